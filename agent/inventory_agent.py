@@ -16,9 +16,15 @@ DEFAULT_CONFIG = {
     "api_url": "https://inventario-it-nfzl.onrender.com/api/inventory",
     "client_code": "DEFAULT",
     "interval_seconds": 60,
-    "api_key": ""
+    "inventory_interval_seconds": 86400,
+    "api_key": "",
+    # Commands run side by side, each killed (with its child processes) after the timeout
+    "max_concurrent_commands": 2,
+    "command_timeout_seconds": 60
 }
 CONFIG_FILE = "agent_config.json"
+# Machine id token handed out by the server, kept next to the config
+IDENTITY_FILE = "agent_identity.json"
 
 def load_config():
     """Load configuration from JSON file"""
@@ -62,12 +68,19 @@ def setup_agent():
     if url:
         config['api_url'] = url
         
-    interval = input(f"Enter Collection Interval (seconds) [{config['interval_seconds']}]: ").strip()
+    interval = input(f"Enter Heartbeat Interval (seconds) [{config['interval_seconds']}]: ").strip()
     if interval:
         try:
             config['interval_seconds'] = int(interval)
         except ValueError:
             print("Invalid interval. Using previous value.")
+
+    interval = input(f"Enter Full Inventory Interval (seconds) [{config['inventory_interval_seconds']}]: ").strip()
+    if interval:
+        try:
+            config['inventory_interval_seconds'] = int(interval)
+        except ValueError:
+            print("Invalid interval. Using previous value.")
             
     code = input(f"Enter Client Code [{config.get('client_code', 'DEFAULT')}]: ").strip()
     if code:
@@ -80,11 +93,47 @@ def setup_agent():
     save_config(config)
     print("Setup complete.")
 
+def load_identity(client_code):
+    """
+    The saved identity, if it was issued to this hostname (not copied from
+    another machine) under this client code.
+    """
+    try:
+        with open(IDENTITY_FILE, 'r') as f:
+            identity = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if identity.get("hostname") != socket.gethostname() or identity.get("client_code") != client_code:
+        return {}
+    return identity
+
+def remember_identity(response):
+    """Save the token the server sent, when it changed."""
+    token = response.headers.get("X-Agent-Token")
+    if not token or token == AGENT_IDENTITY.get("token"):
+        return
+    AGENT_IDENTITY.update({
+        "token": token, "machine_id": int(token.split(".")[0]), "hostname": socket.gethostname(), "client_code": CLIENT_CODE
+    })
+    try:
+        with open(IDENTITY_FILE, 'w') as f:
+            json.dump(AGENT_IDENTITY, f, indent=4)
+    except OSError as e:
+        print(f"Error saving identity: {e}")
+
+def identity_headers():
+    token = AGENT_IDENTITY.get("token")
+    return {"X-Agent-Token": token} if token else {}
+
 # Global config variable
 AGENT_CONFIG = load_config()
 API_URL = AGENT_CONFIG['api_url']
 INTERVAL_SECONDS = AGENT_CONFIG['interval_seconds']
+INVENTORY_INTERVAL_SECONDS = AGENT_CONFIG['inventory_interval_seconds']
 CLIENT_CODE = AGENT_CONFIG.get('client_code', 'DEFAULT')
+AGENT_IDENTITY = load_identity(CLIENT_CODE)
+MAX_CONCURRENT_COMMANDS = max(int(AGENT_CONFIG['max_concurrent_commands']), 1)
+COMMAND_TIMEOUT_SECONDS = int(AGENT_CONFIG['command_timeout_seconds'])
 
 def get_size(bytes, suffix="GB"):
     """
@@ -213,6 +262,13 @@ def get_system_details():
             print(f"Error getting system details: {e}")
     return details
 
+def collect_metrics():
+    return {
+        "cpu_usage": psutil.cpu_percent(interval=1),
+        "memory_usage": psutil.virtual_memory().percent,
+        "disk_usage": psutil.disk_usage('/').percent
+    }
+
 def collect_system_info():
     sys_details = get_system_details()
     info = {
@@ -226,49 +282,303 @@ def collect_system_info():
         "manufacturer": sys_details["manufacturer"],
         "model": sys_details["model"],
         "serial_number": sys_details["serial_number"],
-        # Real-time metrics
-        "cpu_usage": psutil.cpu_percent(interval=1),
-        "memory_usage": psutil.virtual_memory().percent,
-        "disk_usage": psutil.disk_usage('/').percent,
         "softwares": get_installed_software(),
         "services": get_running_services()
     }
+    # Real-time metrics
+    info.update(collect_metrics())
     return info
 
+# --- Inventory Fingerprints ---
+import hashlib
+
+HARDWARE_KEYS = ["os_info", "processor", "ram_gb", "disk_gb", "manufacturer", "model", "serial_number"]
+
+# Fingerprints the server has acknowledged, per section
+LAST_FINGERPRINTS = {}
+
+def fingerprint(section):
+    """
+    Stable content hash of an inventory section (order independent for lists)
+    """
+    if isinstance(section, list):
+        section = sorted(json.dumps(item, sort_keys=True, default=str) for item in section)
+    payload = json.dumps(section, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def get_sections(data):
+    return {
+        "hardware": {key: data.get(key) for key in HARDWARE_KEYS},
+        "softwares": data.get("softwares", []),
+        "services": data.get("services", [])
+    }
+
+def build_payload(data, fingerprints, full_sections=()):
+    """
+    Attach section fingerprints and drop the sections the server already has
+    """
+    payload = dict(data)
+    for section, digest in fingerprints.items():
+        payload[f"{section}_hash"] = digest
+        if section in full_sections or LAST_FINGERPRINTS.get(section) != digest:
+            continue
+        if section == "hardware":
+            for key in HARDWARE_KEYS:
+                payload.pop(key, None)
+        else:
+            payload.pop(section, None)
+    return payload
+
+# --- Upload Encoding ---
+import gzip
+
+# Optional codecs, used only when the server advertises them
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# What the server accepts, learned from its Accept-Encoding / Accept-Post response headers
+SERVER_ENCODINGS = []
+SERVER_CONTENT_TYPES = []
+
+def remember_server_capabilities(response):
+    global SERVER_ENCODINGS, SERVER_CONTENT_TYPES
+    if "Accept-Encoding" in response.headers:
+        SERVER_ENCODINGS = [e.strip() for e in response.headers["Accept-Encoding"].split(",") if e.strip()]
+    if "Accept-Post" in response.headers:
+        SERVER_CONTENT_TYPES = [c.strip() for c in response.headers["Accept-Post"].split(",") if c.strip()]
+
+def encode_payload(payload):
+    """
+    Serialize and compress the payload with the best codecs both sides support.
+    Returns (body, headers).
+    """
+    if msgpack is not None and "application/msgpack" in SERVER_CONTENT_TYPES:
+        body = msgpack.packb(payload, use_bin_type=True, default=str)
+        headers = {'Content-Type': 'application/msgpack'}
+    else:
+        body = json.dumps(payload, default=str).encode("utf-8")
+        headers = {'Content-Type': 'application/json'}
+
+    if zstandard is not None and "zstd" in SERVER_ENCODINGS:
+        body = zstandard.ZstdCompressor(level=10).compress(body)
+        headers['Content-Encoding'] = 'zstd'
+    elif "gzip" in SERVER_ENCODINGS:
+        body = gzip.compress(body, compresslevel=6)
+        headers['Content-Encoding'] = 'gzip'
+    return body, headers
+
+def post_payload(payload):
+    body, headers = encode_payload(payload)
+    response = requests.post(API_URL, data=body, headers={**headers, **identity_headers()})
+    if response.status_code == 415:
+        # Server no longer accepts what it advertised: re-read its capabilities and retry once
+        SERVER_ENCODINGS.clear()
+        SERVER_CONTENT_TYPES.clear()
+        remember_server_capabilities(response)
+        body, headers = encode_payload(payload)
+        response = requests.post(API_URL, data=body, headers={**headers, **identity_headers()})
+    remember_server_capabilities(response)
+    remember_identity(response)
+    return response
+
 def send_data(data):
     try:
-        headers = {'Content-Type': 'application/json'}
-        # Filter out circular refs or non-serializable if any (though we built dicts)
-        response = requests.post(API_URL, json=data, headers=headers)
-        if response.status_code == 200:
+        fingerprints = {section: fingerprint(value) for section, value in get_sections(data).items()}
+        payload = build_payload(data, fingerprints)
+        response = post_payload(payload)
+
+        # Server lost (or never had) some sections: send them in full
+        resend = [s for s in response.headers.get("X-Inventory-Resend", "").split(",") if s]
+        # 202: server queued the report (write-behind mode)
+        accepted = response.status_code in (200, 202)
+        if accepted and resend:
+            print(f"[{datetime.now()}] Server requested full sections: {', '.join(resend)}")
+            payload = build_payload(data, fingerprints, full_sections=resend)
+            response = post_payload(payload)
+            accepted = response.status_code in (200, 202)
+
+        if accepted:
+            LAST_FINGERPRINTS.update(fingerprints)
             print(f"[{datetime.now()}] Successfully sent inventory data!")
+        elif response.status_code == 429:
+            # Server ingest queue is full; the next cycle will retry
+            print(f"[{datetime.now()}] Server busy, retry in {response.headers.get('Retry-After', '?')}s")
         else:
             print(f"[{datetime.now()}] Failed to send data: {response.status_code} - {response.text}")
     except Exception as e:
         print(f"[{datetime.now()}] Error connecting to server: {e}")
 
+def send_heartbeat():
+    """
+    Send metrics only. Returns False when the server does not know this
+    machine yet and a full inventory is needed.
+    """
+    try:
+        data = {"hostname": socket.gethostname(), "client_code": CLIENT_CODE, **collect_metrics()}
+        response = requests.post(f"{API_BASE_URL}/heartbeat", json=data, headers=identity_headers())
+        if response.status_code == 404:
+            return False
+        remember_identity(response)
+        if response.status_code != 200:
+            print(f"[{datetime.now()}] Failed to send heartbeat: {response.status_code} - {response.text}")
+    except Exception as e:
+        print(f"[{datetime.now()}] Error sending heartbeat: {e}")
+    return True
+
+def run_inventory():
+    try:
+        print("Collecting system info...")
+        data = collect_system_info()
+        print(f"Sending data for {data['hostname']}...")
+        send_data(data)
+    except Exception as e:
+        print(f"Inventory collection failed: {e}")
+
 # --- Remote Command Execution ---
+import queue
 import subprocess
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 API_BASE_URL = API_URL.replace("/inventory", "")
 
-def execute_command(command_id, command_str):
+# Output goes to the server while the command runs: at least this often, at most this big per request
+OUTPUT_FLUSH_SECONDS = 1
+OUTPUT_CHUNK_BYTES = 32 * 1024
+
+class OutputStream:
+    """
+    Sends a command's output to the server in ordered chunks. Servers without
+    the output endpoint get the whole text with the result instead.
+    """
+    def __init__(self, command_id, attempt):
+        self.url = f"{API_BASE_URL}/commands/{command_id}/output"
+        self.attempt = attempt
+        self.offset = 0 # bytes sent for this attempt
+        self.pending = []
+        self.pending_bytes = 0
+        self.streaming = True
+        self.stopped = False # server output cap reached
+        self.text = [] # everything, for servers without streaming
+
+    def write(self, text):
+        self.text.append(text)
+        if not self.streaming or self.stopped:
+            return
+        self.pending.append(text)
+        self.pending_bytes += len(text.encode("utf-8"))
+        if self.pending_bytes >= OUTPUT_CHUNK_BYTES:
+            self.flush()
+
+    def flush(self):
+        data = "".join(self.pending)
+        self.pending, self.pending_bytes = [], 0
+        # Slices of OUTPUT_CHUNK_BYTES / 4 characters stay under the byte limit
+        step = OUTPUT_CHUNK_BYTES // 4
+        for i in range(0, len(data), step):
+            if not self.streaming or self.stopped:
+                return
+            self.send(data[i:i + step])
+
+    def send(self, piece):
+        body = {"attempt": self.attempt, "offset": self.offset, "data": piece}
+        for _ in range(3):
+            try:
+                response = requests.post(self.url, json=body, timeout=30)
+            except Exception as e:
+                print(f"[{datetime.now()}] Failed to send output: {e}")
+                time.sleep(1)
+                continue
+            if response.status_code != 200:
+                # No output endpoint (404) or a refused chunk: the whole output goes with the result
+                self.streaming = False
+            else:
+                self.offset += len(piece.encode("utf-8"))
+                if response.json().get("truncated"):
+                    self.stopped = True
+            return
+        # Server unreachable: the rest goes with the result
+        self.streaming = False
+
+    def result_output(self):
+        """Output for the result request: None once it was streamed."""
+        self.flush()
+        return None if self.streaming else "".join(self.text)
+
+def _read_lines(pipe, lines):
+    for line in pipe:
+        lines.put(line)
+    lines.put(None)
+
+def kill_process_tree(pid):
+    """Kill a process and everything it started (PowerShell often spawns children)."""
+    try:
+        parent = psutil.Process(pid)
+        procs = parent.children(recursive=True) + [parent]
+    except psutil.NoSuchProcess:
+        return
+    for proc in procs:
+        try:
+            proc.kill()
+        except psutil.NoSuchProcess:
+            pass
+    psutil.wait_procs(procs, timeout=5)
+
+def execute_command(command_id, command_str, attempt=1, job=None):
+    """
+    Run a command, streaming its output. `job` is the runner's entry for it:
+    the process is registered there so a cancellation can kill it.
+    Returns (output, status).
+    """
     print(f"[{datetime.now()}] Executing command: {command_str}")
+    output = OutputStream(command_id, attempt)
+    job = job if job is not None else {"proc": None, "cancelled": False, "lock": threading.Lock()}
     try:
-        # Run powershell command
-        # Use shell=True to allow shell built-ins, but capture output
+        # Run powershell command, stderr interleaved with stdout as produced
         # '-Command' handles the string as a command
-        proc = subprocess.run(["powershell", "-Command", command_str], capture_output=True, text=True, timeout=60)
-        
-        output = proc.stdout
-        if proc.stderr:
-            output += f"\nERROR:\n{proc.stderr}"
-            
-        status = "completed" if proc.returncode == 0 else "error"
+        proc = subprocess.Popen(["powershell", "-Command", command_str], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        with job["lock"]:
+            job["proc"] = proc
+            cancelled = job["cancelled"]
+        if cancelled:
+            # Cancelled while starting
+            kill_process_tree(proc.pid)
+        lines = queue.Queue()
+        threading.Thread(target=_read_lines, args=(proc.stdout, lines), daemon=True).start()
+
+        deadline = time.monotonic() + COMMAND_TIMEOUT_SECONDS
+        last_flush = time.monotonic()
+        while True:
+            try:
+                line = lines.get(timeout=max(min(OUTPUT_FLUSH_SECONDS, deadline - time.monotonic()), 0))
+            except queue.Empty:
+                line = ""
+            if line is None:
+                break
+            output.write(line)
+            if time.monotonic() - last_flush >= OUTPUT_FLUSH_SECONDS:
+                output.flush()
+                last_flush = time.monotonic()
+            if time.monotonic() > deadline:
+                kill_process_tree(proc.pid)
+                raise subprocess.TimeoutExpired(command_str, COMMAND_TIMEOUT_SECONDS)
+
+        returncode = proc.wait()
+        if job["cancelled"]:
+            output.write("\nCancelled.")
+            return output, "cancelled"
+        status = "completed" if returncode == 0 else "error"
         
     except Exception as e:
-        output = f"Execution failed: {str(e)}"
+        output.write(f"\nExecution failed: {str(e)}")
         status = "error"
         
     # Check for Admin rights if error
@@ -277,39 +587,143 @@ def execute_command(command_id, command_str):
              import ctypes
              is_admin = ctypes.windll.shell32.IsUserAnAdmin() != 0
              if not is_admin:
-                 output += "\n\n[DICA]: O Agente NÃO está rodando como Administrador.\nO Windows exige privilégios de Admin para iniciar/parar serviços.\nPor favor, feche e abra o terminal como Administrador."
+                 output.write("\n\n[DICA]: O Agente NÃO está rodando como Administrador.\nO Windows exige privilégios de Admin para iniciar/parar serviços.\nPor favor, feche e abra o terminal como Administrador.")
         except:
              pass
-        
-    # Send result back
+
+    return output, status
+
+def send_result(command_id, attempt, output, status, duration_ms, queue_depth):
     try:
-        data = {"output": output, "status": status}
+        data = {
+            "output": output.result_output(), "attempt": attempt, "status": status,
+            "duration_ms": duration_ms, "queue_depth": queue_depth
+        }
         requests.post(f"{API_BASE_URL}/commands/{command_id}/result", json=data)
-        print(f"[{datetime.now()}] Command {command_id} result sent (Status: {status})")
+        print(f"[{datetime.now()}] Command {command_id} result sent (Status: {status}, {duration_ms} ms)")
     except Exception as e:
         print(f"[{datetime.now()}] Failed to send command result: {e}")
 
+class CommandRunner:
+    """
+    Runs claimed commands on a bounded pool of worker threads, so polling
+    (and cancellations) go on while commands run.
+    """
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="command")
+        self.lock = threading.Lock()
+        self.jobs = {} # command id -> {"proc", "cancelled", "lock"}, from claim to result
+        self.waiting = 0 # claimed, no worker yet
+        self.finished = deque(maxlen=100) # ids whose result was sent
+
+    def backlog(self):
+        with self.lock:
+            return len(self.jobs)
+
+    def submit(self, cmd):
+        with self.lock:
+            # Already running, or closed by a cancel in the same poll response
+            if cmd['id'] in self.jobs or cmd['id'] in self.finished:
+                return
+            self.jobs[cmd['id']] = {"proc": None, "cancelled": False, "lock": threading.Lock()}
+            self.waiting += 1
+        self.executor.submit(self.run, cmd['id'], cmd['command'], cmd.get('attempts') or 1)
+
+    def cancel(self, command_id):
+        """Kill the command if it runs here. False when there was nothing new to do."""
+        with self.lock:
+            job = self.jobs.get(command_id)
+            finished = command_id in self.finished
+        if job is None:
+            if finished:
+                return False
+            # Claimed before the agent restarted: nothing runs, close it
+            self.finished.append(command_id)
+            try:
+                requests.post(f"{API_BASE_URL}/commands/{command_id}/result", json={"output": "Not running on this agent.", "status": "cancelled"})
+            except Exception as e:
+                print(f"[{datetime.now()}] Failed to send command result: {e}")
+            return True
+        with job["lock"]:
+            if job["cancelled"]:
+                return False
+            job["cancelled"] = True
+            proc = job["proc"]
+        print(f"[{datetime.now()}] Cancelling command {command_id}")
+        if proc is not None:
+            kill_process_tree(proc.pid)
+        return True
+
+    def run(self, command_id, command_str, attempt):
+        with self.lock:
+            self.waiting -= 1
+            job = self.jobs[command_id]
+        started = time.monotonic()
+        try:
+            if job["cancelled"]:
+                output = OutputStream(command_id, attempt)
+                output.write("Cancelled before it started.")
+                status = "cancelled"
+            else:
+                output, status = execute_command(command_id, command_str, attempt, job)
+            with self.lock:
+                queue_depth = self.waiting
+            send_result(command_id, attempt, output, status, int((time.monotonic() - started) * 1000), queue_depth)
+        finally:
+            with self.lock:
+                del self.jobs[command_id]
+                self.finished.append(command_id)
+
+
+# Long-poll: the server holds the request until a command is queued (at most this long)
+COMMAND_WAIT_SECONDS = 55
+# With no free slot the agent only asks for cancellations, and comes back sooner
+BUSY_WAIT_SECONDS = 5
 
 def poll_commands():
     """
-    Polls for pending commands every few seconds
+    Waits for pending commands and hands them to the runner. The server parks
+    the request until a command is queued (or a cancel requested) for this
+    host; servers without long-polling are polled every 3 seconds.
     """
     hostname = socket.gethostname()
+    runner = CommandRunner(MAX_CONCURRENT_COMMANDS)
+    wait = COMMAND_WAIT_SECONDS
     while True:
+        long_poll = False
+        # Claim up to one extra command per worker: it waits here, not in the server's lease
+        limit = max(2 * runner.max_workers - runner.backlog(), 0)
+        poll_wait = wait if limit else min(wait, BUSY_WAIT_SECONDS)
         try:
-            response = requests.get(f"{API_BASE_URL}/commands/pending", params={"hostname": hostname})
+            response = requests.get(
+                f"{API_BASE_URL}/commands/pending",
+                params={"hostname": hostname, "client_code": CLIENT_CODE, "wait": poll_wait, "limit": limit},
+                headers=identity_headers(),
+                timeout=poll_wait + 15
+            )
             if response.status_code == 200:
+                # Only servers that support long-polling send this header
+                server_max = response.headers.get("X-Command-Wait-Max")
+                if server_max is not None:
+                    long_poll = True
+                    wait = min(COMMAND_WAIT_SECONDS, int(server_max))
+                cancels = [int(command_id) for command_id in response.headers.get("X-Cancel-Commands", "").split(",") if command_id]
+                new_cancels = [command_id for command_id in cancels if runner.cancel(command_id)]
                 commands = response.json()
                 for cmd in commands:
-                    # Execute in another thread to not block polling? 
-                    # For now scalar execution is safer to avoid overload
-                    execute_command(cmd['id'], cmd['command'])
-            else:
-                pass # No commands or error, just wait
+                    runner.submit(cmd)
+                if commands or new_cancels:
+                    # Ask again right away, more may be queued
+                    continue
+                if cancels:
+                    # Still reported until their result is in
+                    time.sleep(1)
         except Exception as e:
             print(f"polling error: {e}")
         
-        time.sleep(3) # Poll every 3 seconds
+        if not long_poll:
+            time.sleep(3) # Poll every 3 seconds
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="IT Inventory Agent")
@@ -325,6 +739,9 @@ if __name__ == "__main__":
     API_URL = AGENT_CONFIG['api_url']
     API_BASE_URL = API_URL.replace("/inventory", "")
     INTERVAL_SECONDS = AGENT_CONFIG['interval_seconds']
+    INVENTORY_INTERVAL_SECONDS = AGENT_CONFIG['inventory_interval_seconds']
+    MAX_CONCURRENT_COMMANDS = max(int(AGENT_CONFIG['max_concurrent_commands']), 1)
+    COMMAND_TIMEOUT_SECONDS = int(AGENT_CONFIG['command_timeout_seconds'])
 
     print(f"Starting IT Inventory Agent... (Target: {API_URL})")
     
@@ -337,28 +754,27 @@ if __name__ == "__main__":
     except:
         pass
 
-    # Start Command Polling Thread
+    # Full inventory on start and every INVENTORY_INTERVAL_SECONDS,
+    # a metrics-only heartbeat every INTERVAL_SECONDS in between
+    run_inventory()
+    next_inventory = time.monotonic() + INVENTORY_INTERVAL_SECONDS
+
+    # Started after the first inventory: the machine is registered and its token known
     cmd_thread = threading.Thread(target=poll_commands, daemon=True)
     cmd_thread.start()
     print("Command polling started.")
 
-    # Initial run
-    try:
-        print("Collecting system info...")
-        data = collect_system_info()
-        print(f"Sending data for {data['hostname']}...")
-        send_data(data)
-    except Exception as e:
-         print(f"Initial collection failed: {e}")
-
     # Loop
     while True:
-        time.sleep(INTERVAL_SECONDS)
         try:
-            print("Collecting system info...")
-            data = collect_system_info()
-            print(f"Sending data for {data['hostname']}...")
-            send_data(data)
+            time.sleep(INTERVAL_SECONDS)
+            if time.monotonic() >= next_inventory:
+                run_inventory()
+                next_inventory = time.monotonic() + INVENTORY_INTERVAL_SECONDS
+            elif not send_heartbeat():
+                print("Machine unknown to server, sending full inventory...")
+                run_inventory()
+                next_inventory = time.monotonic() + INVENTORY_INTERVAL_SECONDS
         except KeyboardInterrupt:
             print("\nStopping Agent.")
             break
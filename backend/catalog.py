@@ -0,0 +1,273 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import event, func, insert, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session as OrmSession
+from sqlmodel import Session, select
+
+from .models import Machine, MachineSoftware, SoftwareCatalog
+
+# Max (name, version, publisher) -> catalog id entries kept per process
+CATALOG_CACHE_SIZE = int(os.environ.get("SOFTWARE_CATALOG_CACHE_SIZE", "50000"))
+
+CatalogKey = Tuple[str, Optional[str], Optional[str]]
+
+
+class CatalogCache:
+    """Thread-safe LRU of catalog keys to SoftwareCatalog ids."""
+
+    def __init__(self, max_size: int = CATALOG_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: CatalogKey) -> Optional[int]:
+        with self._lock:
+            catalog_id = self._entries.get(key)
+            if catalog_id is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return catalog_id
+
+    def update(self, entries: Dict[CatalogKey, int]):
+        with self._lock:
+            for key, catalog_id in entries.items():
+                self._entries[key] = catalog_id
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+catalog_cache = CatalogCache()
+
+# Ids resolved inside a transaction only reach the cache once it commits,
+# so a rollback can never leave ids of rows that don't exist in the cache
+PENDING_KEY = "software_catalog_ids"
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _promote_pending_ids(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending:
+        catalog_cache.update(pending)
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_pending_ids(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+def discard_pending_ids(session: Session):
+    # Called when a savepoint is rolled back
+    session.info.pop(PENDING_KEY, None)
+
+
+def resolve_catalog_ids(session: Session, keys: Iterable[CatalogKey]) -> Dict[CatalogKey, int]:
+    """
+    Map (name, version, publisher) keys to catalog ids, interning new entries.
+    Most keys are served from the in-memory LRU without touching the database.
+    """
+    pending = session.info.setdefault(PENDING_KEY, {})
+    ids = {}
+    missing = []
+    for key in keys:
+        catalog_id = pending.get(key) or catalog_cache.get(key)
+        if catalog_id is None:
+            missing.append(key)
+        else:
+            ids[key] = catalog_id
+    if not missing:
+        return ids
+
+    found = _lookup(session, missing)
+    new_keys = [key for key in missing if key not in found]
+    if new_keys:
+        _insert_entries(session, new_keys)
+        found.update(_lookup(session, new_keys))
+    pending.update(found)
+    ids.update(found)
+    return ids
+
+
+def _lookup(session: Session, keys) -> Dict[CatalogKey, int]:
+    wanted = set(keys)
+    names = sorted({key[0] for key in wanted})
+    found = {}
+    for i in range(0, len(names), 500):
+        rows = session.execute(
+            select(SoftwareCatalog.id, SoftwareCatalog.name, SoftwareCatalog.version, SoftwareCatalog.publisher)
+            .where(SoftwareCatalog.name.in_(names[i:i + 500]))
+            .order_by(SoftwareCatalog.id)
+        ).all()
+        for row in rows:
+            key = (row.name, row.version, row.publisher)
+            # NULLs never collide in the unique constraint: keep the oldest entry
+            if key in wanted and key not in found:
+                found[key] = row.id
+    return found
+
+
+def _insert_entries(session: Session, keys):
+    table = SoftwareCatalog.__table__
+    rows = [
+        {"name": name, "version": version, "publisher": publisher, "version_sort": version_sort_key(version)}
+        for name, version, publisher in keys
+    ]
+    dialect = session.get_bind().dialect.name
+    # Another worker may intern the same entry concurrently
+    if dialect == "postgresql":
+        statement = pg_insert(table).on_conflict_do_nothing()
+    elif dialect == "sqlite":
+        statement = sqlite_insert(table).on_conflict_do_nothing()
+    else:
+        statement = insert(table)
+    session.execute(statement, rows)
+
+
+# --- Fleet-wide search ---
+
+# Per-version machine counts returned by a search
+SEARCH_MAX_VERSIONS = 100
+# Above this many matching installs a search pages through machines instead
+SEARCH_BROAD_LINKS = 5000
+
+
+def version_key(version: str):
+    # "120.0.6099.130" < "120.0.6099.217" < "121.0"; numeric parts compare as numbers
+    return tuple((1, int(part)) if part.isdigit() else (0, part.lower()) for part in re.findall(r"\d+|[A-Za-z]+", version))
+
+
+def version_sort_key(version: Optional[str]) -> Optional[str]:
+    """
+    version_key() as a string with the same byte order: each part is a type
+    digit, numbers length-prefixed, and ends with "." (below digits and
+    letters, so a shorter version sorts first).
+    """
+    if version is None:
+        return None
+    parts = []
+    for is_number, part in version_key(version):
+        if is_number:
+            digits = str(part)
+            parts.append(f"1{len(digits):02d}{digits}.")
+        else:
+            parts.append(f"0{part}.")
+    return "".join(parts)
+
+
+def backfill_version_sort(session: Session, batch_size: int = 1000) -> int:
+    """Fill SoftwareCatalog.version_sort for entries stored before it existed."""
+    filled = 0
+    while True:
+        rows = session.execute(
+            select(SoftwareCatalog.id, SoftwareCatalog.version)
+            .where(SoftwareCatalog.version_sort.is_(None), SoftwareCatalog.version.is_not(None))
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            return filled
+        session.execute(update(SoftwareCatalog), [{"id": row.id, "version_sort": version_sort_key(row.version)} for row in rows])
+        session.commit()
+        filled += len(rows)
+
+
+def _like_pattern(text: str) -> str:
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def matching_catalog(q: Optional[str] = None, publisher: Optional[str] = None, version_lt: Optional[str] = None):
+    """
+    Condition on MachineSoftware.catalog_id for the catalog entries matching
+    the filters. It stays a subquery, so a broad filter never turns into a
+    long bind list. Infix matches use the trigram indexes on PostgreSQL; on
+    SQLite the catalog is small enough to scan. Versions compare on the
+    stored version_sort key.
+    """
+    statement = select(SoftwareCatalog.id)
+    if q:
+        statement = statement.where(SoftwareCatalog.name.ilike(_like_pattern(q), escape="\\"))
+    if publisher:
+        statement = statement.where(SoftwareCatalog.publisher.ilike(_like_pattern(publisher), escape="\\"))
+    if version_lt:
+        statement = statement.where(SoftwareCatalog.version_sort < version_sort_key(version_lt))
+    return MachineSoftware.catalog_id.in_(statement)
+
+
+def search_software(session: Session, q: Optional[str] = None, publisher: Optional[str] = None, version_lt: Optional[str] = None,
+                    cursor: Optional[int] = None, limit: int = 50) -> dict:
+    """
+    Machines with a matching package, keyset-paginated by machine id,
+    plus how many machines run each matching version.
+    """
+    # Every query below filters on the same catalog entries
+    matching = matching_catalog(q, publisher, version_lt)
+
+    links = select(MachineSoftware.machine_id).where(matching)
+    if cursor is not None:
+        links = links.where(MachineSoftware.machine_id > cursor)
+    # Probe at most SEARCH_BROAD_LINKS index entries to see how common the match is
+    probe = session.execute(select(func.count()).select_from(links.limit(SEARCH_BROAD_LINKS).subquery())).scalar()
+    if probe < SEARCH_BROAD_LINKS:
+        # Rare package: distinct machines straight from the (catalog_id, machine_id) index
+        page_query = links.distinct().order_by(MachineSoftware.machine_id).limit(limit + 1)
+    else:
+        # Common package: walk machines in id order, most of them match
+        page_query = (
+            select(Machine.id)
+            .where(Machine.id > (cursor if cursor is not None else 0))
+            .where(links.where(MachineSoftware.machine_id == Machine.id).exists())
+            .order_by(Machine.id)
+            .limit(limit + 1)
+        )
+    machine_ids = session.execute(page_query).scalars().all()
+    next_cursor = machine_ids[limit - 1] if len(machine_ids) > limit else None
+    machine_ids = machine_ids[:limit]
+
+    machines = {}
+    if machine_ids:
+        rows = session.execute(
+            select(Machine.id, Machine.hostname, Machine.client_code, Machine.status, Machine.last_seen)
+            .where(Machine.id.in_(machine_ids))
+        ).all()
+        machines = {row.id: {**row._asdict(), "matches": []} for row in rows}
+        matches = session.execute(
+            select(MachineSoftware.machine_id, SoftwareCatalog.name, SoftwareCatalog.version, SoftwareCatalog.publisher)
+            .join(SoftwareCatalog, SoftwareCatalog.id == MachineSoftware.catalog_id)
+            .where(MachineSoftware.machine_id.in_(machine_ids), matching)
+            .order_by(SoftwareCatalog.name, SoftwareCatalog.version)
+        ).all()
+        for match in matches:
+            machines[match.machine_id]["matches"].append({"name": match.name, "version": match.version, "publisher": match.publisher})
+
+    counts = (
+        select(MachineSoftware.catalog_id, func.count(MachineSoftware.machine_id).label("machines"))
+        .where(matching)
+        .group_by(MachineSoftware.catalog_id)
+        .subquery()
+    )
+    versions = session.execute(
+        select(SoftwareCatalog.name, SoftwareCatalog.version, SoftwareCatalog.publisher, counts.c.machines)
+        .join(counts, counts.c.catalog_id == SoftwareCatalog.id)
+        .order_by(counts.c.machines.desc(), SoftwareCatalog.name, SoftwareCatalog.version)
+        .limit(SEARCH_MAX_VERSIONS)
+    ).all()
+
+    return {
+        "machines": [machines[machine_id] for machine_id in machine_ids if machine_id in machines],
+        "versions": [row._asdict() for row in versions],
+        "next_cursor": next_cursor
+    }
@@ -0,0 +1,75 @@
+import hashlib
+from typing import Optional
+
+from fastapi import Request
+from sqlalchemy import event, insert, update
+from sqlalchemy.orm import Session as OrmSession
+from sqlmodel import Session, select
+
+from .models import FleetState, Machine
+
+# Machines written in the current transaction, stamped with a new change_seq on commit
+PENDING_KEY = "changed_machine_ids"
+FLEET_STATE_ID = 1
+
+
+def mark_changed(session: Session, machine_id: int):
+    session.info.setdefault(PENDING_KEY, set()).add(machine_id)
+
+
+@event.listens_for(OrmSession, "before_commit")
+def _stamp_changed_machines(session):
+    machine_ids = session.info.pop(PENDING_KEY, None)
+    if not machine_ids:
+        return
+    # Bumped last, right before COMMIT: the fleetstate row lock is held as
+    # short as possible and sequence values become visible in commit order
+    seq = next_change_seq(session)
+    session.execute(
+        update(Machine).where(Machine.id.in_(machine_ids)).values(change_seq=seq)
+        .execution_options(synchronize_session=False)
+    )
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_changed_machines(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+def next_change_seq(session: Session) -> int:
+    seq = session.execute(
+        update(FleetState).where(FleetState.id == FLEET_STATE_ID)
+        .values(change_seq=FleetState.change_seq + 1)
+        .returning(FleetState.change_seq)
+    ).scalar()
+    if seq is None:
+        # First write on a fresh database (create_db_and_tables() normally creates the row)
+        session.execute(insert(FleetState).values(id=FLEET_STATE_ID, change_seq=1))
+        seq = 1
+    return seq
+
+
+def current_change_seq(session: Session) -> int:
+    return session.execute(select(FleetState.change_seq).where(FleetState.id == FLEET_STATE_ID)).scalar() or 0
+
+
+def ensure_fleet_state(session: Session):
+    if session.get(FleetState, FLEET_STATE_ID) is None:
+        session.add(FleetState(id=FLEET_STATE_ID, change_seq=0))
+        session.commit()
+
+
+# --- Conditional GET ---
+
+def make_etag(*parts) -> str:
+    digest = hashlib.sha1(":".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'"{digest[:20]}"'
+
+
+def not_modified(request: Request, etag: Optional[str]) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header or etag is None:
+        return False
+    # If-None-Match uses the weak comparison: W/"x" matches "x"
+    candidates = [candidate.strip().removeprefix("W/") for candidate in header.split(",")]
+    return "*" in candidates or etag in candidates
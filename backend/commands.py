@@ -0,0 +1,522 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import String, case, delete, func, insert, literal, update
+from sqlmodel import Session, select
+
+from .events import broker, emit, format_sse, EVENTS_KEEPALIVE_SECONDS
+from .models import Command, CommandJob, CommandOutputChunk, Machine
+from .scheduler import try_leader_lock
+
+# Longest an agent may park on the pending commands endpoints (below common proxy idle timeouts)
+COMMAND_WAIT_MAX_SECONDS = float(os.environ.get("COMMAND_WAIT_MAX_SECONDS", "55"))
+# A claimed command goes back to pending when no result arrived within the lease
+COMMAND_LEASE_SECONDS = int(os.environ.get("COMMAND_LEASE_SECONDS", "300"))
+COMMAND_MAX_ATTEMPTS = int(os.environ.get("COMMAND_MAX_ATTEMPTS", "3"))
+# Commands handed out per poll: the agent runs them one after another within the lease
+COMMAND_CLAIM_LIMIT = int(os.environ.get("COMMAND_CLAIM_LIMIT", "5"))
+COMMAND_LEASE_SWEEP_SECONDS = float(os.environ.get("COMMAND_LEASE_SWEEP_SECONDS", "30"))
+# Job progress streams send at most one update per interval, completions arrive in bursts
+JOB_PROGRESS_INTERVAL_SECONDS = float(os.environ.get("JOB_PROGRESS_INTERVAL_SECONDS", "1"))
+# Streamed output: largest append accepted, and total kept per command (UTF-8 bytes)
+COMMAND_OUTPUT_CHUNK_MAX_BYTES = int(os.environ.get("COMMAND_OUTPUT_CHUNK_MAX_BYTES", "65536"))
+COMMAND_OUTPUT_MAX_BYTES = int(os.environ.get("COMMAND_OUTPUT_MAX_BYTES", "1048576"))
+
+
+def queue_command(session: Session, machine: Machine, command: str) -> Command:
+    """Insert a pending command and wake the agent waiting for it."""
+    cmd = Command(machine_id=machine.id, command=command, status="pending", max_attempts=COMMAND_MAX_ATTEMPTS)
+    session.add(cmd)
+    session.flush()
+    emit(session, "command.queued", command_id=cmd.id, machine_id=machine.id,
+         hostname=machine.hostname, client_code=machine.client_code)
+    session.commit()
+    session.refresh(cmd)
+    return cmd
+
+
+def _machine_condition(machine_id: Optional[int], hostname: Optional[str], client_code: Optional[str]):
+    if machine_id is not None:
+        return Command.machine_id == machine_id
+    # Hostnames repeat across clients: the machine is the unique (client_code, hostname)
+    return Command.machine_id.in_(
+        select(Machine.id).where(Machine.client_code == (client_code or "DEFAULT"), Machine.hostname == hostname)
+    )
+
+
+def claim_statement(machine_id: Optional[int], hostname: Optional[str], limit: int, now: datetime, client_code: Optional[str] = None):
+    candidates = (
+        select(Command.id).where(Command.status == "pending", _machine_condition(machine_id, hostname, client_code))
+        .order_by(Command.id).limit(limit).with_for_update(skip_locked=True)
+    )
+    return (
+        # status repeated on the UPDATE: a row claimed meanwhile is not claimed twice
+        update(Command).where(Command.id.in_(candidates), Command.status == "pending")
+        .values(
+            status="running", lease_expires_at=now + timedelta(seconds=COMMAND_LEASE_SECONDS), attempts=Command.attempts + 1,
+            # Each attempt streams its output from offset 0
+            output_size=0, output_truncated=False
+        )
+        .returning(*Command.__table__.columns)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def claim_commands(
+    session: Session,
+    machine_id: Optional[int] = None,
+    hostname: Optional[str] = None,
+    limit: int = COMMAND_CLAIM_LIMIT,
+    now: Optional[datetime] = None,
+    client_code: Optional[str] = None,
+) -> List[Command]:
+    """
+    Move the oldest pending commands of one machine (by id or client code and hostname) to
+    running with a lease, in one UPDATE ... RETURNING, and commit. A command
+    is handed out once per lease: concurrent polls skip the rows another one
+    is claiming (SKIP LOCKED on PostgreSQL, SQLite serializes writers).
+    """
+    rows = session.execute(claim_statement(machine_id, hostname, limit, now or datetime.utcnow(), client_code)).all()
+    session.commit()
+    return sorted((Command(**row._mapping) for row in rows), key=lambda cmd: cmd.id)
+
+
+def cancel_requests(
+    session: Session, machine_id: Optional[int] = None, hostname: Optional[str] = None, client_code: Optional[str] = None
+) -> List[int]:
+    """Ids of the machine's running commands the agent should kill."""
+    return list(session.exec(
+        select(Command.id).where(Command.status == "running", _machine_condition(machine_id, hostname, client_code),
+                                 Command.cancel_requested.is_(True))
+        .order_by(Command.id)
+    ))
+
+
+def poll_agent_commands(
+    session_factory, machine_id: Optional[int], hostname: Optional[str], client_code: Optional[str], limit: int
+) -> Tuple[List[Command], List[int]]:
+    with session_factory() as session:
+        commands = claim_commands(session, machine_id, hostname, limit, client_code=client_code) if limit > 0 else []
+        return commands, cancel_requests(session, machine_id, hostname, client_code)
+
+
+def request_cancel(session: Session, command_id: int) -> Optional[Command]:
+    """
+    Cancel a command: a pending one right away, a running one by flagging it
+    and waking its agent, which kills it and reports status cancelled.
+    Finished commands are left as they are. None when it does not exist.
+    """
+    cmd = session.get(Command, command_id)
+    if cmd is None:
+        return None
+    machine = session.get(Machine, cmd.machine_id)
+    client_code = machine.client_code if machine else None
+    # Conditional UPDATEs: the command may be claimed or finish meanwhile
+    cancelled = session.execute(
+        update(Command).where(Command.id == command_id, Command.status == "pending")
+        .values(status="cancelled", executed_at=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if cancelled:
+        emit(session, "command.completed", command_id=cmd.id, machine_id=cmd.machine_id, job_id=cmd.job_id,
+             client_code=client_code, status="cancelled")
+    elif session.execute(
+        update(Command).where(Command.id == command_id, Command.status == "running")
+        .values(cancel_requested=True)
+        .execution_options(synchronize_session=False)
+    ).rowcount:
+        emit(session, "command.cancel", command_id=cmd.id, machine_id=cmd.machine_id,
+             hostname=machine.hostname if machine else None, client_code=client_code)
+    session.commit()
+    session.refresh(cmd)
+    return cmd
+
+
+def requeue_expired_leases(session: Session, now: Optional[datetime] = None) -> List[int]:
+    """
+    Put running commands whose lease expired back to pending, or to error
+    once they used max_attempts (to cancelled when a cancel was requested).
+    Returns the ids of the commands changed.
+    """
+    if not try_leader_lock(session, "command_leases"):
+        return []
+    now = now or datetime.utcnow()
+    exhausted = Command.attempts >= Command.max_attempts
+    finished = Command.cancel_requested.is_(True) | exhausted
+    rows = session.execute(
+        update(Command).where(Command.status == "running", Command.lease_expires_at < now)
+        .values(
+            status=case((Command.cancel_requested.is_(True), "cancelled"), (exhausted, "error"), else_="pending"),
+            output=case(
+                (Command.cancel_requested.is_(False) & exhausted, "No result received after " + Command.attempts.cast(String) + " attempts"),
+                else_=Command.output
+            ),
+            executed_at=case((finished, now), else_=Command.executed_at),
+            lease_expires_at=None
+        )
+        .returning(Command.id, Command.machine_id, Command.job_id, Command.status)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if rows:
+        machines = {
+            machine.id: machine for machine in session.execute(
+                select(Machine.id, Machine.hostname, Machine.client_code).where(Machine.id.in_({row.machine_id for row in rows}))
+            )
+        }
+        for row in rows:
+            machine = machines.get(row.machine_id)
+            hostname = machine.hostname if machine else None
+            client_code = machine.client_code if machine else None
+            if row.status == "pending":
+                # Wakes the agent if it is parked on the pending endpoint
+                emit(session, "command.queued", command_id=row.id, machine_id=row.machine_id, hostname=hostname, client_code=client_code)
+            else:
+                emit(session, "command.completed", command_id=row.id, machine_id=row.machine_id, job_id=row.job_id,
+                     client_code=client_code, status=row.status)
+    session.commit()
+    return [row.id for row in rows]
+
+
+def requeue_expired_commands(session_factory):
+    with session_factory() as session:
+        requeue_expired_leases(session)
+
+
+def _queued_filter(machine_id: Optional[int], hostname: Optional[str], client_code: Optional[str]):
+    def match(data: dict) -> bool:
+        if data["type"] not in ("command.queued", "command.cancel"):
+            return False
+        if machine_id is not None:
+            return data["machine_id"] == machine_id
+        return data["hostname"] == hostname and data["client_code"] == (client_code or "DEFAULT")
+    return match
+
+
+async def wait_for_commands(
+    session_factory,
+    wait: float,
+    machine_id: Optional[int] = None,
+    hostname: Optional[str] = None,
+    limit: int = COMMAND_CLAIM_LIMIT,
+    client_code: Optional[str] = None,
+) -> Tuple[List[Command], List[int]]:
+    """
+    Claim up to `limit` pending commands of one machine (by id or client code and hostname),
+    along with the ids of its running commands to cancel. When there are
+    neither, park for up to `wait` seconds until a command.queued or
+    command.cancel event for it arrives (from this process or, with the
+    PostgreSQL broker, any worker). No database connection is held while parked.
+    """
+    # Subscribed before the first read: a command queued in between still wakes us
+    subscription = broker.subscribe(_queued_filter(machine_id, hostname, client_code)) if wait > 0 else None
+    try:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            commands, cancels = await run_in_threadpool(poll_agent_commands, session_factory, machine_id, hostname, client_code, limit)
+            remaining = deadline - loop.time()
+            if commands or cancels or subscription is None or remaining <= 0:
+                return commands, cancels
+            if await subscription.get(remaining) is None:
+                return [], []
+    finally:
+        if subscription is not None:
+            subscription.close()
+
+
+# Statuses a command does not leave anymore
+FINISHED_STATUSES = ("completed", "error", "cancelled")
+
+
+def load_command(session_factory, command_id: int) -> Optional[Command]:
+    with session_factory() as session:
+        command = session.get(Command, command_id)
+        return with_streamed_output(session, command) if command else None
+
+
+async def wait_for_result(session_factory, command_id: int, timeout: float) -> Optional[Command]:
+    """
+    The command once it is completed/error, or as it is after `timeout`
+    seconds. Woken by its command.completed event (any worker with the
+    PostgreSQL broker), the database is only read again then.
+    Returns None when the command does not exist.
+    """
+    subscription = broker.subscribe(lambda data: data["type"] == "command.completed" and data["command_id"] == command_id)
+    try:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            command = await run_in_threadpool(load_command, session_factory, command_id)
+            remaining = deadline - loop.time()
+            if command is None or command.status in FINISHED_STATUSES or remaining <= 0:
+                return command
+            await subscription.get(remaining)
+    finally:
+        subscription.close()
+
+
+# --- Streamed output ---
+
+def append_output(session: Session, command_id: int, attempt: int, start: int, data: str) -> Optional[dict]:
+    """
+    Store `data` as the output of a running command's attempt at byte offset
+    `start`, which must be where the stored output ends. The size check and
+    bump are one conditional UPDATE, so chunks land in order exactly once.
+    Past COMMAND_OUTPUT_MAX_BYTES the data is cut and output_truncated set.
+
+    Returns None when the command does not exist, else its output size and
+    whether the data was accepted: a retried chunk (already stored) or one
+    dropped past the cap is, a gap or a stale attempt is not.
+    """
+    encoded = data.encode("utf-8")
+    # Cut on a character boundary
+    kept = encoded[:max(COMMAND_OUTPUT_MAX_BYTES - start, 0)].decode("utf-8", errors="ignore").encode("utf-8")
+    truncated = len(kept) < len(encoded)
+    row = session.execute(
+        update(Command).where(
+            Command.id == command_id, Command.attempts == attempt, Command.status == "running",
+            Command.output_size == start, Command.output_truncated.is_(False)
+        )
+        .values(output_size=start + len(kept), output_truncated=truncated)
+        .returning(Command.machine_id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    if row is None:
+        session.rollback()
+        cmd = session.get(Command, command_id)
+        if cmd is None:
+            return None
+        accepted = cmd.attempts == attempt and (cmd.output_truncated or start + len(encoded) <= cmd.output_size)
+        return {"size": cmd.output_size, "truncated": cmd.output_truncated, "accepted": accepted}
+
+    if kept:
+        session.add(CommandOutputChunk(command_id=command_id, attempt=attempt, start=start, size=len(kept), data=kept.decode("utf-8")))
+    # Wakes the tails of this command
+    emit(session, "command.output", command_id=command_id, machine_id=row.machine_id, size=start + len(kept))
+    session.commit()
+    return {"size": start + len(kept), "truncated": truncated, "accepted": True}
+
+
+def streamed_output(session: Session, command_id: int, attempt: int) -> Optional[str]:
+    """The chunks of one attempt joined, None when it streamed nothing."""
+    chunks = session.exec(
+        select(CommandOutputChunk.data)
+        .where(CommandOutputChunk.command_id == command_id, CommandOutputChunk.attempt == attempt)
+        .order_by(CommandOutputChunk.start)
+    ).all()
+    return "".join(chunks) if chunks else None
+
+
+def with_streamed_output(session: Session, command: Command) -> Command:
+    """
+    The finished command with its streamed output in `output`, for
+    responses only: the chunks stay the one stored copy.
+    """
+    if command.output is None and command.status in FINISHED_STATUSES:
+        output = streamed_output(session, command.id, command.attempts)
+        if output is not None:
+            # Detached, so the filled-in output is never flushed back
+            session.expunge(command)
+            command.output = output
+    return command
+
+
+def store_result_output(session: Session, command: Command, output: Optional[str]):
+    """
+    Keep one copy of the finished attempt's output: a result posted whole
+    replaces the streamed chunks, else the chunks are the output and only
+    those of earlier attempts are dropped.
+    """
+    stale = CommandOutputChunk.command_id == command.id
+    if output is not None:
+        command.output = output
+    else:
+        stale &= CommandOutputChunk.attempt != command.attempts
+    session.execute(delete(CommandOutputChunk).where(stale))
+
+
+def read_output(session: Session, command_id: int, offset: int = 0, limit: int = COMMAND_OUTPUT_CHUNK_MAX_BYTES) -> Optional[dict]:
+    """
+    Up to `limit` bytes of the command's output from byte `offset` on, cut
+    on a character boundary, and the offset to ask for next. A result posted
+    whole (older agents, streaming refused) replaces the streamed chunks and
+    is served the same way.
+    """
+    cmd = session.get(Command, command_id)
+    if cmd is None:
+        return None
+    if cmd.output is None:
+        size = cmd.output_size
+        chunks = session.execute(
+            select(CommandOutputChunk.start, CommandOutputChunk.data)
+            .where(CommandOutputChunk.command_id == command_id, CommandOutputChunk.attempt == cmd.attempts,
+                   CommandOutputChunk.start + CommandOutputChunk.size > offset)
+            .order_by(CommandOutputChunk.start)
+        )
+        pieces, read = [], 0
+        for chunk in chunks:
+            piece = chunk.data.encode("utf-8")[max(offset - chunk.start, 0):]
+            pieces.append(piece)
+            read += len(piece)
+            if read >= limit:
+                break
+        data = _cut(b"".join(pieces), limit)
+    else:
+        encoded = cmd.output.encode("utf-8")
+        size = len(encoded)
+        # A UTF-8 character is at most 4 bytes
+        data = _cut(encoded[offset:offset + limit + 3], limit)
+    next_offset = offset + len(data)
+    return {
+        "command_id": cmd.id,
+        "status": cmd.status,
+        "data": data.decode("utf-8", errors="replace"),
+        "offset": next_offset,
+        "size": size,
+        "truncated": cmd.output_truncated,
+        "done": cmd.status in FINISHED_STATUSES and next_offset >= size,
+    }
+
+
+def _cut(data: bytes, limit: int) -> bytes:
+    """
+    At most `limit` bytes of `data` without splitting a character, or its
+    first character when `limit` is smaller, so a reader always moves on.
+    """
+    if len(data) <= limit:
+        return data
+    end = limit
+    while end > 0 and (data[end] & 0xC0) == 0x80:
+        end -= 1
+    if end == 0:
+        end = 1
+        while end < len(data) and (data[end] & 0xC0) == 0x80:
+            end += 1
+    return data[:end]
+
+
+def load_output(session_factory, command_id: int, offset: int, limit: int) -> Optional[dict]:
+    with session_factory() as session:
+        return read_output(session, command_id, offset, limit)
+
+
+async def wait_for_output(session_factory, command_id: int, offset: int = 0, wait: float = 0,
+                          limit: int = COMMAND_OUTPUT_CHUNK_MAX_BYTES) -> Optional[dict]:
+    """
+    read_output, parking up to `wait` seconds while there is nothing past
+    `offset` and the command is not finished. Woken by the command's
+    command.output / command.completed events.
+    """
+    subscription = broker.subscribe(
+        lambda data: data["type"] in ("command.output", "command.completed") and data["command_id"] == command_id
+    ) if wait > 0 else None
+    try:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            output = await run_in_threadpool(load_output, session_factory, command_id, offset, limit)
+            remaining = deadline - loop.time()
+            if output is None or output["data"] or output["done"] or subscription is None or remaining <= 0:
+                return output
+            await subscription.get(remaining)
+    finally:
+        if subscription is not None:
+            subscription.close()
+
+
+# --- Jobs: one command fanned out to many machines ---
+
+def create_job(session: Session, command: str, conditions: list, selector: dict) -> Optional[CommandJob]:
+    """
+    Queue `command` on every machine matching `conditions` with a single
+    INSERT ... SELECT, under a new CommandJob. Commits, or rolls back and
+    returns None when no machine matches.
+    """
+    job = CommandJob(command=command, selector=json.dumps(selector, default=str))
+    session.add(job)
+    session.flush()
+    now = datetime.utcnow()
+    columns = ["machine_id", "job_id", "command", "status", "created_at", "attempts", "max_attempts"]
+    machines = select(
+        Machine.id, literal(job.id), literal(command), literal("pending"), literal(now), literal(0), literal(COMMAND_MAX_ATTEMPTS)
+    ).where(*conditions)
+    job.total = session.execute(insert(Command).from_select(columns, machines)).rowcount
+    if not job.total:
+        session.rollback()
+        return None
+
+    # Wake the agents parked on the pending endpoints
+    queued = session.execute(
+        select(Command.id, Command.machine_id, Machine.hostname, Machine.client_code)
+        .join(Machine, Machine.id == Command.machine_id)
+        .where(Command.job_id == job.id)
+    )
+    for row in queued:
+        emit(session, "command.queued", command_id=row.id, machine_id=row.machine_id, job_id=job.id,
+             hostname=row.hostname, client_code=row.client_code)
+    session.commit()
+    session.refresh(job)
+    return job
+
+
+def job_progress(session: Session, job_id: int) -> Optional[dict]:
+    """Counts per status of the job's commands, None when the job does not exist."""
+    job = session.get(CommandJob, job_id)
+    if job is None:
+        return None
+    counts = dict(session.execute(
+        select(Command.status, func.count()).where(Command.job_id == job_id).group_by(Command.status)
+    ).all())
+    progress = {"id": job.id, "command": job.command, "created_at": job.created_at, "total": job.total}
+    for status in ("pending", "running", "completed", "error", "cancelled"):
+        progress[status] = counts.get(status, 0)
+    progress["done"] = progress["pending"] + progress["running"] == 0
+    return progress
+
+
+def load_job_progress(session_factory, job_id: int) -> Optional[dict]:
+    with session_factory() as session:
+        return job_progress(session, job_id)
+
+
+def job_commands(session: Session, job_id: int, status: Optional[str] = None, cursor: Optional[int] = None, limit: int = 100):
+    """One page of the job's commands with their hostname, without outputs. Returns (rows, next_cursor)."""
+    statement = (
+        select(Command.id, Command.machine_id, Machine.hostname, Command.status, Command.attempts, Command.executed_at)
+        .outerjoin(Machine, Machine.id == Command.machine_id)
+        .where(Command.job_id == job_id)
+    )
+    if status:
+        statement = statement.where(Command.status == status)
+    if cursor:
+        statement = statement.where(Command.id > cursor)
+    rows = session.execute(statement.order_by(Command.id).limit(limit + 1)).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return [dict(row._mapping) for row in rows[:limit]], next_cursor
+
+
+async def iter_job_progress(session_factory, job_id: int, interval: float = JOB_PROGRESS_INTERVAL_SECONDS):
+    """
+    text/event-stream of job.progress events: the current counts, then new
+    counts after completions (at most one per interval), until the job is done.
+    """
+    subscription = broker.subscribe(lambda data: data["type"] == "command.completed" and data.get("job_id") == job_id)
+    try:
+        while True:
+            progress = await run_in_threadpool(load_job_progress, session_factory, job_id)
+            yield format_sse({"type": "job.progress", **progress})
+            if progress["done"]:
+                return
+            if await subscription.get(EVENTS_KEEPALIVE_SECONDS) is None:
+                # Counts are read again anyway: leases may have expired meanwhile
+                continue
+            # Let the burst accumulate, one update covers it
+            await asyncio.sleep(interval)
+            while not subscription.queue.empty():
+                subscription.queue.get_nowait()
+    finally:
+        subscription.close()
@@ -1,5 +1,12 @@
 from sqlmodel import SQLModel, create_engine, Session
+from sqlalchemy import inspect, insert, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from .catalog import backfill_version_sort
+from contextlib import contextmanager
+import io
 import os
+import zlib
 
 # Render/Cloud uses DATABASE_URL. Local uses SQLite.
 database_url = os.environ.get("DATABASE_URL")
@@ -17,9 +24,145 @@ else:
     # PostgreSQL configuration
     engine = create_engine(database_url, echo=True)
 
+# Advisory lock key of the startup schema steps
+SCHEMA_LOCK_KEY = zlib.crc32(b"schema")
+
 def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+    # Every gunicorn worker runs this at startup: one at a time, the others find nothing left to do
+    with schema_lock():
+        SQLModel.metadata.create_all(engine)
+        add_missing_columns()
+        add_missing_indexes()
+        drop_obsolete_indexes()
+        create_search_indexes()
+        with Session(engine) as session:
+            # Catalog entries interned before SoftwareCatalog.version_sort existed
+            backfill_version_sort(session)
+
+@contextmanager
+def schema_lock():
+    # Session-level lock on its own autocommit connection, held across the DDL
+    # transactions. SQLite already serializes writers.
+    if engine.dialect.name != "postgresql":
+        yield
+        return
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        try:
+            yield
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": SCHEMA_LOCK_KEY})
+
+def add_missing_columns():
+    # create_all() never alters existing tables, so columns added to the
+    # models after a table was created are added here (nullable, with default)
+    inspector = inspect(engine)
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                # IF NOT EXISTS: a second run (another process, a retried boot) is a no-op on PostgreSQL
+                if_not_exists = "IF NOT EXISTS " if engine.dialect.name == "postgresql" else ""
+                ddl = (
+                    f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {if_not_exists}{preparer.quote(column.name)} "
+                    f"{column.type.compile(dialect=engine.dialect)}"
+                )
+                if column.default is not None and column.default.is_scalar:
+                    ddl += f" DEFAULT {column.default.arg!r}"
+                conn.execute(text(ddl))
+                print(f"Added column {table.name}.{column.name}")
+
+def add_missing_indexes():
+    # Same for indexes declared on tables that already exist
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                try:
+                    # IF NOT EXISTS: harmless if another process created it since the inspection
+                    conn.execute(CreateIndex(index, if_not_exists=True))
+                except IntegrityError as e:
+                    # Not served without it: the ingest upsert needs uq_machine_client_code_hostname
+                    raise RuntimeError(
+                        f"Index {index.name} cannot be created, the table has duplicate rows. "
+                        "Run python merge_duplicate_machines.py first."
+                    ) from e
+                print(f"Created index {index.name}")
+
+# Indexes dropped from the models, each one costs every machine write. Covered by uq_machine_client_code_hostname
+OBSOLETE_INDEXES = ("ix_machine_client_code", "ix_machine_client_code_hostname")
+
+def drop_obsolete_indexes():
+    with engine.begin() as conn:
+        for name in OBSOLETE_INDEXES:
+            conn.execute(text(f"DROP INDEX IF EXISTS {engine.dialect.identifier_preparer.quote(name)}"))
+
+def create_search_indexes():
+    # Trigram indexes make the infix (ILIKE '%q%') software search an index
+    # scan on PostgreSQL. SQLite scans the catalog, which stays small.
+    if engine.dialect.name != "postgresql":
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_softwarecatalog_name_trgm ON softwarecatalog USING gin (name gin_trgm_ops)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_softwarecatalog_publisher_trgm ON softwarecatalog USING gin (publisher gin_trgm_ops)"))
+    except Exception as e:
+        print(f"Trigram indexes skipped (pg_trgm not available): {e}")
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+def get_session_factory():
+    # For endpoints that wait a long time: they open short sessions instead of holding one
+    return lambda: Session(engine)
+
+# --- Bulk writes ---
+
+def bulk_insert(session: Session, model, rows):
+    """
+    Insert many rows in one round trip, bypassing the ORM unit of work.
+    Uses COPY on PostgreSQL (psycopg2) and a multi-row executemany elsewhere.
+    Rows are plain dicts with the same keys.
+    """
+    if not rows:
+        return
+    table = model.__table__
+    bind = session.get_bind()
+    if bind.dialect.name == "postgresql" and bind.dialect.driver == "psycopg2":
+        copy_rows(session, table, rows)
+    else:
+        session.execute(insert(table), rows)
+
+def copy_rows(session: Session, table, rows):
+    columns = list(rows[0].keys())
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(",".join(_copy_field(row.get(column)) for column in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    preparer = session.get_bind().dialect.identifier_preparer
+    column_list = ", ".join(preparer.quote(column) for column in columns)
+    sql = f"COPY {preparer.format_table(table)} ({column_list}) FROM STDIN WITH (FORMAT csv)"
+    # Raw DBAPI connection of the current transaction
+    dbapi_connection = session.connection().connection
+    with dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(sql, buffer)
+
+def _copy_field(value):
+    # In CSV COPY an unquoted empty field is NULL, a quoted one an empty string
+    if value is None:
+        return ""
+    return '"' + str(value).replace('"', '""') + '"'
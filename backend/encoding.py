@@ -0,0 +1,227 @@
+import json
+import os
+import zlib
+from typing import AsyncIterator, Iterator, Optional
+
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+
+# Optional codecs: only advertised when installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Upper bound of a request body once decoded, compressed or not (decompression bomb guard).
+# Streamed NDJSON uploads have no total: each line is bounded instead, and so
+# is what one received chunk may inflate to
+MAX_DECODED_BODY_BYTES = int(os.environ.get("INVENTORY_MAX_BODY_BYTES", str(20 * 1024 * 1024)))
+# Streams are decompressed in pieces of at most this size
+DECODED_PIECE_BYTES = 1024 * 1024
+
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def accepted_encodings():
+    encodings = ["gzip", "deflate"]
+    if zstandard is not None:
+        encodings.insert(0, "zstd")
+    return encodings
+
+
+def accepted_content_types():
+    content_types = ["application/json"]
+    if msgpack is not None:
+        content_types.append("application/msgpack")
+    return content_types
+
+
+def advertised_headers():
+    # RFC 7694: Accept-Encoding on a response lists the codings accepted in requests
+    return {
+        "Accept-Encoding": ", ".join(accepted_encodings()),
+        "Accept-Post": ", ".join(accepted_content_types())
+    }
+
+
+def _unsupported(detail: str):
+    return HTTPException(status_code=415, detail=detail, headers=advertised_headers())
+
+
+def _too_large():
+    return HTTPException(status_code=413, detail=f"Body exceeds {MAX_DECODED_BODY_BYTES} bytes once decoded")
+
+
+class _LimitedSink:
+    # Output side of the zstd stream writer, refuses to grow past the limit
+    def __init__(self):
+        self.chunks = []
+        self.total = 0
+        self.limit = MAX_DECODED_BODY_BYTES
+
+    def write(self, data) -> int:
+        self.total += len(data)
+        if self.total > self.limit:
+            raise _too_large()
+        self.chunks.append(bytes(data))
+        return len(data)
+
+
+class _Decoder:
+    """
+    Incremental decompressor. With max_total (whole bodies) the decoded size
+    is capped; without (streams) only what one fed chunk inflates to is.
+    """
+
+    def __init__(self, encoding: str, max_total: Optional[int]):
+        self._zlib = None
+        self._zstd = None
+        if encoding == "gzip":
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self._zlib = zlib.decompressobj()
+        elif encoding == "zstd" and zstandard is not None:
+            self._sink = _LimitedSink()
+            self._zstd = zstandard.ZstdDecompressor().stream_writer(self._sink, write_size=65536, closefd=False)
+        else:
+            raise _unsupported(f"Unsupported Content-Encoding: {encoding}")
+        self.max_total = max_total
+        self.total = 0
+
+    def feed(self, data: bytes) -> bytes:
+        return b"".join(self.pieces(data))
+
+    def pieces(self, data: bytes) -> Iterator[bytes]:
+        try:
+            if self._zstd is not None:
+                # Bounded per call: the whole body, or one received chunk of a stream
+                if self.max_total is None:
+                    self._sink.total = 0
+                self._zstd.write(data)
+                self._zstd.flush()
+                outs = self._sink.chunks
+                self._sink.chunks = []
+            else:
+                outs = self._inflate(data)
+            for out in outs:
+                self.total += len(out)
+                if self.max_total is not None and self.total > self.max_total:
+                    raise _too_large()
+                yield out
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid compressed body: {e}")
+
+    def _inflate(self, data: bytes) -> Iterator[bytes]:
+        # Never inflate more than the limit (or one piece) at once, whatever the input claims
+        while data:
+            if self.max_total is not None:
+                out = self._zlib.decompress(data, self.max_total - self.total + 1)
+                if self._zlib.unconsumed_tail:
+                    raise _too_large()
+            else:
+                out = self._zlib.decompress(data, DECODED_PIECE_BYTES)
+            yield out
+            data = self._zlib.unconsumed_tail
+
+
+def _encoding(request: Request) -> str:
+    return request.headers.get("content-encoding", "identity").strip().lower()
+
+
+def _is_msgpack(request: Request) -> bool:
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    return content_type in MSGPACK_CONTENT_TYPES
+
+
+async def _read_body(request: Request) -> bytes:
+    """
+    The raw body, held to the decoded cap as it is read: a chunked upload
+    has no Content-Length to check up front. Kept on the request, so the
+    route reads it from there.
+    """
+    declared = request.headers.get("content-length", "")
+    if declared.isdigit() and int(declared) > MAX_DECODED_BODY_BYTES:
+        raise _too_large()
+    pieces, size = [], 0
+    async for piece in request.stream():
+        size += len(piece)
+        if size > MAX_DECODED_BODY_BYTES:
+            raise _too_large()
+        pieces.append(piece)
+    request._body = b"".join(pieces)
+    return request._body
+
+
+async def decode_request(request: Request) -> Request:
+    """
+    Return a request whose body is plain JSON: decompresses gzip/deflate/zstd
+    bodies and converts MessagePack to JSON.
+    """
+    encoding = _encoding(request)
+    is_msgpack = _is_msgpack(request)
+    body = await _read_body(request)
+    if encoding == "identity" and not is_msgpack:
+        return request
+
+    if encoding != "identity":
+        decoder = _Decoder(encoding, MAX_DECODED_BODY_BYTES)
+        body = decoder.feed(body)
+    if is_msgpack:
+        if msgpack is None:
+            raise _unsupported("MessagePack bodies are not supported by this server")
+        try:
+            body = json.dumps(msgpack.unpackb(body, raw=False)).encode("utf-8")
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=f"Invalid MessagePack body: {e}")
+
+    # Rebuild the request as if the client had sent uncompressed JSON
+    headers = [
+        (key, value) for key, value in request.scope["headers"]
+        if key not in (b"content-encoding", b"content-length", b"content-type")
+    ]
+    headers += [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]
+    decoded = Request({**request.scope, "headers": headers}, request.receive)
+    decoded._body = body
+    return decoded
+
+
+async def iter_decoded_stream(request: Request) -> AsyncIterator[bytes]:
+    """
+    Decompress a streamed request body chunk by chunk (for NDJSON uploads).
+    There is no total cap: the parser bounds each line (MAX_NDJSON_LINE_BYTES).
+    """
+    encoding = _encoding(request)
+    if encoding == "identity":
+        async for data in request.stream():
+            yield data
+        return
+    decoder = _Decoder(encoding, max_total=None)
+    async for data in request.stream():
+        for out in decoder.pieces(data):
+            if out:
+                yield out
+
+
+class DecodingRoute(APIRoute):
+    """
+    Route class for agent upload endpoints: accepts compressed and
+    MessagePack bodies and advertises the supported codecs on every response.
+    """
+
+    def get_route_handler(self):
+        original_handler = super().get_route_handler()
+
+        async def handler(request: Request):
+            request = await decode_request(request)
+            response = await original_handler(request)
+            response.headers.update(advertised_headers())
+            return response
+
+        return handler
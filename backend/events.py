@@ -0,0 +1,324 @@
+import asyncio
+import json
+import os
+import select
+import threading
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session as OrmSession
+from sqlmodel import Session
+
+from .database import engine
+from .models import Machine
+
+# LISTEN/NOTIFY channel shared by the worker processes (PostgreSQL)
+EVENTS_CHANNEL = os.environ.get("EVENTS_CHANNEL", "inventory_events")
+# "postgres" fans events out to every worker, "local" only within the process
+EVENTS_BROKER = os.environ.get("EVENTS_BROKER") or ("postgres" if engine.dialect.name == "postgresql" else "local")
+# Events a slow client may fall behind before it is told to resync
+EVENTS_QUEUE_SIZE = int(os.environ.get("EVENTS_QUEUE_SIZE", "1000"))
+# Comment line sent on idle streams so proxies keep the connection open
+EVENTS_KEEPALIVE_SECONDS = float(os.environ.get("EVENTS_KEEPALIVE_SECONDS", "15"))
+# NOTIFY payloads are limited to 8000 bytes
+MAX_NOTIFY_PAYLOAD_BYTES = 7500
+
+# Sent to subscribers that missed events: reload the state instead of patching it
+RESYNC_EVENT = {"type": "resync"}
+
+
+class Subscription:
+    """One client stream: a bounded queue filled from the event loop that created it."""
+
+    def __init__(self, broker: "LocalBroker", match: Optional[Callable[[dict], bool]], maxsize: int):
+        self.broker = broker
+        self.match = match
+        self.queue = asyncio.Queue(maxsize)
+        self.loop = asyncio.get_running_loop()
+
+    def wants(self, data: dict) -> bool:
+        return self.match is None or self.match(data)
+
+    def _put(self, events: List[dict]):
+        # Runs on self.loop
+        for data in events:
+            try:
+                self.queue.put_nowait(data)
+            except asyncio.QueueFull:
+                # Too far behind: drop the backlog, the client reloads instead
+                while not self.queue.empty():
+                    self.queue.get_nowait()
+                self.queue.put_nowait(RESYNC_EVENT)
+                return
+
+    async def get(self, timeout: Optional[float] = None) -> Optional[dict]:
+        """Next event, or None after timeout seconds."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """Fans events out to the subscribers of this process."""
+
+    # Events are published after the transaction commits
+    transactional = False
+
+    def __init__(self, queue_size: int = EVENTS_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscribers = set()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def subscribe(self, match: Optional[Callable[[dict], bool]] = None) -> Subscription:
+        """Must be called from the event loop that will consume the subscription."""
+        subscription = Subscription(self, match, self.queue_size)
+        with self._lock:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def add_listener(self, callback: Callable[[List[dict]], None]):
+        """Call callback with every batch dispatched in this process, on the dispatching thread (process-wide caches)."""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def publish(self, events: List[dict]):
+        self.dispatch(events)
+
+    def dispatch(self, events: List[dict]):
+        """Hand events to the local subscribers. Safe to call from any thread."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            listeners = list(self._listeners)
+        for callback in listeners:
+            try:
+                callback(events)
+            except Exception as e:
+                print(f"Event listener failed: {e}")
+        for subscription in subscribers:
+            wanted = [data for data in events if data is RESYNC_EVENT or subscription.wants(data)]
+            if not wanted:
+                continue
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._put, wanted)
+            except RuntimeError:
+                # Event loop already closed
+                self.unsubscribe(subscription)
+
+
+class PostgresBroker(LocalBroker):
+    """
+    Cross-process fan-out with LISTEN/NOTIFY. Events are NOTIFYed inside the
+    transaction that produced them, so PostgreSQL delivers them on commit only.
+    Each worker process listens on one dedicated connection and dispatches to
+    its own subscribers, including the events it published itself.
+    """
+
+    transactional = True
+
+    def __init__(self, engine, channel: str = EVENTS_CHANNEL, queue_size: int = EVENTS_QUEUE_SIZE):
+        super().__init__(queue_size)
+        self.engine = engine
+        self.channel = channel
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def notify(self, session: Session, events: List[dict]):
+        for payload in notify_payloads(events):
+            session.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": self.channel, "payload": payload})
+
+    def publish(self, events: List[dict]):
+        with self.engine.begin() as conn:
+            for payload in notify_payloads(events):
+                conn.execute(text("SELECT pg_notify(:channel, :payload)"), {"channel": self.channel, "payload": payload})
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._listen, name="events-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _listen(self):
+        connected_before = False
+        while not self._stopping.is_set():
+            connection = None
+            try:
+                # Kept out of the pool: it stays in LISTEN for the life of the process
+                connection = self.engine.raw_connection()
+                connection.detach()
+                dbapi_connection = connection.dbapi_connection
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {self.engine.dialect.identifier_preparer.quote(self.channel)}")
+                if connected_before:
+                    # Whatever was published while reconnecting is lost
+                    self.dispatch([RESYNC_EVENT])
+                connected_before = True
+                while not self._stopping.is_set():
+                    if select.select([dbapi_connection], [], [], 1.0) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    events = []
+                    while dbapi_connection.notifies:
+                        events.extend(json.loads(dbapi_connection.notifies.pop(0).payload))
+                    if events:
+                        self.dispatch(events)
+            except Exception as e:
+                print(f"Event listener error, reconnecting: {e}")
+                self._stopping.wait(5)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+
+def notify_payloads(events: Iterable[dict]):
+    """JSON arrays of events, each small enough for one NOTIFY."""
+    batch, size = [], 2
+    for data in events:
+        encoded = json.dumps(data, default=_json_default, separators=(",", ":"))
+        length = len(encoded.encode("utf-8"))
+        if length + 2 > MAX_NOTIFY_PAYLOAD_BYTES:
+            print(f"Event {data.get('type')} too large for NOTIFY, dropped")
+            continue
+        if batch and size + length + 1 > MAX_NOTIFY_PAYLOAD_BYTES:
+            yield "[" + ",".join(batch) + "]"
+            batch, size = [], 2
+        batch.append(encoded)
+        size += length + 1
+    if batch:
+        yield "[" + ",".join(batch) + "]"
+
+
+def create_broker() -> LocalBroker:
+    if EVENTS_BROKER == "postgres":
+        return PostgresBroker(engine)
+    return LocalBroker()
+
+
+broker = create_broker()
+
+# Events produced inside a transaction, published once it commits
+PENDING_KEY = "pending_events"
+
+
+@event.listens_for(OrmSession, "before_commit")
+def _notify_pending_events(session):
+    if broker.transactional and session.info.get(PENDING_KEY):
+        broker.notify(session, session.info.pop(PENDING_KEY))
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _publish_pending_events(session):
+    events = session.info.pop(PENDING_KEY, None)
+    if events:
+        try:
+            broker.publish(events)
+        except Exception as e:
+            # The transaction is committed already, clients catch up on their next reload
+            print(f"Publishing {len(events)} events failed: {e}")
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_pending_events(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+def pending_events(session: Session) -> list:
+    return session.info.setdefault(PENDING_KEY, [])
+
+
+def emit(session: Session, event_type: str, **data):
+    pending_events(session).append({"type": event_type, **data})
+
+
+# What set-based UPDATEs return to build machine events without another read
+MACHINE_EVENT_COLUMNS = (
+    Machine.id, Machine.hostname, Machine.client_code, Machine.ip_address, Machine.os_info, Machine.last_seen,
+    Machine.cpu_usage, Machine.memory_usage, Machine.disk_usage, Machine.status, Machine.alert_message,
+    Machine.previous_status
+)
+
+
+def machine_event_data(machine) -> dict:
+    """MachineSummary fields of a Machine (or a RETURNING row)."""
+    return {
+        "machine_id": machine.id,
+        "hostname": machine.hostname,
+        "client_code": machine.client_code,
+        "ip_address": machine.ip_address,
+        "os_info": machine.os_info,
+        "last_seen": machine.last_seen.isoformat() if machine.last_seen else None,
+        "cpu_usage": machine.cpu_usage,
+        "memory_usage": machine.memory_usage,
+        "disk_usage": machine.disk_usage,
+        "status": machine.status,
+        "alert_message": machine.alert_message,
+    }
+
+
+def emit_machine_write(session: Session, machine, created: bool = False):
+    """
+    machine.created for a new machine, otherwise machine.updated, plus
+    machine.status when the write changed the status (alert transitions).
+    """
+    data = machine_event_data(machine)
+    if created:
+        emit(session, "machine.created", **data)
+        return
+    emit(session, "machine.updated", **data)
+    if machine.previous_status is not None and machine.previous_status != machine.status:
+        emit(session, "machine.status", previous_status=machine.previous_status, **data)
+
+
+def event_filter(client_code: Optional[str] = None, types: Optional[Iterable[str]] = None):
+    types = set(types) if types else None
+    if client_code is None and types is None:
+        return None
+
+    def match(data: dict) -> bool:
+        if client_code is not None and data.get("client_code") != client_code:
+            return False
+        return types is None or data["type"] in types
+    return match
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def format_sse(data: dict) -> str:
+    return f"event: {data['type']}\ndata: {json.dumps(data, default=_json_default)}\n\n"
+
+
+async def iter_sse(subscription: Subscription, keepalive: float = EVENTS_KEEPALIVE_SECONDS):
+    """text/event-stream body of one subscription, unsubscribed when the client goes away."""
+    try:
+        # Reconnect delay for EventSource
+        yield "retry: 3000\n\n"
+        while True:
+            data = await subscription.get(keepalive)
+            yield format_sse(data) if data is not None else ": keepalive\n\n"
+    finally:
+        subscription.close()
@@ -0,0 +1,83 @@
+import csv
+import io
+import json
+from typing import Callable, Iterator
+
+from sqlmodel import Session, select
+
+from .models import Machine, MachineSoftware, SoftwareCatalog
+
+# Rows fetched per round trip (server-side cursor on PostgreSQL)
+EXPORT_BATCH_SIZE = 1000
+
+CSV_HEADER = ["Client Code", "Hostname", "IP", "OS", "CPU%", "RAM", "Disk", "Software Name", "Version", "Publisher", "Last Seen"]
+
+MACHINE_COLUMNS = (
+    Machine.id, Machine.client_code, Machine.hostname, Machine.ip_address, Machine.os_info,
+    Machine.processor, Machine.ram_gb, Machine.disk_gb, Machine.manufacturer, Machine.model,
+    Machine.serial_number, Machine.cpu_usage, Machine.memory_usage, Machine.disk_usage,
+    Machine.status, Machine.last_seen,
+)
+
+
+def _inventory_rows(session: Session, conditions: list):
+    # One row per (machine, software), machines without software get one row with NULLs
+    statement = (
+        select(*MACHINE_COLUMNS, SoftwareCatalog.name, SoftwareCatalog.version, SoftwareCatalog.publisher)
+        .outerjoin(MachineSoftware, MachineSoftware.machine_id == Machine.id)
+        .outerjoin(SoftwareCatalog, SoftwareCatalog.id == MachineSoftware.catalog_id)
+        .where(*conditions)
+        # Served by uq_machinesoftware_machine_catalog: rows come out without a sort of the whole join
+        .order_by(Machine.id, MachineSoftware.catalog_id)
+    )
+    # yield_per streams from a server-side (named) cursor instead of buffering the result
+    return session.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+
+
+def iter_inventory_csv(session_factory: Callable[[], Session], conditions: list) -> Iterator[str]:
+    """CSV text in chunks of EXPORT_BATCH_SIZE rows, same columns as the old browser export."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    yield buffer.getvalue()
+
+    # The session lives as long as the response is being streamed
+    with session_factory() as session:
+        for partition in _inventory_rows(session, conditions).partitions():
+            buffer.seek(0)
+            buffer.truncate()
+            for row in partition:
+                writer.writerow([
+                    row.client_code, row.hostname, row.ip_address, row.os_info,
+                    row.cpu_usage, row.ram_gb, row.disk_gb,
+                    row.name, row.version, row.publisher,
+                    row.last_seen.isoformat() if row.last_seen else None,
+                ])
+            yield buffer.getvalue()
+
+
+def _machine_dict(row) -> dict:
+    machine = {column.key: getattr(row, column.key) for column in MACHINE_COLUMNS}
+    if machine["last_seen"] is not None:
+        machine["last_seen"] = machine["last_seen"].isoformat()
+    machine["softwares"] = []
+    return machine
+
+
+def iter_inventory_ndjson(session_factory: Callable[[], Session], conditions: list) -> Iterator[str]:
+    """One JSON object per machine (with its softwares) per line."""
+    with session_factory() as session:
+        current = None
+        for partition in _inventory_rows(session, conditions).partitions():
+            lines = []
+            for row in partition:
+                if current is None or current["id"] != row.id:
+                    if current is not None:
+                        lines.append(json.dumps(current))
+                    current = _machine_dict(row)
+                if row.name is not None:
+                    current["softwares"].append({"name": row.name, "version": row.version, "publisher": row.publisher})
+            if lines:
+                yield "\n".join(lines) + "\n"
+        if current is not None:
+            yield json.dumps(current) + "\n"
@@ -0,0 +1,86 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from .auth import SECRET_KEY
+
+# Agents get their machine id signed with this key and send it back on
+# every call; nothing is stored server-side
+AGENT_TOKEN_SECRET = os.environ.get("AGENT_TOKEN_SECRET", SECRET_KEY)
+AGENT_TOKEN_HEADER = "X-Agent-Token"
+
+# Max hostname -> machine id entries kept per process, and how long one is trusted
+HOSTNAME_CACHE_SIZE = int(os.environ.get("HOSTNAME_CACHE_SIZE", "10000"))
+HOSTNAME_CACHE_TTL_SECONDS = float(os.environ.get("HOSTNAME_CACHE_TTL_SECONDS", "300"))
+
+
+def _signature(machine_id: int) -> str:
+    digest = hmac.new(AGENT_TOKEN_SECRET.encode("utf-8"), f"machine:{machine_id}".encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode("ascii")
+
+
+def issue_agent_token(machine_id: int) -> str:
+    return f"{machine_id}.{_signature(machine_id)}"
+
+
+def verify_agent_token(token: Optional[str]) -> Optional[int]:
+    """The machine id of a token from issue_agent_token, None when missing or not signed by us."""
+    if not token:
+        return None
+    machine_id, _, signature = token.partition(".")
+    if not machine_id.isdigit() or not hmac.compare_digest(signature, _signature(int(machine_id))):
+        return None
+    return int(machine_id)
+
+
+class HostnameCache:
+    """
+    Thread-safe LRU of (client_code, hostname) to machine ids, for agents that
+    identify by hostname only. The write paths check an id still has that
+    identity and invalidate it when not; entries also expire, so another
+    worker does not serve the id of a merged or deleted machine for long.
+    A missing client code is "DEFAULT", as on ingest.
+    """
+
+    def __init__(self, max_size: int = HOSTNAME_CACHE_SIZE, ttl: float = HOSTNAME_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (client_code, hostname) -> (machine_id, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, client_code: Optional[str], hostname: Optional[str]) -> Optional[int]:
+        key = (client_code or "DEFAULT", hostname)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, client_code: Optional[str], hostname: str, machine_id: int):
+        key = (client_code or "DEFAULT", hostname)
+        with self._lock:
+            self._entries[key] = (machine_id, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, client_code: Optional[str], hostname: Optional[str]):
+        with self._lock:
+            self._entries.pop((client_code or "DEFAULT", hostname), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+hostname_cache = HostnameCache()
@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from sqlmodel import Session
+
+from .inventory import ingest_chunk, HARDWARE_FIELDS, BATCH_CHUNK_SIZE
+from .models import InventoryReport
+
+# Write-behind mode: /api/inventory answers 202 and workers write in batches
+WRITE_BEHIND_ENABLED = os.environ.get("INVENTORY_WRITE_BEHIND", "0").lower() in ("1", "true", "yes")
+QUEUE_MAX_SIZE = int(os.environ.get("INVENTORY_QUEUE_MAX_SIZE", "10000"))
+QUEUE_BATCH_SIZE = int(os.environ.get("INVENTORY_QUEUE_BATCH_SIZE", str(BATCH_CHUNK_SIZE)))
+QUEUE_WORKERS = int(os.environ.get("INVENTORY_QUEUE_WORKERS", "1"))
+
+
+def machine_key(report: InventoryReport):
+    # The machine a report is written to, see the ingest upsert in backend/inventory.py
+    return (report.client_code or "DEFAULT", report.hostname)
+
+
+def merge_reports(older: InventoryReport, newer: InventoryReport) -> InventoryReport:
+    """
+    Coalesce two pending reports of the same host into the newest one.
+    Sections the newer report omitted (unchanged fingerprint) are carried
+    over from the older report so they are not lost.
+    """
+    merged = newer.model_copy()
+    if merged.softwares is None and older.softwares is not None:
+        merged.softwares = older.softwares
+    if merged.services is None and older.services is not None:
+        merged.services = older.services
+    if all(getattr(merged, field) is None for field in HARDWARE_FIELDS):
+        for field in HARDWARE_FIELDS:
+            setattr(merged, field, getattr(older, field))
+    return merged
+
+
+class IngestQueue:
+    """
+    In-process queue of inventory reports, keyed by (client_code, hostname).
+    A newer report for a host that is still waiting replaces (and is merged
+    with) the pending one, so a slow database only ever sees the latest state.
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], max_size: int = QUEUE_MAX_SIZE,
+                 batch_size: int = QUEUE_BATCH_SIZE, workers: int = QUEUE_WORKERS):
+        self.session_factory = session_factory
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.workers = workers
+
+        self._pending = OrderedDict()  # (client_code, hostname) -> (report, enqueued_at)
+        self._in_flight = set()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+
+        # Metrics
+        self.enqueued = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.last_batch_lag = 0.0
+        self.last_batch_duration = 0.0
+
+    def put(self, report: InventoryReport) -> Optional[InventoryReport]:
+        """
+        Queue a report. Returns the report as it will be written (merged with
+        a pending one for the same host), or None when the queue is full.
+        """
+        key = machine_key(report)
+        with self._cond:
+            pending = self._pending.get(key)
+            if pending is not None:
+                older, enqueued_at = pending
+                report = merge_reports(older, report)
+                # Keep the original enqueue time so lag reflects the oldest data
+                self._pending[key] = (report, enqueued_at)
+                self.coalesced += 1
+            elif len(self._pending) >= self.max_size:
+                self.rejected += 1
+                return None
+            else:
+                self._pending[key] = (report, time.monotonic())
+            self.enqueued += 1
+            self._cond.notify()
+        return report
+
+    def retry_after(self) -> int:
+        # Rough time to drain the queue at the last observed batch speed
+        with self._cond:
+            depth = len(self._pending)
+        if not self.last_batch_duration:
+            return 5
+        batches = depth / max(self.batch_size, 1)
+        return max(1, min(300, int(batches * self.last_batch_duration / max(self.workers, 1)) + 1))
+
+    def stats(self) -> dict:
+        with self._cond:
+            depth = len(self._pending)
+            oldest = next(iter(self._pending.values()), None)
+            lag = time.monotonic() - oldest[1] if oldest else 0.0
+            in_flight = len(self._in_flight)
+        return {
+            "depth": depth,
+            "max_size": self.max_size,
+            "in_flight": in_flight,
+            "lag_seconds": round(lag, 3),
+            "last_batch_lag_seconds": round(self.last_batch_lag, 3),
+            "last_batch_duration_seconds": round(self.last_batch_duration, 3),
+            "enqueued": self.enqueued,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "workers": len(self._threads)
+        }
+
+    def start(self):
+        self._stopping = False
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"ingest-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout: float = 30):
+        """Stop the workers after draining what is already queued."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        # Anything left (e.g. hosts that were in flight) is written synchronously
+        with self._cond:
+            remaining = list(self._pending.values())
+            self._pending.clear()
+        for i in range(0, len(remaining), self.batch_size):
+            self.drain_batch(remaining[i:i + self.batch_size])
+
+    def _take_batch(self):
+        # Skip hosts already being written by another worker to keep per-host order
+        batch = []
+        for key in list(self._pending):
+            if key in self._in_flight:
+                continue
+            report, enqueued_at = self._pending.pop(key)
+            self._in_flight.add(key)
+            batch.append((report, enqueued_at))
+            if len(batch) >= self.batch_size:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+                while not batch:
+                    if self._stopping:
+                        return
+                    self._cond.wait(1.0)
+                    batch = self._take_batch()
+            self.drain_batch(batch)
+
+    def drain_batch(self, batch):
+        started = time.monotonic()
+        self.last_batch_lag = started - min(enqueued_at for _, enqueued_at in batch)
+        try:
+            with self.session_factory() as session:
+                session.expire_on_commit = False
+                results = ingest_chunk(session, [report for report, _ in batch])
+            self.processed += sum(1 for r in results if r["status"] == "ok")
+            self.failed += sum(1 for r in results if r["status"] != "ok")
+        except Exception as e:
+            self.failed += len(batch)
+            print(f"Ingest batch of {len(batch)} reports failed: {e}")
+        finally:
+            self.last_batch_duration = time.monotonic() - started
+            with self._cond:
+                for report, _ in batch:
+                    self._in_flight.discard(machine_key(report))
+                # Hosts skipped while in flight can be picked up now
+                self._cond.notify_all()
@@ -0,0 +1,370 @@
+import json
+import os
+from datetime import datetime
+from types import SimpleNamespace
+from typing import List, Optional
+from sqlmodel import Session, select
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .database import bulk_insert
+from .catalog import resolve_catalog_ids, discard_pending_ids
+from .metrics import record_sample, pending_samples
+from .stats import mark_stats_dirty
+from .changes import mark_changed
+from .events import emit_machine_write, pending_events, MACHINE_EVENT_COLUMNS
+from .identity import hostname_cache
+from .models import Machine, MachineSoftware, Service, InventoryReport, Heartbeat
+
+# Reports committed per transaction by the batch/stream endpoints
+BATCH_CHUNK_SIZE = int(os.environ.get("INVENTORY_BATCH_CHUNK_SIZE", "100"))
+MAX_BATCH_CHUNK_SIZE = 1000
+# Longest accepted NDJSON line (one report)
+MAX_NDJSON_LINE_BYTES = 5 * 1024 * 1024
+
+# Report fields covered by the "hardware" fingerprint
+HARDWARE_FIELDS = ("os_info", "processor", "ram_gb", "disk_gb", "manufacturer", "model", "serial_number")
+
+
+def hardware_sent(report: InventoryReport) -> bool:
+    return any(getattr(report, field) is not None for field in HARDWARE_FIELDS)
+
+
+def plan_sections(report: InventoryReport, machine: Machine):
+    """
+    Decide per section (hardware, softwares, services) what to do with a report.
+    Returns (to_sync, to_resend): sections to write and sections the agent
+    only fingerprinted but the server does not have.
+    """
+    sections = (
+        ("hardware", hardware_sent(report), report.hardware_hash, machine.hardware_hash),
+        ("softwares", report.softwares is not None, report.softwares_hash, machine.softwares_hash),
+        ("services", report.services is not None, report.services_hash, machine.services_hash),
+    )
+    to_sync, to_resend = [], []
+    for section, sent, report_hash, stored_hash in sections:
+        if report_hash is not None and report_hash == stored_hash:
+            # Unchanged since the last accepted scan
+            continue
+        if sent:
+            to_sync.append(section)
+        elif report_hash is not None:
+            to_resend.append(section)
+    return to_sync, to_resend
+
+
+def compute_alert(disk_usage: Optional[float], memory_usage: Optional[float]):
+    """Returns (status, alert_message) for the reported metrics."""
+    if disk_usage and disk_usage > 90:
+        return "critical", "Storage Critical (>90%)"
+    if memory_usage and memory_usage > 90:
+        return "warning", "High Memory Usage (>90%)"
+    return "online", None
+
+
+def apply_heartbeat(session: Session, heartbeat: Heartbeat, machine_id: Optional[int] = None, known_id: Optional[int] = None) -> List[int]:
+    """
+    Update last_seen, metrics and status with a single UPDATE statement.
+    Targets machine_id when given, otherwise the machine of
+    (heartbeat.client_code, heartbeat.hostname): by the id from the agent's
+    token (known_id) or the hostname cache when it still has that identity,
+    by the unique (client_code, hostname) if not.
+    Returns the ids of the machines updated.
+    """
+    status, alert_msg = compute_alert(heartbeat.disk_usage, heartbeat.memory_usage)
+    statement = update(Machine).values(
+        # The right-hand side reads the row before the update
+        previous_status=Machine.status,
+        last_seen=datetime.utcnow(),
+        cpu_usage=heartbeat.cpu_usage,
+        memory_usage=heartbeat.memory_usage,
+        disk_usage=heartbeat.disk_usage,
+        status=status,
+        alert_message=alert_msg
+    )
+    # RETURNING has both statuses: status transitions need no extra read
+    statement = statement.returning(*MACHINE_EVENT_COLUMNS).execution_options(synchronize_session=False)
+    if machine_id is not None:
+        rows = session.execute(statement.where(Machine.id == machine_id)).all()
+    else:
+        client_code = heartbeat.client_code or "DEFAULT"
+        identity = (Machine.client_code == client_code, Machine.hostname == heartbeat.hostname)
+        known_id = known_id or hostname_cache.get(client_code, heartbeat.hostname)
+        rows = []
+        if known_id is not None:
+            rows = session.execute(statement.where(Machine.id == known_id, *identity)).all()
+        if not rows:
+            hostname_cache.invalidate(client_code, heartbeat.hostname)
+            rows = session.execute(statement.where(*identity)).all()
+            if rows:
+                hostname_cache.put(client_code, heartbeat.hostname, rows[0].id)
+    for row in rows:
+        mark_changed(session, row.id)
+        record_sample(session, row.id, heartbeat.cpu_usage, heartbeat.memory_usage, heartbeat.disk_usage)
+        emit_machine_write(session, row)
+        if row.previous_status != row.status:
+            mark_stats_dirty(session)
+    return [row.id for row in rows]
+
+
+def check_queued_report(session: Session, report: InventoryReport):
+    """
+    Read-only look at the stored machine of a report that is written later
+    (write-behind mode). Returns (machine_id, to_resend): the id is None for
+    a host not registered yet, to_resend the sections the agent only
+    fingerprinted and the stored machine does not match.
+    """
+    stored = session.execute(
+        select(Machine.id, Machine.hardware_hash, Machine.softwares_hash, Machine.services_hash)
+        .where(Machine.client_code == (report.client_code or "DEFAULT"), Machine.hostname == report.hostname)
+    ).first()
+    if stored is None:
+        stored = SimpleNamespace(id=None, hardware_hash=None, softwares_hash=None, services_hash=None)
+    return stored.id, plan_sections(report, stored)[1]
+
+
+def software_key(data: dict):
+    # Natural key of an installed package
+    return (data.get("name"), data.get("version"), data.get("publisher"))
+
+
+def sync_softwares(session: Session, machine: Machine, softwares: List[dict]):
+    """
+    Reconcile the catalog links of a machine with a new scan.
+    Only packages that appeared or disappeared are inserted/deleted.
+    """
+    keys = []
+    seen = set()
+    for soft_data in softwares:
+        key = software_key(soft_data)
+        if key in seen or not key[0]:
+            continue
+        seen.add(key)
+        keys.append(key)
+    catalog_ids = resolve_catalog_ids(session, keys)
+    wanted = {catalog_ids[key] for key in keys}
+
+    stored = session.execute(
+        select(MachineSoftware.id, MachineSoftware.catalog_id)
+        .where(MachineSoftware.machine_id == machine.id)
+    ).all()
+
+    existing = set()
+    to_delete = []
+    for row in stored:
+        if row.catalog_id in existing or row.catalog_id not in wanted:
+            # Uninstalled, or a duplicate left behind by older scans
+            to_delete.append(row.id)
+        else:
+            existing.add(row.catalog_id)
+
+    to_insert = []
+    for key in keys:
+        catalog_id = catalog_ids[key]
+        if catalog_id not in existing:
+            existing.add(catalog_id)
+            to_insert.append({"machine_id": machine.id, "catalog_id": catalog_id})
+
+    if to_delete:
+        session.execute(delete(MachineSoftware).where(MachineSoftware.id.in_(to_delete)).execution_options(synchronize_session=False))
+    bulk_insert(session, MachineSoftware, to_insert)
+
+
+def sync_services(session: Session, machine: Machine, services: List[dict]):
+    """
+    Reconcile the stored Service rows of a machine with a new scan.
+    Services are matched by name; only changed rows are updated.
+    """
+    stored = session.execute(
+        select(Service.id, Service.name, Service.display_name, Service.status, Service.start_type)
+        .where(Service.machine_id == machine.id)
+    ).all()
+
+    existing = {}
+    to_delete = []
+    for row in stored:
+        if row.name in existing:
+            to_delete.append(row.id)
+        else:
+            existing[row.name] = row
+
+    to_insert = []
+    to_update = []
+    seen = set()
+    for svc_data in services:
+        name = svc_data.get("name")
+        if name in seen:
+            continue
+        seen.add(name)
+        values = {
+            "display_name": svc_data.get("display_name"),
+            "status": svc_data.get("status"),
+            "start_type": svc_data.get("start_type")
+        }
+        row = existing.pop(name, None)
+        if row is None:
+            to_insert.append({"name": name, "machine_id": machine.id, **values})
+        elif any(getattr(row, field) != value for field, value in values.items()):
+            # Only touch the row if something actually changed
+            to_update.append({"id": row.id, **values})
+
+    to_delete.extend(row.id for row in existing.values())
+    if to_delete:
+        session.execute(delete(Service).where(Service.id.in_(to_delete)).execution_options(synchronize_session=False))
+    if to_update:
+        # Bulk UPDATE by primary key
+        session.execute(update(Service), to_update)
+    bulk_insert(session, Service, to_insert)
+
+
+def upsert_statement(dialect: str, report: InventoryReport, now: datetime):
+    """
+    INSERT ... ON CONFLICT (client_code, hostname) DO UPDATE ... RETURNING
+    the machine: registration and the metric update in one statement, safe
+    against concurrent first reports of a host. previous_status is the old
+    status on update and NULL on insert.
+    """
+    status, alert_msg = compute_alert(report.disk_usage, report.memory_usage)
+    values = {
+        "hostname": report.hostname,
+        "client_code": report.client_code or "DEFAULT",
+        "ip_address": report.ip_address,
+        "last_seen": now,
+        "cpu_usage": report.cpu_usage,
+        "memory_usage": report.memory_usage,
+        "disk_usage": report.disk_usage,
+        "status": status,
+        "alert_message": alert_msg,
+        "previous_status": None,
+    }
+    updated = ["ip_address", "last_seen", "cpu_usage", "memory_usage", "disk_usage", "status", "alert_message"]
+    # Hardware is omitted by the agent when its fingerprint did not change
+    if hardware_sent(report):
+        values.update({field: getattr(report, field) for field in HARDWARE_FIELDS})
+        updated.extend(HARDWARE_FIELDS)
+    insert = pg_insert if dialect == "postgresql" else sqlite_insert
+    statement = insert(Machine).values(**values)
+    return statement.on_conflict_do_update(
+        index_elements=["client_code", "hostname"],
+        set_={
+            **{field: statement.excluded[field] for field in updated},
+            # Unqualified columns in DO UPDATE read the existing row
+            "previous_status": Machine.__table__.c.status,
+        },
+    ).returning(Machine)
+
+
+def ingest_report(session: Session, report: InventoryReport):
+    """
+    Apply one report to the session without committing.
+    Returns (machine, to_resend).
+    """
+    dialect = session.get_bind().dialect.name
+    machine = session.scalars(
+        upsert_statement(dialect, report, datetime.utcnow()),
+        execution_options={"populate_existing": True}
+    ).one()
+    created = machine.previous_status is None
+
+    if created:
+        hostname_cache.invalidate(machine.client_code, report.hostname)
+    else:
+        hostname_cache.put(machine.client_code, report.hostname, machine.id)
+    # Stats fields: client_code is part of the identity, hardware changes show in its fingerprint
+    hardware_changed = hardware_sent(report) and (report.hardware_hash is None or report.hardware_hash != machine.hardware_hash)
+    if created or machine.previous_status != machine.status or hardware_changed:
+        mark_stats_dirty(session)
+
+    mark_changed(session, machine.id)
+    record_sample(session, machine.id, report.cpu_usage, report.memory_usage, report.disk_usage)
+    emit_machine_write(session, machine, created=created)
+
+    # Sections whose fingerprint matches the stored one are skipped entirely
+    to_sync, to_resend = plan_sections(report, machine)
+    if "hardware" in to_sync:
+        machine.hardware_hash = report.hardware_hash
+    if "softwares" in to_sync:
+        # Only insert/update/delete the rows that changed since the last scan
+        sync_softwares(session, machine, report.softwares)
+        machine.softwares_hash = report.softwares_hash
+    if "services" in to_sync:
+        sync_services(session, machine, report.services)
+        machine.services_hash = report.services_hash
+
+    return machine, to_resend
+
+
+def ingest_chunk(session: Session, reports: List[InventoryReport]):
+    """
+    Ingest several reports in one transaction. Each report runs in a
+    savepoint so a bad one does not roll back the rest of the chunk.
+    """
+    results = []
+    for report in reports:
+        samples = len(pending_samples(session))
+        events = len(pending_events(session))
+        try:
+            with session.begin_nested():
+                machine, to_resend = ingest_report(session, report)
+            results.append({"hostname": report.hostname, "status": "ok", "machine_id": machine.id, "resend": to_resend})
+        except Exception as e:
+            discard_pending_ids(session)
+            # Drop the sample and events of the report that was rolled back
+            del pending_samples(session)[samples:]
+            del pending_events(session)[events:]
+            results.append({"hostname": report.hostname, "status": "error", "detail": str(e)})
+    session.commit()
+    # Keep the identity map from growing across chunks
+    session.expunge_all()
+    return results
+
+
+async def iter_ndjson_reports(stream):
+    """
+    Parse an NDJSON byte stream into InventoryReports, one line at a time.
+    Lines that fail to parse or exceed MAX_NDJSON_LINE_BYTES come out as an
+    error result in their place, so results can be kept in input order.
+    """
+    buffer = b""
+    line_no = 0
+    skipping = False # inside an oversized line, dropped up to its newline
+    async for data in stream:
+        if skipping:
+            end = data.find(b"\n")
+            if end < 0:
+                continue
+            data = data[end + 1:]
+            line_no += 1
+            skipping = False
+        buffer += data
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            line_no += 1
+            item = _parse_ndjson_line(line, line_no)
+            if item is not None:
+                yield item
+        if len(buffer) > MAX_NDJSON_LINE_BYTES:
+            # One error for the line, whatever number of chunks it spans
+            yield {"status": "error", "detail": f"line {line_no + 1}: exceeds {MAX_NDJSON_LINE_BYTES} bytes"}
+            buffer = b""
+            skipping = True
+    if buffer.strip() and not skipping:
+        item = _parse_ndjson_line(buffer, line_no + 1)
+        if item is not None:
+            yield item
+
+
+def _parse_ndjson_line(line: bytes, line_no: int):
+    # The report, an error result, or None for a blank line
+    if not line.strip():
+        return None
+    try:
+        return InventoryReport.model_validate(json.loads(line))
+    except ValueError as e:
+        return {"status": "error", "detail": f"line {line_no}: {e}"}
+    try:
+        return InventoryReport.model_validate(json.loads(line))
+    except ValueError as e:
+        results.append({"status": "error", "detail": f"line {line_no}: {e}"})
+        return None
@@ -0,0 +1,206 @@
+import base64
+import json
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
+
+from .models import Machine, MachineSoftware, MachineRead, MachineSummary, Service, SoftwareCatalog, SoftwareRead, ServiceRead
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Sortable columns. Nullable metrics sort as -1 so the keyset stays total
+SORT_COLUMNS = {
+    "id": Machine.id,
+    "hostname": Machine.hostname,
+    "client_code": Machine.client_code,
+    "status": Machine.status,
+    "last_seen": Machine.last_seen,
+    "cpu_usage": func.coalesce(Machine.cpu_usage, -1),
+    "memory_usage": func.coalesce(Machine.memory_usage, -1),
+    "disk_usage": func.coalesce(Machine.disk_usage, -1),
+}
+
+EMBEDDABLE = ("softwares", "services")
+# MachineRead fields stored on the machine row, in MachineRead order
+MACHINE_READ_COLUMNS = [field for field in MachineRead.model_fields if field not in EMBEDDABLE]
+
+
+def encode_cursor(sort_value, machine_id: int) -> str:
+    if isinstance(sort_value, datetime):
+        sort_value = sort_value.isoformat()
+    raw = json.dumps([sort_value, machine_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        sort_value, machine_id = json.loads(raw)
+        if sort == "last_seen":
+            sort_value = datetime.fromisoformat(sort_value)
+        return sort_value, int(machine_id)
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+
+
+def parse_sort(sort: str):
+    """'hostname' or '-last_seen' -> (column name, descending)."""
+    descending = sort.startswith("-")
+    name = sort.lstrip("-")
+    if name not in SORT_COLUMNS:
+        raise ValueError(f"Invalid sort: {name} (allowed: {', '.join(SORT_COLUMNS)})")
+    return name, descending
+
+
+def parse_embed(embed: Optional[str]) -> List[str]:
+    if not embed:
+        return []
+    collections = [part.strip() for part in embed.split(",") if part.strip()]
+    for collection in collections:
+        if collection not in EMBEDDABLE:
+            raise ValueError(f"Invalid embed: {collection} (allowed: {', '.join(EMBEDDABLE)})")
+    return collections
+
+
+def machine_filters(
+    client_code: Optional[str] = None,
+    status: Optional[str] = None,
+    os_info: Optional[str] = None,
+    hostname: Optional[str] = None,
+    seen_after: Optional[datetime] = None,
+    seen_before: Optional[datetime] = None,
+) -> list:
+    """WHERE conditions shared by the machine list and the exports."""
+    conditions = []
+    if client_code:
+        conditions.append(Machine.client_code == client_code)
+    if status:
+        conditions.append(Machine.status == status)
+    if os_info:
+        conditions.append(Machine.os_info == os_info)
+    if hostname:
+        # Prefix match as a range, so the hostname index is used on every backend
+        conditions += [Machine.hostname >= hostname, Machine.hostname < hostname + "\uffff"]
+    if seen_after:
+        conditions.append(Machine.last_seen >= seen_after)
+    if seen_before:
+        conditions.append(Machine.last_seen < seen_before)
+    return conditions
+
+
+def list_machines(
+    session: Session,
+    client_code: Optional[str] = None,
+    status: Optional[str] = None,
+    os_info: Optional[str] = None,
+    hostname: Optional[str] = None,
+    seen_after: Optional[datetime] = None,
+    seen_before: Optional[datetime] = None,
+    sort: str = "hostname",
+    cursor: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    embed: Optional[str] = None,
+    fast: bool = False,
+):
+    """
+    One page of machines, filtered and keyset-paginated on (sort column, id).
+    Returns (rows, next_cursor). Rows are MachineSummary dicts, or full
+    MachineRead dicts with the requested child collections when embed is set.
+    fast builds the MachineRead dicts from plain rows instead of ORM objects.
+    Raises ValueError on invalid sort, cursor or embed.
+    """
+    sort_name, descending = parse_sort(sort)
+    collections = parse_embed(embed)
+    sort_column = SORT_COLUMNS[sort_name]
+
+    if collections and fast:
+        statement = select(*[getattr(Machine, field) for field in MACHINE_READ_COLUMNS])
+    elif collections:
+        statement = select(Machine)
+        if "softwares" in collections:
+            statement = statement.options(selectinload(Machine.softwares).joinedload(MachineSoftware.catalog))
+        if "services" in collections:
+            statement = statement.options(selectinload(Machine.services))
+    else:
+        # Only the list view columns, no ORM objects or child collections
+        statement = select(*[getattr(Machine, field) for field in MachineSummary.model_fields])
+
+    statement = statement.where(*machine_filters(client_code, status, os_info, hostname, seen_after, seen_before))
+
+    if cursor:
+        sort_value, last_id = decode_cursor(cursor, sort_name)
+        if descending:
+            statement = statement.where(or_(sort_column < sort_value, and_(sort_column == sort_value, Machine.id < last_id)))
+        else:
+            statement = statement.where(or_(sort_column > sort_value, and_(sort_column == sort_value, Machine.id > last_id)))
+
+    if descending:
+        statement = statement.order_by(sort_column.desc(), Machine.id.desc())
+    else:
+        statement = statement.order_by(sort_column, Machine.id)
+    statement = statement.add_columns(sort_column.label("sort_value")).limit(limit + 1)
+
+    rows = session.execute(statement).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last.sort_value, last[0].id if collections and not fast else last.id)
+
+    if collections and fast:
+        items = [{field: row._mapping[field] for field in MACHINE_READ_COLUMNS} for row in rows]
+        attach_collections(session, items, collections)
+    elif collections:
+        excluded = {collection for collection in EMBEDDABLE if collection not in collections}
+        items = [MachineRead.model_validate(row[0]).model_dump(exclude=excluded) for row in rows]
+    else:
+        items = [{field: row._mapping[field] for field in MachineSummary.model_fields} for row in rows]
+    return items, next_cursor
+
+
+def attach_collections(session: Session, items: List[dict], collections: List[str]):
+    """
+    Add the SoftwareRead/ServiceRead dicts of each machine dict, one query
+    per collection for the whole page. Children are ordered by id.
+    """
+    by_id = {item["id"]: item for item in items}
+    for collection in EMBEDDABLE:
+        if collection not in collections:
+            continue
+        for item in items:
+            item[collection] = []
+        if not by_id:
+            continue
+        if collection == "softwares":
+            statement = (
+                select(MachineSoftware.machine_id, MachineSoftware.id, SoftwareCatalog.name, SoftwareCatalog.version, SoftwareCatalog.publisher)
+                .join(SoftwareCatalog, SoftwareCatalog.id == MachineSoftware.catalog_id)
+                .where(MachineSoftware.machine_id.in_(by_id))
+                .order_by(MachineSoftware.machine_id, MachineSoftware.id)
+            )
+            fields = list(SoftwareRead.model_fields)
+        else:
+            statement = (
+                select(Service.machine_id, *[getattr(Service, field) for field in ServiceRead.model_fields])
+                .where(Service.machine_id.in_(by_id))
+                .order_by(Service.machine_id, Service.id)
+            )
+            fields = list(ServiceRead.model_fields)
+        for row in session.execute(statement):
+            by_id[row[0]][collection].append(dict(zip(fields, row[1:])))
+
+
+def machine_detail(session: Session, machine_id: int) -> Optional[dict]:
+    """MachineRead of one machine as a plain dict, without ORM objects."""
+    row = session.execute(
+        select(*[getattr(Machine, field) for field in MACHINE_READ_COLUMNS]).where(Machine.id == machine_id)
+    ).first()
+    if row is None:
+        return None
+    item = dict(row._mapping)
+    attach_collections(session, [item], EMBEDDABLE)
+    return item
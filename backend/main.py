@@ -1,13 +1,35 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, APIRouter, Depends, HTTPException, Header, Response, Request, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from sqlmodel import Session, select, SQLModel
-from typing import List
-from datetime import datetime, timedelta
+from sqlmodel import Field, Session, select, SQLModel
+from typing import Annotated, List, Optional
+from datetime import datetime, timedelta, timezone
+import time
 
-from .database import create_db_and_tables, get_session
+from .database import create_db_and_tables, get_session, get_session_factory, engine
 from sqlalchemy.orm import selectinload
-from .models import Machine, Software, Service, InventoryReport, MachineRead
+from .models import Machine, MachineSoftware, InventoryReport, MachineRead, MachineSummary, Heartbeat, MetricSeries, SoftwareSearchResult
+from .inventory import ingest_report, ingest_chunk, iter_ndjson_reports, check_queued_report, apply_heartbeat, compute_alert, BATCH_CHUNK_SIZE, MAX_BATCH_CHUNK_SIZE
+from .ingest_queue import IngestQueue, WRITE_BEHIND_ENABLED
+from .encoding import DecodingRoute, iter_decoded_stream
+from .metrics import metrics_buffer, query_metrics, flush_metrics, rollup_metrics, METRICS_FLUSH_SECONDS, METRICS_ROLLUP_SECONDS
+from .scheduler import Scheduler
+from .catalog import search_software
+from .machines import list_machines, machine_detail, machine_filters, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from .export import iter_inventory_csv, iter_inventory_ndjson
+from .stats import read_cached_stats
+from .changes import current_change_seq, ensure_fleet_state, make_etag, not_modified
+from .events import broker, emit, event_filter, iter_sse
+from .offline import sweep_offline_machines, OFFLINE_SWEEP_SECONDS
+from .responses import FastJSONResponse, FAST_JSON_RESPONSES
+from .identity import issue_agent_token, verify_agent_token, hostname_cache, AGENT_TOKEN_HEADER
+from .commands import queue_command, wait_for_commands, requeue_expired_commands, request_cancel
+from .commands import COMMAND_WAIT_MAX_SECONDS, COMMAND_LEASE_SWEEP_SECONDS, COMMAND_CLAIM_LIMIT
+from .commands import create_job, job_progress, job_commands, iter_job_progress, wait_for_result
+from .commands import append_output, store_result_output, with_streamed_output, wait_for_output, COMMAND_OUTPUT_CHUNK_MAX_BYTES, COMMAND_OUTPUT_MAX_BYTES
 
 app = FastAPI(title="IT Inventory System", version="1.0.0")
 
@@ -24,123 +46,284 @@ app.add_middleware(
 def on_startup():
     create_db_and_tables()
 
-@app.post("/api/inventory", response_model=Machine)
-def create_inventory(report: InventoryReport, session: Session = Depends(get_session)):
-    # Check if machine exists
-    statement = select(Machine).where(Machine.hostname == report.hostname)
-    existing_machine = session.exec(statement).first()
-
-    if existing_machine:
-        machine = existing_machine
-        machine.client_code = report.client_code or "DEFAULT"
-        machine.ip_address = report.ip_address
-        machine.os_info = report.os_info
-        machine.processor = report.processor
-        machine.ram_gb = report.ram_gb
-        machine.disk_gb = report.disk_gb
-        machine.manufacturer = report.manufacturer
-        machine.model = report.model
-        machine.serial_number = report.serial_number
-        machine.last_seen = datetime.utcnow()
-        
-        # Update metrics
-        machine.cpu_usage = report.cpu_usage
-        machine.memory_usage = report.memory_usage
-        machine.disk_usage = report.disk_usage
-        
-        # Alert Logic
-        machine.status = "online"
-        machine.alert_message = None
-        
-        if report.disk_usage and report.disk_usage > 90:
-            machine.status = "critical"
-            machine.alert_message = "Storage Critical (>90%)"
-        elif report.memory_usage and report.memory_usage > 90:
-            machine.status = "warning"
-            machine.alert_message = "High Memory Usage (>90%)"
-            
-        # Remove old software to replace with new scan (simple approach)
-        for software in machine.softwares:
-            session.delete(software)
-        # Remove old services
-        for service in machine.services:
-            session.delete(service)
-    else:
-        # Initial Alert Logic for new machine
-        status = "online"
-        alert_msg = None
-        if report.disk_usage and report.disk_usage > 90:
-            status = "critical"
-            alert_msg = "Storage Critical (>90%)"
-        elif report.memory_usage and report.memory_usage > 90:
-            status = "warning"
-            alert_msg = "High Memory Usage (>90%)"
-            
-        machine = Machine(
-            hostname=report.hostname,
-            client_code=report.client_code or "DEFAULT",
-            ip_address=report.ip_address,
-            os_info=report.os_info,
-            processor=report.processor,
-            ram_gb=report.ram_gb,
-            disk_gb=report.disk_gb,
-            manufacturer=report.manufacturer,
-            model=report.model,
-            serial_number=report.serial_number,
-            last_seen=datetime.utcnow(),
-            cpu_usage=report.cpu_usage,
-            memory_usage=report.memory_usage,
-            disk_usage=report.disk_usage,
-            status=status,
-            alert_message=alert_msg
-        )
-        session.add(machine)
-    
-    session.commit()
-    session.refresh(machine)
-
-    # Add softwares
-    if report.softwares:
-        for soft_data in report.softwares:
-            software = Software(
-                name=soft_data.get("name"),
-                version=soft_data.get("version"),
-                publisher=soft_data.get("publisher"),
-                machine_id=machine.id
-            )
-            session.add(software)
-    
-    # Add services
-    if report.services:
-        for svc_data in report.services:
-            service = Service(
-                name=svc_data.get("name"),
-                display_name=svc_data.get("display_name"),
-                status=svc_data.get("status"),
-                start_type=svc_data.get("start_type"),
-                machine_id=machine.id
-            )
-            session.add(service)
-    
+@app.on_event("startup")
+def create_fleet_state():
+    with Session(engine) as session:
+        ensure_fleet_state(session)
+
+ingest_queue = IngestQueue(lambda: Session(engine))
+
+# Agent upload endpoints accept gzip/deflate/zstd and MessagePack bodies
+ingest_router = APIRouter(route_class=DecodingRoute)
+
+@app.on_event("startup")
+def start_ingest_queue():
+    if WRITE_BEHIND_ENABLED:
+        ingest_queue.start()
+
+@app.on_event("shutdown")
+def stop_ingest_queue():
+    if WRITE_BEHIND_ENABLED:
+        ingest_queue.stop()
+
+# Periodic background jobs (metrics flush and rollups, offline detection, command leases)
+scheduler = Scheduler()
+scheduler.add("metrics_flush", METRICS_FLUSH_SECONDS, lambda: flush_metrics(lambda: Session(engine)))
+scheduler.add("metrics_rollup", METRICS_ROLLUP_SECONDS, lambda: rollup_metrics(lambda: Session(engine)))
+scheduler.add("offline_sweep", OFFLINE_SWEEP_SECONDS, lambda: sweep_offline_machines(lambda: Session(engine)))
+scheduler.add("command_leases", COMMAND_LEASE_SWEEP_SECONDS, lambda: requeue_expired_commands(lambda: Session(engine)))
+
+@app.on_event("startup")
+def start_event_broker():
+    broker.start()
+
+@app.on_event("shutdown")
+def stop_event_broker():
+    broker.stop()
+
+@app.on_event("startup")
+def start_scheduler():
+    scheduler.start()
+
+@app.on_event("shutdown")
+def stop_scheduler():
+    scheduler.stop()
+    # Samples still buffered in this process
+    flush_metrics(lambda: Session(engine))
+
+@ingest_router.post("/api/inventory", response_model=Machine)
+def create_inventory(
+    report: InventoryReport,
+    response: Response,
+    session: Session = Depends(get_session)
+):
+    if WRITE_BEHIND_ENABLED:
+        return enqueue_inventory(report, session)
+
+    # The response is built from the in-memory machine, no refresh round trip after commit
+    session.expire_on_commit = False
+
+    machine, to_resend = ingest_report(session, report)
     session.commit()
-    session.refresh(machine)
+    if to_resend:
+        # Agent only sent fingerprints we don't have, ask for the full sections
+        response.headers["X-Inventory-Resend"] = ",".join(to_resend)
+    # The agent sends it back on heartbeats and polls: its machine is then found by primary key
+    response.headers[AGENT_TOKEN_HEADER] = issue_agent_token(machine.id)
     return machine
 
-@app.get("/api/machines", response_model=List[MachineRead])
-def read_machines(session: Session = Depends(get_session)):
-    # Eager load for CSV export support
-    query = select(Machine).options(
-        selectinload(Machine.softwares),
-        selectinload(Machine.services)
+def enqueue_inventory(report: InventoryReport, session: Session):
+    queued = ingest_queue.put(report)
+    if queued is None:
+        raise HTTPException(
+            status_code=429,
+            detail="Inventory queue is full",
+            headers={"Retry-After": str(ingest_queue.retry_after())}
+        )
+    headers = {}
+    # Read-only look at the stored machine: its hashes and, once registered, its token
+    machine_id, to_resend = check_queued_report(session, queued)
+    if to_resend:
+        headers["X-Inventory-Resend"] = ",".join(to_resend)
+    if machine_id is not None:
+        headers[AGENT_TOKEN_HEADER] = issue_agent_token(machine_id)
+    return JSONResponse(
+        status_code=202,
+        content={"status": "queued", "hostname": report.hostname, "queue_depth": ingest_queue.stats()["depth"]},
+        headers=headers
+    )
+
+@app.get("/api/inventory/queue")
+def read_ingest_queue_stats():
+    return {"enabled": WRITE_BEHIND_ENABLED, **ingest_queue.stats()}
+
+class BatchResult(SQLModel):
+    hostname: Optional[str] = None
+    status: str # ok, error
+    machine_id: Optional[int] = None
+    resend: List[str] = []
+    detail: Optional[str] = None
+
+@ingest_router.post("/api/inventory/batch", response_model=List[BatchResult])
+def create_inventory_batch(
+    reports: List[InventoryReport],
+    chunk_size: Optional[int] = Query(None, ge=1, le=MAX_BATCH_CHUNK_SIZE),
+    session: Session = Depends(get_session)
+):
+    # Relay agents post many machines at once, committed in chunks
+    session.expire_on_commit = False
+    size = chunk_size or BATCH_CHUNK_SIZE
+    results = []
+    for i in range(0, len(reports), size):
+        results.extend(ingest_chunk(session, reports[i:i + size]))
+    return results
+
+@app.post("/api/inventory/stream", response_model=List[BatchResult])
+async def create_inventory_stream(
+    request: Request,
+    chunk_size: Optional[int] = Query(None, ge=1, le=MAX_BATCH_CHUNK_SIZE),
+    session: Session = Depends(get_session)
+):
+    # NDJSON body (one InventoryReport per line), parsed and committed incrementally
+    session.expire_on_commit = False
+    size = chunk_size or BATCH_CHUNK_SIZE
+    results = []
+    # Reports of the current chunk and their place in results (bad lines are answered in order)
+    chunk, slots = [], []
+
+    async def ingest_pending():
+        for slot, result in zip(slots, await run_in_threadpool(ingest_chunk, session, chunk)):
+            results[slot] = result
+        chunk.clear()
+        slots.clear()
+
+    async for item in iter_ndjson_reports(iter_decoded_stream(request)):
+        if not isinstance(item, InventoryReport):
+            results.append(item)
+            continue
+        slots.append(len(results))
+        results.append(None)
+        chunk.append(item)
+        if len(chunk) >= size:
+            await ingest_pending()
+    if chunk:
+        await ingest_pending()
+    return results
+
+@ingest_router.post("/api/heartbeat")
+def heartbeat_by_hostname(
+    heartbeat: Heartbeat,
+    response: Response,
+    session: Session = Depends(get_session),
+    x_agent_token: Annotated[Optional[str], Header()] = None
+):
+    if not heartbeat.hostname:
+        raise HTTPException(status_code=400, detail="hostname is required")
+    return record_heartbeat(session, heartbeat, response=response, known_id=verify_agent_token(x_agent_token))
+
+@ingest_router.post("/api/machines/{machine_id}/heartbeat")
+def heartbeat_by_id(machine_id: int, heartbeat: Heartbeat, session: Session = Depends(get_session)):
+    return record_heartbeat(session, heartbeat, machine_id)
+
+def record_heartbeat(
+    session: Session,
+    heartbeat: Heartbeat,
+    machine_id: Optional[int] = None,
+    response: Optional[Response] = None,
+    known_id: Optional[int] = None
+):
+    machine_ids = apply_heartbeat(session, heartbeat, machine_id, known_id)
+    if not machine_ids:
+        # Unknown machine: the agent should send a full inventory
+        raise HTTPException(status_code=404, detail="Machine not found")
+    session.commit()
+    if response is not None:
+        # Refreshed on every heartbeat: an agent whose machine was merged gets the new id
+        response.headers[AGENT_TOKEN_HEADER] = issue_agent_token(min(machine_ids))
+    status, _ = compute_alert(heartbeat.disk_usage, heartbeat.memory_usage)
+    return {"status": status}
+
+app.include_router(ingest_router)
+
+@app.get("/api/machines", response_model=List[MachineSummary])
+def read_machines(
+    request: Request,
+    response: Response,
+    client_code: Optional[str] = None,
+    status: Optional[str] = None,
+    os_info: Optional[str] = Query(None, alias="os"),
+    hostname: Optional[str] = Query(None, description="Hostname prefix"),
+    seen_after: Optional[datetime] = None,
+    seen_before: Optional[datetime] = None,
+    sort: str = Query("hostname", description="Column to sort by, '-' prefix for descending"),
+    cursor: Optional[str] = None,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    embed: Optional[str] = Query(None, description="softwares,services: return the full machines (heavy)"),
+    session: Session = Depends(get_session)
+):
+    # Read the sequence before the rows: a write committed in between only makes the ETag stale-new, never stale-old
+    etag = make_etag("machines", current_change_seq(session), request.url.query)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    try:
+        items, next_cursor = list_machines(
+            session, client_code, status, os_info, hostname, seen_after, seen_before, sort, cursor, limit, embed,
+            fast=FAST_JSON_RESPONSES
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+        headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    if FAST_JSON_RESPONSES:
+        # Plain dicts already in the response shape, no per-row validation
+        return FastJSONResponse(items, headers=headers)
+    if embed:
+        # Full MachineRead objects, serialized as-is
+        return JSONResponse(content=jsonable_encoder(items), headers=headers)
+    response.headers.update(headers)
+    return items
+
+@app.get("/api/export/inventory.{fmt}")
+def export_inventory(
+    fmt: str,
+    client_code: Optional[str] = None,
+    status: Optional[str] = None,
+    os_info: Optional[str] = Query(None, alias="os"),
+    hostname: Optional[str] = Query(None, description="Hostname prefix"),
+    seen_after: Optional[datetime] = None,
+    seen_before: Optional[datetime] = None
+):
+    # Streamed straight from the database cursor, the export is never held in memory.
+    # The generators open their own session: it has to outlive this function.
+    conditions = machine_filters(client_code, status, os_info, hostname, seen_after, seen_before)
+    filename = f"full_inventory_{datetime.utcnow().date().isoformat()}.{fmt}"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if fmt == "csv":
+        return StreamingResponse(iter_inventory_csv(export_session, conditions), media_type="text/csv; charset=utf-8", headers=headers)
+    if fmt == "ndjson":
+        return StreamingResponse(iter_inventory_ndjson(export_session, conditions), media_type="application/x-ndjson", headers=headers)
+    raise HTTPException(status_code=404, detail="Unknown export format (csv, ndjson)")
+
+def export_session():
+    return Session(engine)
+
+@app.get("/api/events")
+async def stream_events(
+    client_code: Optional[str] = None,
+    types: Optional[str] = Query(None, description="Comma separated event types, e.g. machine.status,command.completed")
+):
+    # Server-Sent Events: machine.created, machine.updated, machine.status, stats.invalidated, command.completed (and resync)
+    subscription = broker.subscribe(event_filter(client_code, types.split(",") if types else None))
+    return StreamingResponse(
+        iter_sse(subscription),
+        media_type="text/event-stream",
+        # No buffering in reverse proxies, events must go out as they happen
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
-    machines = session.exec(query).all()
-    return machines
 
 @app.get("/api/machines/{machine_id}", response_model=MachineRead)
-def read_machine(machine_id: int, session: Session = Depends(get_session)):
+def read_machine(machine_id: int, request: Request, response: Response, session: Session = Depends(get_session)):
+    # Only the version column is read when the client already has this version
+    change_seq = session.execute(select(Machine.change_seq).where(Machine.id == machine_id)).scalar()
+    if change_seq is None:
+        raise HTTPException(status_code=404, detail="Machine not found")
+    etag = make_etag("machine", machine_id, change_seq)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    if FAST_JSON_RESPONSES:
+        detail = machine_detail(session, machine_id)
+        if detail is None:
+            raise HTTPException(status_code=404, detail="Machine not found")
+        return FastJSONResponse(detail, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
     # Eager load softwares and services
     query = select(Machine).where(Machine.id == machine_id).options(
-        selectinload(Machine.softwares),
+        selectinload(Machine.softwares).joinedload(MachineSoftware.catalog),
         selectinload(Machine.services)
     )
     machine = session.exec(query).first()
@@ -149,16 +332,63 @@ def read_machine(machine_id: int, session: Session = Depends(get_session)):
         raise HTTPException(status_code=404, detail="Machine not found")
     return machine
 
+@app.get("/api/machines/{machine_id}/metrics", response_model=MetricSeries)
+def read_machine_metrics(
+    machine_id: int,
+    start: Optional[datetime] = Query(None, alias="from"),
+    end: Optional[datetime] = Query(None, alias="to"),
+    step: Optional[int] = Query(None, ge=1, description="Bucket size in seconds"),
+    session: Session = Depends(get_session)
+):
+    # Naive datetimes are UTC, like last_seen
+    # Exclusive end: include samples recorded this second
+    end_ts = to_epoch(end) if end else int(time.time()) + 1
+    start_ts = to_epoch(start) if start else end_ts - 86400
+    if start_ts >= end_ts:
+        raise HTTPException(status_code=400, detail="'from' must be before 'to'")
+    if not session.get(Machine, machine_id):
+        raise HTTPException(status_code=404, detail="Machine not found")
+    return query_metrics(session, machine_id, start_ts, end_ts, step)
+
+def to_epoch(value: datetime) -> int:
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+@app.get("/api/metrics/buffer")
+def read_metrics_buffer_stats():
+    return {"buffered": len(metrics_buffer), "dropped": metrics_buffer.dropped}
+
+@app.get("/api/software/search", response_model=SoftwareSearchResult)
+def search_software_endpoint(
+    response: Response,
+    q: Optional[str] = Query(None, min_length=1, description="Part of the package name"),
+    publisher: Optional[str] = Query(None, min_length=1),
+    version_lt: Optional[str] = Query(None, min_length=1, description="Only versions older than this one"),
+    cursor: Optional[int] = Query(None, description="next_cursor of the previous page"),
+    limit: int = Query(50, ge=1, le=500),
+    session: Session = Depends(get_session)
+):
+    if not q and not publisher:
+        raise HTTPException(status_code=400, detail="q or publisher is required")
+    result = search_software(session, q, publisher, version_lt, cursor, limit)
+    if result["next_cursor"] is not None:
+        response.headers["X-Next-Cursor"] = str(result["next_cursor"])
+    return result
+
 # --- Command Execution API ---
 
-from .models import Command
+from .models import Command, CommandJob, CommandJobProgress, JobCommandRead
 
 class CommandCreate(SQLModel):
     command: str
 
 class CommandUpdate(SQLModel):
-    output: str
+    output: Optional[str] = None # None when the output was streamed to /output
+    attempt: Optional[int] = None # Command.attempts of the claim, checked when sent
     status: str
+    duration_ms: Optional[int] = None
+    queue_depth: Optional[int] = None
 
 @app.post("/api/machines/{machine_id}/command", response_model=Command)
 def create_command(machine_id: int, cmd_data: CommandCreate, session: Session = Depends(get_session)):
@@ -166,63 +396,197 @@ def create_command(machine_id: int, cmd_data: CommandCreate, session: Session =
     if not machine:
         raise HTTPException(status_code=404, detail="Machine not found")
     
-    cmd = Command(
-        machine_id=machine_id,
-        command=cmd_data.command,
-        status="pending"
-    )
-    session.add(cmd)
-    session.commit()
-    session.refresh(cmd)
-    return cmd
+    return queue_command(session, machine, cmd_data.command)
+
+def set_agent_poll_headers(response: Response, cancels: List[int]):
+    response.headers["X-Command-Wait-Max"] = str(int(COMMAND_WAIT_MAX_SECONDS))
+    if cancels:
+        # Running commands to kill; a header keeps the body readable by older agents
+        response.headers["X-Cancel-Commands"] = ",".join(str(command_id) for command_id in cancels)
 
 @app.get("/api/machines/{machine_id}/commands/pending", response_model=List[Command])
-def get_pending_commands(machine_id: int, session: Session = Depends(get_session)):
-    # Find machine by ID first to ensure it exists (optional but good practice)
-    # Actually, agent knows its hostname usually. Let's assume agent sends hostname query param or just ID if it knows it.
-    # For now, let's use machine_id as agent should know it from initial handshake or config.
-    # UPDATE: Agent currently doesn't store ID. It only knows hostname.
-    # Let's support hostname lookup for pending commands to make it easier for agent.
-    # But for now, we'll implement by ID and see if we need hostname support.
-    
-    statement = select(Command).where(Command.machine_id == machine_id).where(Command.status == "pending")
-    commands = session.exec(statement).all()
+async def get_pending_commands(
+    machine_id: int,
+    response: Response,
+    wait: float = Query(0, ge=0, le=COMMAND_WAIT_MAX_SECONDS, description="Long-poll: seconds to wait for a command"),
+    limit: int = Query(COMMAND_CLAIM_LIMIT, ge=0, description="Commands to claim (free slots of the agent), at most COMMAND_CLAIM_LIMIT"),
+    session_factory = Depends(get_session_factory)
+):
+    # An agent with more free slots than the claim limit gets the limit, not a 422
+    commands, cancels = await wait_for_commands(
+        session_factory, wait, machine_id=machine_id, limit=min(limit, COMMAND_CLAIM_LIMIT)
+    )
+    set_agent_poll_headers(response, cancels)
     return commands
 
 # Alternative endpoint for Agent to poll by Hostname
 @app.get("/api/commands/pending", response_model=List[Command])
-def get_pending_commands_by_hostname(hostname: str, session: Session = Depends(get_session)):
-    statement = select(Machine).where(Machine.hostname == hostname)
-    machine = session.exec(statement).first()
-    if not machine:
-        return []
-    
-    cmd_stmt = select(Command).where(Command.machine_id == machine.id).where(Command.status == "pending")
-    commands = session.exec(cmd_stmt).all()
+async def get_pending_commands_by_hostname(
+    response: Response,
+    hostname: Optional[str] = None,
+    client_code: Optional[str] = None,
+    x_agent_token: Annotated[Optional[str], Header()] = None,
+    wait: float = Query(0, ge=0, le=COMMAND_WAIT_MAX_SECONDS, description="Long-poll: seconds to wait for a command"),
+    limit: int = Query(COMMAND_CLAIM_LIMIT, ge=0, description="Commands to claim (free slots of the agent), at most COMMAND_CLAIM_LIMIT"),
+    session_factory = Depends(get_session_factory)
+):
+    # Agents with a token (or a cached hostname) poll by machine id, no hostname lookup
+    machine_id = verify_agent_token(x_agent_token) or hostname_cache.get(client_code, hostname)
+    if machine_id is None and not hostname:
+        raise HTTPException(status_code=400, detail="hostname or agent token is required")
+    # Agents long-poll: the request returns as soon as a command is queued for the host
+    commands, cancels = await wait_for_commands(
+        session_factory, wait, machine_id=machine_id, hostname=hostname, client_code=client_code,
+        limit=min(limit, COMMAND_CLAIM_LIMIT)
+    )
+    set_agent_poll_headers(response, cancels)
     return commands
 
 @app.post("/api/commands/{command_id}/result", response_model=Command)
 def update_command_result(command_id: int, result: CommandUpdate, session: Session = Depends(get_session)):
-    cmd = session.get(Command, command_id)
+    # Row locked: the lease sweep cannot requeue it between the check and the write
+    cmd = session.get(Command, command_id, with_for_update=True)
     if not cmd:
         raise HTTPException(status_code=404, detail="Command not found")
+    # A late result of an expired attempt must not overwrite a requeued or cancelled command
+    if cmd.status != "running" or (result.attempt is not None and result.attempt != cmd.attempts):
+        raise HTTPException(status_code=409, detail="Command is not running this attempt")
     
-    cmd.output = result.output
+    store_result_output(session, cmd, result.output)
     cmd.status = result.status
+    cmd.duration_ms = result.duration_ms
+    cmd.queue_depth = result.queue_depth
     cmd.executed_at = datetime.utcnow()
+    cmd.lease_expires_at = None
     
     session.add(cmd)
+    machine = session.get(Machine, cmd.machine_id)
+    emit(session, "command.completed", command_id=cmd.id, machine_id=cmd.machine_id, job_id=cmd.job_id,
+         client_code=machine.client_code if machine else None, status=cmd.status)
     session.commit()
     session.refresh(cmd)
-    return cmd
+    return with_streamed_output(session, cmd)
 
 @app.get("/api/commands/{command_id}", response_model=Command)
 def get_command_status(command_id: int, session: Session = Depends(get_session)):
     cmd = session.get(Command, command_id)
     if not cmd:
         raise HTTPException(status_code=404, detail="Command not found")
+    # Streamed output is served from its chunks
+    return with_streamed_output(session, cmd)
+
+@app.get("/api/commands/{command_id}/wait", response_model=Command)
+async def wait_command_result(
+    command_id: int,
+    timeout: float = Query(30, ge=0, le=COMMAND_WAIT_MAX_SECONDS, description="Seconds to wait for completed/error/cancelled"),
+    session_factory = Depends(get_session_factory)
+):
+    # Returns as soon as the agent posts the result, or the command as it is after timeout
+    cmd = await wait_for_result(session_factory, command_id, timeout)
+    if not cmd:
+        raise HTTPException(status_code=404, detail="Command not found")
+    return cmd
+
+@app.post("/api/commands/{command_id}/cancel", response_model=Command)
+def cancel_command(command_id: int, session: Session = Depends(get_session)):
+    cmd = request_cancel(session, command_id)
+    if not cmd:
+        raise HTTPException(status_code=404, detail="Command not found")
+    if cmd.status not in ("cancelled", "running"):
+        raise HTTPException(status_code=409, detail=f"Command already {cmd.status}")
     return cmd
 
+class CommandOutputAppend(SQLModel):
+    attempt: int # Command.attempts of the claim the output belongs to
+    offset: int = Field(ge=0) # bytes of output already sent for this attempt (UTF-8)
+    data: str
+
+@app.post("/api/commands/{command_id}/output")
+def append_command_output(command_id: int, chunk: CommandOutputAppend, session: Session = Depends(get_session)):
+    # Agents stream output while the command runs, the result only carries the status
+    if len(chunk.data.encode("utf-8")) > COMMAND_OUTPUT_CHUNK_MAX_BYTES:
+        raise HTTPException(status_code=413, detail=f"Chunk larger than {COMMAND_OUTPUT_CHUNK_MAX_BYTES} bytes")
+    state = append_output(session, command_id, chunk.attempt, chunk.offset, chunk.data)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Command not found")
+    if not state["accepted"]:
+        raise HTTPException(status_code=409, detail=f"Output offset mismatch, {state['size']} bytes stored for this attempt")
+    return {"size": state["size"], "truncated": state["truncated"]}
+
+@app.get("/api/commands/{command_id}/output")
+async def read_command_output(
+    command_id: int,
+    offset: int = Query(0, ge=0, description="Byte offset to read from (the offset of the previous response)"),
+    wait: float = Query(0, ge=0, le=COMMAND_WAIT_MAX_SECONDS, description="Long-poll: seconds to wait for new output"),
+    limit: int = Query(COMMAND_OUTPUT_CHUNK_MAX_BYTES, ge=1, le=COMMAND_OUTPUT_MAX_BYTES),
+    session_factory = Depends(get_session_factory)
+):
+    # Tail: call again with the returned offset until done
+    output = await wait_for_output(session_factory, command_id, offset, wait, limit)
+    if output is None:
+        raise HTTPException(status_code=404, detail="Command not found")
+    return output
+
+# --- Command jobs (one command, many machines) ---
+
+class CommandJobCreate(SQLModel):
+    command: str
+    # Machine selector, combined with AND; at least one is required
+    client_code: Optional[str] = None
+    status: Optional[str] = None
+    os_info: Optional[str] = None
+    hostname: Optional[str] = None # prefix
+    machine_ids: Optional[List[int]] = None
+
+@app.post("/api/jobs", response_model=CommandJobProgress, status_code=201)
+def create_command_job(job_data: CommandJobCreate, session: Session = Depends(get_session)):
+    selector = job_data.model_dump(exclude={"command"}, exclude_none=True)
+    if not selector:
+        raise HTTPException(status_code=400, detail="A machine selector is required (client_code, status, os_info, hostname or machine_ids)")
+    conditions = machine_filters(job_data.client_code, job_data.status, job_data.os_info, job_data.hostname)
+    if job_data.machine_ids is not None:
+        conditions.append(Machine.id.in_(job_data.machine_ids))
+    # All Command rows are inserted by one INSERT ... SELECT
+    job = create_job(session, job_data.command, conditions, selector)
+    if job is None:
+        raise HTTPException(status_code=404, detail="No machine matches the selector")
+    return job_progress(session, job.id)
+
+@app.get("/api/jobs/{job_id}", response_model=CommandJobProgress)
+def read_command_job(job_id: int, session: Session = Depends(get_session)):
+    progress = job_progress(session, job_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return progress
+
+@app.get("/api/jobs/{job_id}/stream")
+def stream_command_job(job_id: int, session: Session = Depends(get_session), session_factory = Depends(get_session_factory)):
+    # Server-Sent Events: job.progress with the counts, until nothing is pending or running
+    if session.get(CommandJob, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return StreamingResponse(
+        iter_job_progress(session_factory, job_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/api/jobs/{job_id}/commands", response_model=List[JobCommandRead])
+def read_command_job_commands(
+    job_id: int,
+    response: Response,
+    status: Optional[str] = None,
+    cursor: Optional[int] = Query(None, description="X-Next-Cursor of the previous page"),
+    limit: int = Query(100, ge=1, le=1000),
+    session: Session = Depends(get_session)
+):
+    # Outputs are not included, they are read per command from /api/commands/{id}/output
+    if session.get(CommandJob, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    rows, next_cursor = job_commands(session, job_id, status, cursor, limit)
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = str(next_cursor)
+    return rows
+
 class ServiceAction(SQLModel):
     action: str # start, stop, restart
 
@@ -246,30 +610,12 @@ def control_service(machine_id: int, service_name: str, action_data: ServiceActi
         ps_command = f"Restart-Service -Name '{service_name}' -Force"
         
     # Queue Command
-    cmd = Command(
-        machine_id=machine_id,
-        command=ps_command,
-        status="pending"
-    )
-    session.add(cmd)
-    session.commit()
-    session.refresh(cmd)
-    return cmd
+    return queue_command(session, machine, ps_command)
 
 @app.get("/api/stats")
 def read_stats(session: Session = Depends(get_session)):
-    machines = session.exec(select(Machine)).all()
-    total = len(machines)
-    # Basic stats
-    os_counts = {}
-    for m in machines:
-        os = m.os_info or "Unknown"
-        os_counts[os] = os_counts.get(os, 0) + 1
-        
-    return {
-        "total_machines": total,
-        "os_distribution": os_counts
-    }
+    # Computed with GROUP BY queries and shared by every dashboard for STATS_CACHE_TTL_SECONDS
+    return read_cached_stats(session)
 
 # --- Authentication ---
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
@@ -322,11 +668,9 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 async def read_users_me(current_user: User = Depends(get_current_user)):
     return current_user
 
-# Modify startup to create admin user
+# Create the admin user once the tables exist (on_startup above)
 @app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
-    
+def create_default_admin():
     # Create default admin if not exists (handle race condition)
     from .database import engine
     try:
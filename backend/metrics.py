@@ -0,0 +1,267 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+from sqlalchemy import case, delete, event, func, insert, literal_column
+from sqlalchemy.orm import Session as OrmSession
+from sqlmodel import Session, select
+
+from .database import bulk_insert
+from .models import MetricSample, MetricRollup
+from .scheduler import try_leader_lock
+
+# Retention in seconds, 0 keeps a tier forever
+RAW_RETENTION_SECONDS = int(os.environ.get("METRICS_RAW_RETENTION_HOURS", "48")) * 3600
+# Rollup tiers as (bucket size in seconds, retention in seconds), finest first
+TIERS = (
+    (60, int(os.environ.get("METRICS_1M_RETENTION_DAYS", "14")) * 86400),
+    (3600, int(os.environ.get("METRICS_1H_RETENTION_DAYS", "400")) * 86400),
+    (86400, int(os.environ.get("METRICS_1D_RETENTION_DAYS", "0")) * 86400),
+)
+TIER_NAMES = {0: "raw", 60: "1m", 3600: "1h", 86400: "1d"}
+
+# Samples held in memory between flushes (oldest are dropped past this)
+METRICS_BUFFER_SIZE = int(os.environ.get("METRICS_BUFFER_SIZE", "50000"))
+METRICS_FLUSH_SECONDS = float(os.environ.get("METRICS_FLUSH_SECONDS", "10"))
+METRICS_ROLLUP_SECONDS = float(os.environ.get("METRICS_ROLLUP_SECONDS", "60"))
+# Buckets are only rolled up once every worker had time to flush their samples
+ROLLUP_DELAY_SECONDS = max(30, int(METRICS_FLUSH_SECONDS * 3))
+# Default resolution of /api/machines/{id}/metrics and upper bound of points returned
+METRICS_MAX_POINTS = int(os.environ.get("METRICS_MAX_POINTS", "500"))
+
+METRICS = ("cpu", "memory", "disk")
+
+
+class MetricsBuffer:
+    """Committed samples waiting to be written to MetricSample in one batch."""
+
+    def __init__(self, max_size: int = METRICS_BUFFER_SIZE):
+        self._samples = deque(maxlen=max_size)
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._samples)
+
+    def extend(self, samples):
+        with self._lock:
+            overflow = len(self._samples) + len(samples) - self._samples.maxlen
+            if overflow > 0:
+                self.dropped += overflow
+            self._samples.extend(samples)
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+    def flush(self, session: Session) -> int:
+        """Write and commit everything buffered. Returns the number of samples written."""
+        with self._lock:
+            rows = list(self._samples)
+            self._samples.clear()
+        if not rows:
+            return 0
+        try:
+            bulk_insert(session, MetricSample, rows)
+            session.commit()
+        except Exception:
+            # Keep them for the next flush
+            session.rollback()
+            self.extend(rows)
+            raise
+        return len(rows)
+
+
+metrics_buffer = MetricsBuffer()
+
+# Samples recorded inside a transaction only reach the buffer once it commits
+PENDING_KEY = "metric_samples"
+
+
+@event.listens_for(OrmSession, "after_commit")
+def _buffer_pending_samples(session):
+    pending = session.info.pop(PENDING_KEY, None)
+    if pending:
+        metrics_buffer.extend(pending)
+
+
+@event.listens_for(OrmSession, "after_rollback")
+def _discard_pending_samples(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+def pending_samples(session: Session) -> list:
+    return session.info.setdefault(PENDING_KEY, [])
+
+
+def record_sample(session: Session, machine_id: int, cpu: Optional[float], memory: Optional[float], disk: Optional[float]):
+    if cpu is None and memory is None and disk is None:
+        return
+    pending_samples(session).append({
+        "machine_id": machine_id,
+        "ts": int(time.time()),
+        "cpu": cpu,
+        "memory": memory,
+        "disk": disk
+    })
+
+
+def _aggregate(source_step: int, step: int, start: int, end: int, machine_id: Optional[int] = None):
+    """
+    SELECT machine_id, bucket, samples, <metric>_min/_avg/_max over buckets of
+    `step` seconds in [start, end), read from raw samples (source_step 0) or
+    from a rollup tier. Averages of rollups are weighted by their sample count.
+    """
+    if source_step == 0:
+        source = MetricSample
+        time_column = MetricSample.ts
+        columns = [func.count()]
+        for metric in METRICS:
+            column = getattr(MetricSample, metric)
+            columns += [func.min(column), func.avg(column), func.max(column)]
+        conditions = []
+    else:
+        source = MetricRollup
+        time_column = MetricRollup.bucket
+        columns = [func.sum(MetricRollup.samples)]
+        for metric in METRICS:
+            average = getattr(MetricRollup, f"{metric}_avg")
+            weight = case((average.isnot(None), MetricRollup.samples))
+            columns += [
+                func.min(getattr(MetricRollup, f"{metric}_min")),
+                func.sum(average * MetricRollup.samples) / func.sum(weight),
+                func.max(getattr(MetricRollup, f"{metric}_max")),
+            ]
+        conditions = [MetricRollup.step == source_step]
+
+    # Inlined literal: PostgreSQL needs the SELECT and GROUP BY expressions to match exactly
+    bucket = time_column - time_column % literal_column(str(int(step)))
+    conditions += [time_column >= start, time_column < end]
+    if machine_id is not None:
+        conditions.append(source.machine_id == machine_id)
+    return (
+        select(source.machine_id, bucket.label("bucket"), *columns)
+        .where(*conditions)
+        .group_by(source.machine_id, bucket)
+    )
+
+
+AGGREGATE_COLUMNS = ["samples"] + [f"{metric}_{agg}" for metric in METRICS for agg in ("min", "avg", "max")]
+
+
+def rollup(session: Session, now: Optional[int] = None) -> bool:
+    """
+    Aggregate completed buckets of every tier from the tier below it and
+    apply retention. Returns False when another process holds the job.
+    """
+    if not try_leader_lock(session, "metrics_rollup"):
+        return False
+    now = int(now if now is not None else time.time())
+    source_step = 0
+    for step, _ in TIERS:
+        _rollup_tier(session, step, source_step, now - ROLLUP_DELAY_SECONDS)
+        source_step = step
+    _apply_retention(session, now)
+    session.commit()
+    return True
+
+
+def _rollup_tier(session: Session, step: int, source_step: int, now: int):
+    end = now - now % step
+    last = session.execute(select(func.max(MetricRollup.bucket)).where(MetricRollup.step == step)).scalar()
+    if last is not None:
+        # The newest bucket is aggregated again to pick up late samples
+        start = last
+    else:
+        if source_step == 0:
+            first = session.execute(select(func.min(MetricSample.ts))).scalar()
+        else:
+            first = session.execute(select(func.min(MetricRollup.bucket)).where(MetricRollup.step == source_step)).scalar()
+        if first is None:
+            return
+        start = first - first % step
+    if start >= end:
+        return
+
+    session.execute(delete(MetricRollup).where(MetricRollup.step == step, MetricRollup.bucket >= start, MetricRollup.bucket < end))
+    rows = _aggregate(source_step, step, start, end).add_columns(literal_column(str(int(step))))
+    session.execute(insert(MetricRollup).from_select(["machine_id", "bucket"] + AGGREGATE_COLUMNS + ["step"], rows))
+
+
+def _apply_retention(session: Session, now: int):
+    if RAW_RETENTION_SECONDS:
+        session.execute(delete(MetricSample).where(MetricSample.ts < now - RAW_RETENTION_SECONDS))
+    for step, retention in TIERS:
+        if retention:
+            session.execute(delete(MetricRollup).where(MetricRollup.step == step, MetricRollup.bucket < now - retention))
+
+
+def pick_tier(start: int, step: int, now: int) -> int:
+    """
+    Coarsest tier not coarser than step whose retention still covers start.
+    Falls back to the finest tier that covers start.
+    """
+    tiers = [(0, RAW_RETENTION_SECONDS)] + list(TIERS)
+    covering = [tier for tier, retention in tiers if not retention or start >= now - retention]
+    if not covering:
+        return TIERS[-1][0]
+    fitting = [tier for tier in covering if tier <= step]
+    return fitting[-1] if fitting else covering[0]
+
+
+def query_metrics(session: Session, machine_id: int, start: int, end: int, step: Optional[int] = None, now: Optional[int] = None) -> dict:
+    """Metrics of a machine over [start, end), aggregated into buckets of step seconds."""
+    now = int(now if now is not None else time.time())
+    # Never return more than METRICS_MAX_POINTS points
+    step = max(step or 1, math.ceil((end - start) / METRICS_MAX_POINTS))
+    tier = pick_tier(start, step, now)
+    if tier:
+        step = math.ceil(step / tier) * tier
+    start -= start % step
+
+    rows = session.execute(_aggregate(tier, step, start, end, machine_id)).all()
+    if tier:
+        # Samples newer than the last rolled up bucket are read raw so charts stay current
+        last = session.execute(
+            select(func.max(MetricRollup.bucket)).where(MetricRollup.step == tier, MetricRollup.machine_id == machine_id)
+        ).scalar()
+        tail_start = max(start, last + tier if last is not None else start)
+        if tail_start < end:
+            rows += session.execute(_aggregate(0, step, tail_start, end, machine_id)).all()
+
+    points = {}
+    for row in rows:
+        point = dict(zip(AGGREGATE_COLUMNS, row[2:]))
+        ts = row.bucket
+        points[ts] = _merge_points(points[ts], point) if ts in points else point
+    return {
+        "machine_id": machine_id, "tier": TIER_NAMES[tier], "step": step, "start": start, "end": end,
+        "points": [{"ts": ts, **points[ts]} for ts in sorted(points)]
+    }
+
+
+def _merge_points(a: dict, b: dict) -> dict:
+    # Bucket split between a rollup tier and raw samples
+    merged = {"samples": a["samples"] + b["samples"]}
+    for metric in METRICS:
+        lows = [p[f"{metric}_min"] for p in (a, b) if p[f"{metric}_min"] is not None]
+        highs = [p[f"{metric}_max"] for p in (a, b) if p[f"{metric}_max"] is not None]
+        weighted = [(p[f"{metric}_avg"], p["samples"]) for p in (a, b) if p[f"{metric}_avg"] is not None]
+        merged[f"{metric}_min"] = min(lows) if lows else None
+        merged[f"{metric}_max"] = max(highs) if highs else None
+        total = sum(count for _, count in weighted)
+        merged[f"{metric}_avg"] = sum(avg * count for avg, count in weighted) / total if total else None
+    return merged
+
+
+def flush_metrics(session_factory):
+    with session_factory() as session:
+        metrics_buffer.flush(session)
+
+
+def rollup_metrics(session_factory):
+    with session_factory() as session:
+        rollup(session)
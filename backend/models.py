@@ -1,25 +1,56 @@
 from typing import Optional, List
 from sqlmodel import Field, SQLModel, Relationship
+from sqlalchemy import Index, String, UniqueConstraint, text
 from datetime import datetime
 
-class Software(SQLModel, table=True):
+class SoftwareCatalog(SQLModel, table=True):
+    # One row per distinct (name, version, publisher) across the fleet
+    __table_args__ = (UniqueConstraint("name", "version", "publisher", name="uq_softwarecatalog_entry"),)
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    name: str
+    name: str = Field(index=True)
     version: Optional[str] = None
     publisher: Optional[str] = None
-    machine_id: Optional[int] = Field(default=None, foreign_key="machine.id")
+    # version_sort_key(version): sorts byte by byte like the version, so "older than" runs in SQL
+    version_sort: Optional[str] = Field(default=None, index=True, sa_type=String().with_variant(String(collation="C"), "postgresql"))
+
+class MachineSoftware(SQLModel, table=True):
+    # Slim machine <-> catalog link (software installed on a machine)
+    __table_args__ = (
+        UniqueConstraint("machine_id", "catalog_id", name="uq_machinesoftware_machine_catalog"),
+        # "Which machines run X" is an index range scan
+        Index("ix_machinesoftware_catalog_machine", "catalog_id", "machine_id"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    machine_id: int = Field(foreign_key="machine.id")
+    catalog_id: int = Field(foreign_key="softwarecatalog.id")
     machine: Optional["Machine"] = Relationship(back_populates="softwares")
+    catalog: Optional[SoftwareCatalog] = Relationship()
+
+    # Read through to the catalog entry so SoftwareRead keeps its shape
+    @property
+    def name(self) -> str:
+        return self.catalog.name
+
+    @property
+    def version(self) -> Optional[str]:
+        return self.catalog.version
+
+    @property
+    def publisher(self) -> Optional[str]:
+        return self.catalog.publisher
 
 
 
 class InventoryReport(SQLModel):
     hostname: str
     client_code: Optional[str] = "DEFAULT"
-    ip_address: Optional[str]
-    os_info: Optional[str]
-    processor: Optional[str]
-    ram_gb: Optional[float]
-    disk_gb: Optional[float]
+    ip_address: Optional[str] = None
+    os_info: Optional[str] = None
+    processor: Optional[str] = None
+    ram_gb: Optional[float] = None
+    disk_gb: Optional[float] = None
     manufacturer: Optional[str] = None
     model: Optional[str] = None
     serial_number: Optional[str] = None
@@ -29,8 +60,24 @@ class InventoryReport(SQLModel):
     memory_usage: Optional[float] = None
     disk_usage: Optional[float] = None
     
-    softwares: List[dict] = []
-    services: List[dict] = []
+    # Sections are omitted (None) when their fingerprint did not change
+    softwares: Optional[List[dict]] = None
+    services: Optional[List[dict]] = None
+
+    # Content fingerprints computed by the agent
+    hardware_hash: Optional[str] = None
+    softwares_hash: Optional[str] = None
+    services_hash: Optional[str] = None
+
+
+class Heartbeat(SQLModel):
+    # Metrics-only report sent between full inventories
+    hostname: Optional[str] = None
+    # Part of the machine identity with hostname, "DEFAULT" when not sent
+    client_code: Optional[str] = None
+    cpu_usage: Optional[float] = None
+    memory_usage: Optional[float] = None
+    disk_usage: Optional[float] = None
 
 
 
@@ -40,6 +87,27 @@ class SoftwareRead(SQLModel):
     version: Optional[str] = None
     publisher: Optional[str] = None
 
+class SoftwareMatch(SQLModel):
+    name: str
+    version: Optional[str] = None
+    publisher: Optional[str] = None
+
+class SoftwareVersionCount(SoftwareMatch):
+    machines: int
+
+class SoftwareSearchHit(SQLModel):
+    id: int
+    hostname: str
+    client_code: str
+    status: str
+    last_seen: datetime
+    matches: List[SoftwareMatch] = []
+
+class SoftwareSearchResult(SQLModel):
+    machines: List[SoftwareSearchHit] = []
+    versions: List[SoftwareVersionCount] = []
+    next_cursor: Optional[int] = None
+
 class ServiceRead(SQLModel):
     id: int
     name: str
@@ -49,7 +117,7 @@ class ServiceRead(SQLModel):
 
 class MachineBase(SQLModel):
     hostname: str = Field(index=True)
-    client_code: str = Field(default="DEFAULT", index=True)
+    client_code: str = Field(default="DEFAULT")
     ip_address: Optional[str] = None
     os_info: Optional[str] = None
     processor: Optional[str] = None
@@ -67,17 +135,81 @@ class MachineBase(SQLModel):
     status: str = "online"
     alert_message: Optional[str] = None
 
+class CommandJob(SQLModel, table=True):
+    # One command sent to many machines, each gets its own Command row
+    id: Optional[int] = Field(default=None, primary_key=True)
+    command: str
+    selector: str # JSON of the machine selector used
+    total: int = 0
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+
 class Command(SQLModel, table=True):
+    __table_args__ = (
+        # Agent poll: the pending commands of one machine, whatever the history size
+        Index("ix_command_machine_id_status", "machine_id", "status", "id"),
+        # Lease sweeper: running commands past their expiry
+        Index("ix_command_status_lease_expires_at", "status", "lease_expires_at"),
+        # Job progress counts and per-job listing
+        Index("ix_command_job_id_status", "job_id", "status", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     machine_id: int = Field(foreign_key="machine.id")
+    job_id: Optional[int] = Field(default=None, foreign_key="commandjob.id")
     command: str
     output: Optional[str] = None
-    status: str = "pending" # pending, running, completed, error
+    status: str = "pending" # pending, running, completed, error, cancelled
     created_at: datetime = Field(default_factory=datetime.utcnow)
     executed_at: Optional[datetime] = None
+    # Reported by the agent with the result: run time, and commands still waiting for a worker
+    duration_ms: Optional[int] = None
+    queue_depth: Optional[int] = None
+
+    # Set when an agent claims the command; re-queued if no result arrives before it expires
+    lease_expires_at: Optional[datetime] = None
+    attempts: int = 0
+    max_attempts: int = 3
+    # Set on a running command, the agent kills it on its next poll
+    cancel_requested: bool = False
+
+    # Streamed output of the current attempt: bytes stored in CommandOutputChunk, capped
+    output_size: int = 0
+    output_truncated: bool = False
     
     machine: Optional["Machine"] = Relationship(back_populates="commands")
 
+class CommandOutputChunk(SQLModel, table=True):
+    # Output appended by the agent while a command runs, read back in start order
+    __table_args__ = (UniqueConstraint("command_id", "attempt", "start", name="uq_commandoutputchunk_command_attempt_start"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    command_id: int = Field(foreign_key="command.id")
+    attempt: int
+    start: int # byte offset of data in the attempt's output (UTF-8)
+    size: int # bytes of data (UTF-8)
+    data: str
+
+class CommandJobProgress(SQLModel):
+    id: int
+    command: str
+    created_at: datetime
+    total: int
+    pending: int = 0
+    running: int = 0
+    completed: int = 0
+    error: int = 0
+    cancelled: int = 0
+    done: bool = False
+
+class JobCommandRead(SQLModel):
+    # Per-machine line of a job, the output is read from /api/commands/{id}/output
+    id: int
+    machine_id: int
+    hostname: Optional[str] = None
+    status: str
+    attempts: int
+    executed_at: Optional[datetime] = None
+
 class User(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     username: str = Field(index=True, unique=True)
@@ -85,6 +217,21 @@ class User(SQLModel, table=True):
     role: str = "admin"
 
 class Machine(MachineBase, table=True):
+    # Listing filters + keyset sort order, see backend/machines.py
+    __table_args__ = (
+        # Machine identity: the ON CONFLICT target of the ingest upsert, see backend/inventory.py.
+        # Also the client_code filter + hostname sort (unique, so no id needed)
+        Index("uq_machine_client_code_hostname", "client_code", "hostname", unique=True),
+        Index("ix_machine_status_hostname", "status", "hostname", "id"),
+        Index("ix_machine_os_info_hostname", "os_info", "hostname", "id"),
+        Index("ix_machine_last_seen_id", "last_seen", "id"),
+        # Offline sweeper: only the machines that can still go offline, see backend/offline.py
+        Index(
+            "ix_machine_last_seen_not_offline", "last_seen",
+            postgresql_where=text("status <> 'offline'"), sqlite_where=text("status <> 'offline'")
+        ),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     
     # Real-time metrics
@@ -93,21 +240,97 @@ class Machine(MachineBase, table=True):
     disk_usage: Optional[float] = None
     status: str = "online" # online, warning, critical, offline
     alert_message: Optional[str] = None
+    # Status before the last write, set in the same UPDATE (status transitions, see backend/events.py)
+    previous_status: Optional[str] = None
+
+    # FleetState.change_seq of the last write to this machine (ETag of the detail view)
+    change_seq: int = 0
+
+    # Fingerprints of the last accepted inventory sections
+    hardware_hash: Optional[str] = None
+    softwares_hash: Optional[str] = None
+    services_hash: Optional[str] = None
     
-    softwares: List["Software"] = Relationship(back_populates="machine")
+    softwares: List["MachineSoftware"] = Relationship(back_populates="machine")
     services: List["Service"] = Relationship(back_populates="machine")
     commands: List["Command"] = Relationship(back_populates="machine")
 
+class MachineSummary(SQLModel):
+    # List view projection, without child collections
+    id: int
+    hostname: str
+    client_code: str
+    ip_address: Optional[str] = None
+    os_info: Optional[str] = None
+    last_seen: datetime
+    cpu_usage: Optional[float] = None
+    memory_usage: Optional[float] = None
+    disk_usage: Optional[float] = None
+    status: str
+    alert_message: Optional[str] = None
+
 class MachineRead(MachineBase):
     id: int
     softwares: List[SoftwareRead] = []
     services: List[ServiceRead] = []
 
+class FleetState(SQLModel, table=True):
+    # Single row: fleet-wide change sequence, bumped by every transaction that writes machines
+    id: Optional[int] = Field(default=None, primary_key=True)
+    change_seq: int = 0
+
+class MetricSample(SQLModel, table=True):
+    # Append-only raw metrics, one narrow row per report/heartbeat
+    __table_args__ = (Index("ix_metricsample_machine_ts", "machine_id", "ts"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    machine_id: int = Field(foreign_key="machine.id")
+    ts: int = Field(index=True) # epoch seconds (UTC)
+    cpu: Optional[float] = None
+    memory: Optional[float] = None
+    disk: Optional[float] = None
+
+class MetricAggregates(SQLModel):
+    samples: int = 0
+    cpu_min: Optional[float] = None
+    cpu_avg: Optional[float] = None
+    cpu_max: Optional[float] = None
+    memory_min: Optional[float] = None
+    memory_avg: Optional[float] = None
+    memory_max: Optional[float] = None
+    disk_min: Optional[float] = None
+    disk_avg: Optional[float] = None
+    disk_max: Optional[float] = None
+
+class MetricRollup(MetricAggregates, table=True):
+    # min/avg/max of a machine over one bucket; step is the bucket size in seconds (60, 3600, 86400)
+    __table_args__ = (
+        UniqueConstraint("step", "machine_id", "bucket", name="uq_metricrollup_bucket"),
+        Index("ix_metricrollup_step_bucket", "step", "bucket"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    step: int
+    machine_id: int = Field(foreign_key="machine.id")
+    bucket: int # bucket start, epoch seconds
+
+class MetricPoint(MetricAggregates):
+    ts: int
+
+class MetricSeries(SQLModel):
+    machine_id: int
+    tier: str # raw, 1m, 1h, 1d
+    step: int
+    start: int
+    end: int
+    points: List[MetricPoint] = []
+
 class Service(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
     display_name: Optional[str] = None
     status: str
     start_type: Optional[str] = None
-    machine_id: Optional[int] = Field(default=None, foreign_key="machine.id")
+    # Every ingest reads and reconciles the services of one machine
+    machine_id: Optional[int] = Field(default=None, foreign_key="machine.id", index=True)
     machine: Optional["Machine"] = Relationship(back_populates="services")
@@ -0,0 +1,53 @@
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from sqlalchemy import literal_column, update
+from sqlmodel import Session, select
+
+from .changes import mark_changed
+from .events import emit_machine_write, MACHINE_EVENT_COLUMNS
+from .models import Machine
+from .scheduler import try_leader_lock
+from .stats import mark_stats_dirty
+
+# A machine without report or heartbeat for this long is marked offline
+OFFLINE_AFTER_SECONDS = int(os.environ.get("OFFLINE_AFTER_SECONDS", "300"))
+OFFLINE_SWEEP_SECONDS = float(os.environ.get("OFFLINE_SWEEP_SECONDS", "30"))
+# Machines flipped per transaction, the job loops until none are left
+OFFLINE_SWEEP_BATCH_SIZE = int(os.environ.get("OFFLINE_SWEEP_BATCH_SIZE", "1000"))
+
+
+def sweep_offline(session: Session, now: Optional[datetime] = None, limit: int = OFFLINE_SWEEP_BATCH_SIZE) -> List[int]:
+    """
+    Mark machines not seen for OFFLINE_AFTER_SECONDS as offline, in one UPDATE.
+    Only machines that are not offline yet are visited (partial index
+    ix_machine_last_seen_not_offline), so the cost follows the number of
+    transitions, not the fleet size. Returns the ids of the machines flipped,
+    nothing when another process holds the job.
+    """
+    if not try_leader_lock(session, "offline_sweep"):
+        return []
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=OFFLINE_AFTER_SECONDS)
+    # Literal, not a bound parameter, so the predicate matches the partial index
+    stale = (Machine.status != literal_column("'offline'"), Machine.last_seen < cutoff)
+    candidates = select(Machine.id).where(*stale).order_by(Machine.last_seen).limit(limit)
+    rows = session.execute(
+        # Conditions repeated on the UPDATE: a heartbeat committed meanwhile keeps its machine online
+        update(Machine).where(Machine.id.in_(candidates), *stale)
+        .values(previous_status=Machine.status, status="offline", alert_message=None)
+        .returning(*MACHINE_EVENT_COLUMNS).execution_options(synchronize_session=False)
+    ).all()
+    for row in rows:
+        mark_changed(session, row.id)
+        emit_machine_write(session, row)
+    if rows:
+        mark_stats_dirty(session)
+    session.commit()
+    return [row.id for row in rows]
+
+
+def sweep_offline_machines(session_factory):
+    with session_factory() as session:
+        while len(sweep_offline(session)) == OFFLINE_SWEEP_BATCH_SIZE:
+            pass
@@ -0,0 +1,33 @@
+import json
+import os
+from datetime import datetime
+
+from fastapi import Response
+
+# Optional: the stdlib encoder is used when orjson is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Opt-in: the machine list/detail endpoints build plain dicts straight from
+# the SQL rows and skip the response_model validation (same JSON shape)
+FAST_JSON_RESPONSES = os.environ.get("FAST_JSON_RESPONSES", "0") == "1"
+
+
+def _default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class FastJSONResponse(Response):
+    """JSONResponse for content made of dicts, lists, scalars and datetimes only."""
+
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        if orjson is not None:
+            # Naive datetimes come out as isoformat(), like pydantic
+            return orjson.dumps(content)
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_default).encode("utf-8")
@@ -0,0 +1,58 @@
+import threading
+import time
+import zlib
+from typing import Callable
+
+from sqlalchemy import text
+from sqlmodel import Session
+
+
+class Scheduler:
+    """Runs periodic jobs in one daemon thread per process."""
+
+    def __init__(self):
+        self._jobs = []
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def add(self, name: str, interval: float, func: Callable[[], None]):
+        self._jobs.append({"name": name, "interval": interval, "func": func, "next_run": time.monotonic() + interval})
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 30):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        while not self._stopping.is_set():
+            now = time.monotonic()
+            for job in self._jobs:
+                if job["next_run"] <= now:
+                    run_job(job["name"], job["func"])
+                    job["next_run"] = time.monotonic() + job["interval"]
+            next_run = min((job["next_run"] for job in self._jobs), default=now + 1)
+            self._stopping.wait(max(0.1, next_run - time.monotonic()))
+
+
+def run_job(name: str, func: Callable[[], None]):
+    try:
+        func()
+    except Exception as e:
+        print(f"Scheduled job {name} failed: {e}")
+
+
+def try_leader_lock(session: Session, name: str) -> bool:
+    """
+    Transaction-scoped lock so a job runs in only one worker process at a time.
+    Released on commit/rollback. SQLite already serializes writers.
+    """
+    if session.get_bind().dialect.name != "postgresql":
+        return True
+    key = zlib.crc32(name.encode("utf-8"))
+    return bool(session.execute(text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": key}).scalar())
@@ -0,0 +1,117 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Callable
+
+from sqlalchemy import case, func
+from sqlmodel import Session, select
+
+from .events import broker, emit, pending_events, RESYNC_EVENT
+from .models import Machine
+
+# How long /api/stats answers from memory (per worker process, dropped early on stats.invalidated)
+STATS_CACHE_TTL_SECONDS = float(os.environ.get("STATS_CACHE_TTL_SECONDS", "30"))
+TOP_MODELS = 20
+
+# Machine fields the breakdowns are computed from
+STATS_FIELDS = ("client_code", "os_info", "status", "manufacturer", "model", "ram_gb")
+
+
+class StatsCache:
+    """Caches one computed value for a TTL; concurrent misses compute it once."""
+
+    def __init__(self, ttl: float = STATS_CACHE_TTL_SECONDS):
+        self.ttl = ttl
+        self._value = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, compute: Callable[[], dict]) -> dict:
+        with self._lock:
+            if self._value is None or time.monotonic() >= self._expires_at:
+                self._value = compute()
+                self._expires_at = time.monotonic() + self.ttl
+            return self._value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+
+
+stats_cache = StatsCache()
+
+# Published once per transaction that created a machine or changed one of
+# STATS_FIELDS; every worker drops its cache (PostgreSQL broker), and the
+# dashboard reloads the stats on it
+STATS_EVENT = "stats.invalidated"
+
+
+def _invalidate_on_event(events):
+    # A resync means notifications were missed, possibly this one
+    if any(data is RESYNC_EVENT or data["type"] == STATS_EVENT for data in events):
+        stats_cache.invalidate()
+
+
+broker.add_listener(_invalidate_on_event)
+
+
+def mark_stats_dirty(session: Session):
+    # Goes out with the transaction's other events, after commit (dropped on rollback)
+    if not any(data["type"] == STATS_EVENT for data in pending_events(session)):
+        emit(session, STATS_EVENT)
+
+
+def _ram_bucket():
+    ram = Machine.ram_gb
+    return case(
+        (ram.is_(None), "Unknown"),
+        (ram < 4, "<4 GB"),
+        (ram < 8, "4-8 GB"),
+        (ram < 16, "8-16 GB"),
+        (ram < 32, "16-32 GB"),
+        else_="32+ GB",
+    )
+
+
+def _histogram(session: Session, column, default: str = "Unknown") -> dict:
+    rows = session.execute(select(column, func.count()).group_by(column).order_by(func.count().desc())).all()
+    counts = {}
+    for value, count in rows:
+        key = value if value is not None else default
+        counts[key] = counts.get(key, 0) + count
+    return counts
+
+
+def compute_stats(session: Session) -> dict:
+    """Fleet breakdowns, each one GROUP BY in the database."""
+    # status is set to offline by the sweeper (backend/offline.py), which also invalidates this cache
+    total, online = session.execute(
+        select(func.count(), func.sum(case((Machine.status != "offline", 1), else_=0)))
+    ).one()
+
+    ram_bucket = _ram_bucket().label("ram_bucket")
+    models = session.execute(
+        select(Machine.manufacturer, Machine.model, func.count().label("count"))
+        .group_by(Machine.manufacturer, Machine.model)
+        .order_by(func.count().desc())
+        .limit(TOP_MODELS)
+    ).all()
+
+    return {
+        "total_machines": total,
+        "online_machines": online or 0,
+        "os_distribution": _histogram(session, Machine.os_info),
+        "status_distribution": _histogram(session, Machine.status),
+        "client_distribution": _histogram(session, Machine.client_code),
+        "ram_distribution": _histogram(session, ram_bucket),
+        "top_models": [
+            {"manufacturer": row.manufacturer or "Unknown", "model": row.model or "Unknown", "count": row.count}
+            for row in models
+        ],
+        "generated_at": datetime.utcnow().isoformat()
+    }
+
+
+def read_cached_stats(session: Session) -> dict:
+    return stats_cache.get(lambda: compute_stats(session))
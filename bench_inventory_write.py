@@ -0,0 +1,98 @@
+"""
+Benchmark: ORM unit-of-work inserts vs. the bulk_insert() path for
+MachineSoftware/Service rows of a full inventory report.
+
+Usage: python bench_inventory_write.py [--machines 50] [--softwares 300] [--services 150] [--url sqlite:///bench.db]
+Only point --url at a scratch database, rows are written to it.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from sqlmodel import SQLModel, Session, create_engine
+
+from backend.database import bulk_insert
+from backend.models import Machine, MachineSoftware, Service, SoftwareCatalog
+
+
+def make_rows(machine_id, catalog_ids, services):
+    soft_rows = [{"machine_id": machine_id, "catalog_id": catalog_id} for catalog_id in catalog_ids]
+    svc_rows = [
+        {"name": f"svc{i}", "display_name": f"Service {i}", "status": "running", "start_type": "automatic", "machine_id": machine_id}
+        for i in range(services)
+    ]
+    return soft_rows, svc_rows
+
+
+def orm_path(engine, machine_ids, catalog_ids, services):
+    # What create_inventory used to do: one ORM object per row, commit + refresh
+    for machine_id in machine_ids:
+        with Session(engine) as session:
+            machine = session.get(Machine, machine_id)
+            soft_rows, svc_rows = make_rows(machine_id, catalog_ids, services)
+            for row in soft_rows:
+                session.add(MachineSoftware(**row))
+            for row in svc_rows:
+                session.add(Service(**row))
+            session.commit()
+            session.refresh(machine)
+
+
+def bulk_path(engine, machine_ids, catalog_ids, services):
+    for machine_id in machine_ids:
+        with Session(engine) as session:
+            soft_rows, svc_rows = make_rows(machine_id, catalog_ids, services)
+            bulk_insert(session, MachineSoftware, soft_rows)
+            bulk_insert(session, Service, svc_rows)
+            session.commit()
+
+
+def run(name, func, engine, machine_ids, catalog_ids, services):
+    start = time.perf_counter()
+    func(engine, machine_ids, catalog_ids, services)
+    elapsed = time.perf_counter() - start
+    rows = len(machine_ids) * (len(catalog_ids) + services)
+    print(f"{name:<6} {elapsed:8.3f}s  {rows / elapsed:10.0f} rows/s  ({elapsed / len(machine_ids) * 1000:.1f} ms/report)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Software/Service write path benchmark")
+    parser.add_argument("--machines", type=int, default=50)
+    parser.add_argument("--softwares", type=int, default=300)
+    parser.add_argument("--services", type=int, default=150)
+    parser.add_argument("--url", help="Database URL (default: temporary SQLite file)")
+    args = parser.parse_args()
+
+    tmpdir = None
+    url = args.url
+    if not url:
+        tmpdir = tempfile.mkdtemp()
+        url = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+
+    engine = create_engine(url)
+    SQLModel.metadata.create_all(engine)
+
+    with Session(engine) as session:
+        # One set of machines per path, links are unique per (machine, package)
+        machines = [Machine(hostname=f"BENCH-{i}") for i in range(args.machines * 2)]
+        session.add_all(machines)
+        session.commit()
+        machine_ids = [m.id for m in machines]
+        catalog = [SoftwareCatalog(name=f"Package {i}", version=f"1.{i}", publisher="Vendor") for i in range(args.softwares)]
+        session.add_all(catalog)
+        session.commit()
+        catalog_ids = [c.id for c in catalog]
+
+    print(f"{args.machines} reports x ({args.softwares} softwares + {args.services} services) on {engine.dialect.name}")
+    run("orm", orm_path, engine, machine_ids[:args.machines], catalog_ids, args.services)
+    run("bulk", bulk_path, engine, machine_ids[args.machines:], catalog_ids, args.services)
+
+    engine.dispose()
+    if tmpdir:
+        os.remove(os.path.join(tmpdir, "bench.db"))
+        os.rmdir(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Benchmark: response serialization of GET /api/machines and /api/machines/{id},
+with and without FAST_JSON_RESPONSES, at several fleet sizes.
+
+Usage: python bench_serialization.py [--sizes 1000,10000,50000] [--softwares 30] [--services 10]
+Requests go through the ASGI app (routing, validation, serialization), a scratch
+SQLite database is created for each size.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+
+DB_PATH = os.path.join(tempfile.mkdtemp(), "bench_serialization.db")
+# Before importing the app: it binds its engine at import time
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+
+from sqlmodel import SQLModel, Session
+
+from backend import main
+from backend.database import bulk_insert, engine
+from backend.models import Machine, MachineSoftware, Service, SoftwareCatalog
+
+engine.echo = False
+
+
+def seed(machines, softwares, services):
+    SQLModel.metadata.drop_all(engine)
+    SQLModel.metadata.create_all(engine)
+    rng = random.Random(42)
+    with Session(engine) as session:
+        bulk_insert(session, SoftwareCatalog, [
+            {"name": f"Package {i}", "version": f"{i % 20}.{i % 7}.{i}", "publisher": f"Vendor {i % 150}"} for i in range(2000)
+        ])
+        bulk_insert(session, Machine, [
+            {
+                "hostname": f"BENCH-{i:06d}", "client_code": "BENCH", "ip_address": f"10.0.{i // 256 % 256}.{i % 256}",
+                "os_info": "Windows 11 Pro", "processor": "Intel(R) Core(TM) i5-10500 CPU @ 3.10GHz", "ram_gb": 15.8,
+                "disk_gb": 476.3, "manufacturer": "Dell Inc.", "model": "OptiPlex 7080", "serial_number": f"SN{i:08d}",
+                "last_seen": datetime(2024, 1, 1, 12, 0, i % 60, i), "cpu_usage": rng.random() * 100,
+                "memory_usage": rng.random() * 100, "disk_usage": rng.random() * 100, "status": "online", "change_seq": 0
+            }
+            for i in range(machines)
+        ])
+        session.commit()
+        links, rows = [], []
+        for machine_id in range(1, machines + 1):
+            links.extend({"machine_id": machine_id, "catalog_id": c} for c in rng.sample(range(1, 2001), softwares))
+            rows.extend(
+                {"machine_id": machine_id, "name": f"Svc{s}", "display_name": f"Service {s}", "status": "running", "start_type": "auto"}
+                for s in range(services)
+            )
+            if len(links) >= 100000:
+                bulk_insert(session, MachineSoftware, links)
+                bulk_insert(session, Service, rows)
+                links, rows = [], []
+        bulk_insert(session, MachineSoftware, links)
+        bulk_insert(session, Service, rows)
+        session.commit()
+
+
+async def request(path, query=""):
+    """GET through the ASGI app. Returns (status, headers, body bytes)."""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET", "scheme": "http",
+        "path": path, "raw_path": path.encode(), "query_string": query.encode(), "root_path": "",
+        "headers": [(b"host", b"bench")], "server": ("bench", 80), "client": ("127.0.0.1", 1),
+    }
+    await main.app(scope, receive, send)
+    start = messages[0]
+    headers = {key.decode(): value.decode() for key, value in start["headers"]}
+    return start["status"], headers, b"".join(m.get("body", b"") for m in messages[1:])
+
+
+async def list_pages(query, max_pages=None):
+    """Walk the pages of the machine list. Returns the bytes received."""
+    received, cursor, pages = 0, None, 0
+    while max_pages is None or pages < max_pages:
+        pages += 1
+        status, headers, body = await request("/api/machines", query + (f"&cursor={cursor}" if cursor else ""))
+        assert status == 200, body[:200]
+        received += len(body)
+        cursor = headers.get("x-next-cursor")
+        if not cursor:
+            break
+    return received
+
+
+async def details(machine_ids):
+    received = 0
+    for machine_id in machine_ids:
+        status, _, body = await request(f"/api/machines/{machine_id}")
+        assert status == 200, body[:200]
+        received += len(body)
+    return received
+
+
+def timed(label, func, *args):
+    results = {}
+    for fast in (False, True):
+        main.FAST_JSON_RESPONSES = fast
+        asyncio.run(func(*args))  # warm up
+        start = time.perf_counter()
+        received = asyncio.run(func(*args))
+        results[fast] = (time.perf_counter() - start, received)
+    (before, size), (after, fast_size) = results[False], results[True]
+    assert size == fast_size, f"{label}: {size} bytes before, {fast_size} after"
+    print(f"  {label:<34} {before * 1000:9.1f} ms -> {after * 1000:9.1f} ms  ({before / after:4.1f}x, {size / 1e6:6.1f} MB)")
+
+
+def main_bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,50000")
+    parser.add_argument("--softwares", type=int, default=30)
+    parser.add_argument("--services", type=int, default=10)
+    args = parser.parse_args()
+
+    for size in (int(value) for value in args.sizes.split(",")):
+        seed(size, args.softwares, args.services)
+        print(f"{size} machines ({args.softwares} softwares, {args.services} services each)")
+        timed("list, all pages (limit=1000)", list_pages, "limit=1000")
+        timed("list embed, first 1000 machines", list_pages, "limit=100&embed=softwares,services", 10)
+        timed("detail x 200", details, random.Random(1).sample(range(1, size + 1), 200))
+    os.remove(DB_PATH)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,97 @@
+"""
+Benchmark: /api/software/search queries on a synthetic fleet.
+
+Usage: python bench_software_search.py [--machines 10000] [--softwares 300] [--packages 3000] [--url sqlite:///bench.db]
+Only point --url at a scratch database, rows are written to it.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+
+from sqlmodel import SQLModel, Session, create_engine
+
+from backend.catalog import search_software, version_sort_key
+from backend.database import bulk_insert
+from backend.models import Machine, MachineSoftware, SoftwareCatalog
+
+
+def seed(engine, machines, softwares, packages):
+    rng = random.Random(42)
+    with Session(engine) as session:
+        catalog = []
+        for i in range(packages):
+            for minor in range(3):
+                catalog.append({"name": f"Package {i}", "version": f"{1 + i % 20}.{minor}.{i}", "publisher": f"Vendor {i % 150}"})
+        # A package installed everywhere, in a few versions
+        catalog += [{"name": "Google Chrome", "version": version, "publisher": "Google LLC"} for version in ("120.0.6099.130", "120.0.6099.217", "121.0.6167.85")]
+        for entry in catalog:
+            entry["version_sort"] = version_sort_key(entry["version"])
+        bulk_insert(session, SoftwareCatalog, catalog)
+        bulk_insert(session, Machine, [
+            {"hostname": f"BENCH-{i}", "client_code": "BENCH", "status": "online", "last_seen": datetime(2024, 1, 1)}
+            for i in range(machines)
+        ])
+        session.commit()
+
+        catalog_ids = list(range(1, len(catalog) - 2))
+        chrome_ids = [len(catalog) - 2, len(catalog) - 1, len(catalog)]
+        rows = []
+        for machine_id in range(1, machines + 1):
+            picked = rng.sample(catalog_ids, softwares - 1) + [rng.choice(chrome_ids)]
+            rows.extend({"machine_id": machine_id, "catalog_id": catalog_id} for catalog_id in picked)
+            if len(rows) >= 100000:
+                bulk_insert(session, MachineSoftware, rows)
+                rows = []
+        bulk_insert(session, MachineSoftware, rows)
+        session.commit()
+
+
+def timed(engine, label, **filters):
+    with Session(engine) as session:
+        search_software(session, **filters)  # warm up
+        runs = 5
+        start = time.perf_counter()
+        for _ in range(runs):
+            result = search_software(session, **filters)
+        elapsed = (time.perf_counter() - start) / runs
+    print(f"{label:<38} {elapsed * 1000:8.1f} ms  ({len(result['machines'])} machines, {len(result['versions'])} versions)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Software search benchmark")
+    parser.add_argument("--machines", type=int, default=10000)
+    parser.add_argument("--softwares", type=int, default=300)
+    parser.add_argument("--packages", type=int, default=3000)
+    parser.add_argument("--url", help="Database URL (default: temporary SQLite file)")
+    args = parser.parse_args()
+
+    tmpdir = None
+    url = args.url
+    if not url:
+        tmpdir = tempfile.mkdtemp()
+        url = f"sqlite:///{os.path.join(tmpdir, 'bench.db')}"
+
+    engine = create_engine(url)
+    SQLModel.metadata.create_all(engine)
+    start = time.perf_counter()
+    seed(engine, args.machines, args.softwares, args.packages)
+    print(f"Seeded {args.machines} machines x {args.softwares} softwares on {engine.dialect.name} in {time.perf_counter() - start:.1f}s")
+
+    timed(engine, "q=chrome (every machine)", q="chrome")
+    timed(engine, "q=chrome version_lt=121", q="chrome", version_lt="121")
+    timed(engine, "q=package 12 (many entries)", q="package 12")
+    timed(engine, "publisher=vendor 7", publisher="vendor 7")
+    timed(engine, "publisher=vendor version_lt=10 (broad)", publisher="vendor", version_lt="10")
+    timed(engine, "q=chrome page 50", q="chrome", cursor=args.machines // 2)
+
+    engine.dispose()
+    if tmpdir:
+        os.remove(os.path.join(tmpdir, "bench.db"))
+        os.rmdir(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
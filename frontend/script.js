@@ -21,6 +21,21 @@ async function authFetch(url, options = {}) {
     return response;
 }
 
+// Follows the X-Next-Cursor header of paginated endpoints and returns every item
+async function fetchAllPages(url) {
+    const items = [];
+    let cursor = null;
+    do {
+        const separator = url.includes('?') ? '&' : '?';
+        const pageUrl = cursor ? `${url}${separator}cursor=${encodeURIComponent(cursor)}` : url;
+        const response = await authFetch(pageUrl);
+        if (!response) return null;
+        items.push(...await response.json());
+        cursor = response.headers.get('X-Next-Cursor');
+    } while (cursor);
+    return items;
+}
+
 document.addEventListener('DOMContentLoaded', () => {
     // Logout Button Logic (assuming we add one)
     const logoutBtn = document.getElementById('btn-logout');
@@ -82,8 +97,8 @@ async function loadStats() {
         const data = await response.json();
 
         document.getElementById('total-machines').textContent = data.total_machines;
-        // Mock online/disk data for now as API doesn't fully support it yet
-        document.getElementById('online-machines').textContent = data.total_machines;
+        // Machines not marked offline by the server's offline sweep
+        document.getElementById('online-machines').textContent = data.online_machines;
 
         // Update Chart
         updateChart(data.os_distribution);
@@ -92,60 +107,83 @@ async function loadStats() {
     }
 }
 
+// Machines shown in the list, kept current by the event stream
+const machinesById = new Map();
+
 async function loadMachines() {
     try {
-        const response = await authFetch(`${API_URL}/machines`);
-        if (!response) return;
-        const machines = await response.json();
+        // Slim summaries, the details modal loads software/services per machine
+        const machines = await fetchAllPages(`${API_URL}/machines?limit=500`);
+        if (!machines) return;
         const tbody = document.getElementById('machines-table-body');
         tbody.innerHTML = '';
+        machinesById.clear();
 
         machines.forEach(machine => {
-            let statusColor = '#10b981'; // green
-            let statusText = 'Online';
-
-            if (machine.status === 'warning') {
-                statusColor = '#f59e0b';
-                statusText = 'Warning';
-            } else if (machine.status === 'critical') {
-                statusColor = '#ef4444';
-                statusText = 'Critical';
-            }
-
-            // Online/Offline check (rough check based on last_seen > 5 min)
-            const lastSeen = new Date(machine.last_seen);
-            const now = new Date();
-            const diffMs = now - lastSeen;
-            const diffMins = Math.round(((diffMs % 86400000) % 3600000) / 60000); // rough
-
-            // Better diff
-            const diffSeconds = (now - lastSeen) / 1000;
-            if (diffSeconds > 300) { // 5 mins
-                statusColor = '#94a3b8'; // gray
-                statusText = 'Offline';
-            }
-
-            const tr = document.createElement('tr');
-            tr.innerHTML = `
-                <td><span style="background-color: ${statusColor}; color: #fff; padding: 2px 6px; border-radius: 4px; font-size: 0.8em;">${statusText}</span></td>
-                <td>${machine.hostname}
-                    ${machine.alert_message ? `<br><small style="color:${statusColor}">${machine.alert_message}</small>` : ''}
-                </td>
-                <td>${machine.ip_address || 'N/A'}</td>
-                <td>${machine.cpu_usage !== null ? machine.cpu_usage + '%' : '-'}</td>
-                <td>${machine.memory_usage !== null ? machine.memory_usage + '%' : '-'}</td>
-                <td>${machine.disk_usage !== null ? machine.disk_usage + '%' : '-'}</td>
-                <td>${machine.os_info || 'N/A'}</td>
-                <td>${new Date(machine.last_seen).toLocaleString()}</td>
-                <td><button onclick="viewDetails(${machine.id})">Detalhes</button></td>
-            `;
-            tbody.appendChild(tr);
+            machinesById.set(machine.id, machine);
+            tbody.appendChild(renderMachineRow(machine));
         });
     } catch (error) {
         console.error('Error loading machines:', error);
     }
 }
 
+function renderMachineRow(machine) {
+    let statusColor = '#10b981'; // green
+    let statusText = 'Online';
+
+    if (machine.status === 'warning') {
+        statusColor = '#f59e0b';
+        statusText = 'Warning';
+    } else if (machine.status === 'critical') {
+        statusColor = '#ef4444';
+        statusText = 'Critical';
+    }
+
+    // Set by the server's offline sweeper
+    if (machine.status === 'offline') {
+        statusColor = '#94a3b8'; // gray
+        statusText = 'Offline';
+    }
+
+    const tr = document.createElement('tr');
+    tr.dataset.machineId = machine.id;
+    tr.innerHTML = `
+        <td><span style="background-color: ${statusColor}; color: #fff; padding: 2px 6px; border-radius: 4px; font-size: 0.8em;">${statusText}</span></td>
+        <td>${machine.hostname}
+            ${machine.alert_message ? `<br><small style="color:${statusColor}">${machine.alert_message}</small>` : ''}
+        </td>
+        <td>${machine.ip_address || 'N/A'}</td>
+        <td>${machine.cpu_usage !== null ? machine.cpu_usage + '%' : '-'}</td>
+        <td>${machine.memory_usage !== null ? machine.memory_usage + '%' : '-'}</td>
+        <td>${machine.disk_usage !== null ? machine.disk_usage + '%' : '-'}</td>
+        <td>${machine.os_info || 'N/A'}</td>
+        <td>${new Date(machine.last_seen).toLocaleString()}</td>
+        <td><button onclick="viewDetails(${machine.id})">Detalhes</button></td>
+    `;
+    return tr;
+}
+
+// Replaces the row of one machine, or inserts it in hostname order
+function upsertMachineRow(data) {
+    const { type, machine_id, previous_status, ...fields } = data;
+    const machine = { ...(machinesById.get(machine_id) || {}), ...fields, id: machine_id };
+    machinesById.set(machine_id, machine);
+
+    const tbody = document.getElementById('machines-table-body');
+    const row = renderMachineRow(machine);
+    const existing = tbody.querySelector(`tr[data-machine-id="${machine_id}"]`);
+    if (existing) {
+        tbody.replaceChild(row, existing);
+        return;
+    }
+    const next = Array.from(tbody.children).find(tr => {
+        const other = machinesById.get(Number(tr.dataset.machineId));
+        return other && other.hostname > machine.hostname;
+    });
+    tbody.insertBefore(row, next || null);
+}
+
 async function viewDetails(id) {
     try {
         const response = await authFetch(`${API_URL}/machines/${id}`);
@@ -245,7 +283,7 @@ async function controlService(machineId, serviceName, action) {
         const commandData = await response.json();
         const commandId = commandData.id;
 
-        pollCommandResult(commandId);
+        waitForCommandResult(commandId);
 
     } catch (error) {
         appendToTerminal(`Error: ${error.message}`, 'error');
@@ -310,6 +348,11 @@ function setupTerminal(machineId) {
         runCommand(newInput.value);
         newInput.value = '';
     });
+
+    // Ctrl+C on an empty line stops the commands still running
+    newInput.addEventListener('keydown', (e) => {
+        if (e.ctrlKey && e.key === 'c' && !newInput.value) cancelRunningCommands();
+    });
 }
 
 function appendToTerminal(text, type = 'output') {
@@ -324,6 +367,7 @@ function appendToTerminal(text, type = 'output') {
     }
     term.appendChild(div);
     term.scrollTop = term.scrollHeight;
+    return div;
 }
 
 async function runCommand(cmd) {
@@ -344,39 +388,77 @@ async function runCommand(cmd) {
         const commandData = await response.json();
         const commandId = commandData.id;
 
-        // Poll for result
-        pollCommandResult(commandId);
+        // Output is shown while the agent streams it
+        waitForCommandResult(commandId);
 
     } catch (error) {
         appendToTerminal(`Error: ${error.message}`, 'error');
     }
 }
 
-async function pollCommandResult(commandId) {
-    let attempts = 0;
-    const maxAttempts = 20; // 60 seconds (3s interval)
+// Gives up when the command produces nothing for this long
+const COMMAND_TIMEOUT_MS = 60000;
+// Seconds per request, the server answers as soon as output arrives
+const COMMAND_WAIT_SECONDS = 30;
 
-    const interval = setInterval(async () => {
-        try {
-            const response = await authFetch(`${API_URL}/commands/${commandId}`);
-            const cmd = await response.json();
+// Commands whose output is being tailed
+const runningCommands = new Set();
 
-            if (cmd.status === 'completed' || cmd.status === 'error') {
-                clearInterval(interval);
-                appendToTerminal(cmd.output || "[No Output]");
-            }
+async function cancelRunningCommands() {
+    if (!runningCommands.size) return;
+    appendToTerminal('^C');
+    for (const commandId of runningCommands) {
+        try {
+            await authFetch(`${API_URL}/commands/${commandId}/cancel`, { method: 'POST' });
+        } catch (error) {
+            appendToTerminal(`Error: ${error.message}`, 'error');
+        }
+    }
+}
 
-            attempts++;
-            if (attempts >= maxAttempts) {
-                clearInterval(interval);
-                appendToTerminal("Timeout waiting for response.", 'error');
-            }
+// Tails the command's output into the terminal until it finishes
+async function waitForCommandResult(commandId) {
+    runningCommands.add(commandId);
+    try {
+        await tailCommandOutput(commandId);
+    } finally {
+        runningCommands.delete(commandId);
+    }
+}
 
-        } catch (error) {
-            clearInterval(interval);
-            appendToTerminal(`Polling error: ${error.message}`, 'error');
+async function tailCommandOutput(commandId) {
+    const block = appendToTerminal('');
+    let offset = 0;
+    let deadline = Date.now() + COMMAND_TIMEOUT_MS;
+    while (Date.now() < deadline) {
+        const wait = Math.min(COMMAND_WAIT_SECONDS, Math.ceil((deadline - Date.now()) / 1000));
+        const tail = await fetchCommandOutput(commandId, offset, wait);
+        if (!tail) return;
+        if (tail.data) {
+            block.textContent += tail.data;
+            block.parentElement.scrollTop = block.parentElement.scrollHeight;
+            deadline = Date.now() + COMMAND_TIMEOUT_MS;
+        }
+        offset = tail.offset;
+        if (tail.done) {
+            if (!offset) block.textContent = "[No Output]";
+            if (tail.status === 'cancelled') appendToTerminal("Command cancelled.", 'error');
+            if (tail.truncated) appendToTerminal("[Output truncated]", 'error');
+            return;
         }
-    }, 3000);
+    }
+    appendToTerminal("Timeout waiting for response.", 'error');
+}
+
+async function fetchCommandOutput(commandId, offset, wait) {
+    try {
+        const response = await authFetch(`${API_URL}/commands/${commandId}/output?offset=${offset}&wait=${wait}`);
+        if (!response || !response.ok) return null;
+        return await response.json();
+    } catch (error) {
+        appendToTerminal(`Error: ${error.message}`, 'error');
+        return null;
+    }
 }
 
 
@@ -429,8 +511,9 @@ function updateChart(osData) {
 
 // --- Settings Logic ---
 
-// Auto Refresh
-let autoRefreshInterval = null;
+// Live updates (Server-Sent Events)
+let eventSource = null;
+let statsReloadTimer = null;
 
 function setupSettings() {
     // Auto Refresh Toggle
@@ -438,13 +521,13 @@ function setupSettings() {
     if (toggleRefresh) {
         toggleRefresh.addEventListener('change', (e) => {
             if (e.target.checked) {
-                startAutoRefresh();
+                startLiveUpdates();
             } else {
-                stopAutoRefresh();
+                stopLiveUpdates();
             }
         });
         // Initial state
-        if (toggleRefresh.checked) startAutoRefresh();
+        if (toggleRefresh.checked) startLiveUpdates();
     }
 
     // Compact Mode Toggle
@@ -468,29 +551,51 @@ function setupSettings() {
     }
 }
 
-function startAutoRefresh() {
-    if (autoRefreshInterval) clearInterval(autoRefreshInterval);
-    autoRefreshInterval = setInterval(() => {
-        // Only refresh if tab is active to save resources? 
-        // For now just check if dashboard or machines view is active
-        const dashboard = document.getElementById('dashboard-view');
-        const machines = document.getElementById('machines-view');
+function startLiveUpdates() {
+    if (eventSource) eventSource.close();
+    let reconnecting = false;
+    eventSource = new EventSource(`${API_URL}/events`);
 
-        if (dashboard.style.display !== 'none') loadStats();
-        if (machines.style.display !== 'none') loadMachines();
+    eventSource.addEventListener('open', () => {
+        // Events sent while disconnected are lost, reload once
+        if (reconnecting) reloadViews();
+        reconnecting = false;
+    });
+    eventSource.addEventListener('error', () => {
+        // EventSource reconnects by itself
+        reconnecting = true;
+    });
+    eventSource.addEventListener('resync', reloadViews);
 
-    }, 30000); // 30 seconds
-    console.log('Auto-refresh started');
+    eventSource.addEventListener('machine.created', (e) => upsertMachineRow(JSON.parse(e.data)));
+    eventSource.addEventListener('machine.updated', (e) => upsertMachineRow(JSON.parse(e.data)));
+    // Sent once the server caches were dropped, the reload gets fresh numbers
+    eventSource.addEventListener('stats.invalidated', scheduleStatsReload);
+    console.log('Live updates started');
 }
 
-function stopAutoRefresh() {
-    if (autoRefreshInterval) {
-        clearInterval(autoRefreshInterval);
-        autoRefreshInterval = null;
-        console.log('Auto-refresh stopped');
+function stopLiveUpdates() {
+    if (eventSource) {
+        eventSource.close();
+        eventSource = null;
+        console.log('Live updates stopped');
     }
 }
 
+function reloadViews() {
+    loadStats();
+    loadMachines();
+}
+
+// Stats changes come in bursts, the dashboard reloads the stats once per burst
+function scheduleStatsReload() {
+    if (statsReloadTimer) return;
+    statsReloadTimer = setTimeout(() => {
+        statsReloadTimer = null;
+        if (document.getElementById('dashboard-view').style.display !== 'none') loadStats();
+    }, 2000);
+}
+
 function copyToken() {
     const copyText = document.getElementById("agent-token");
     copyText.select();
@@ -500,47 +605,14 @@ function copyToken() {
         .catch(() => alert("Falha ao copiar"));
 }
 
-async function exportFullInventory() {
-    try {
-        const response = await authFetch(`${API_URL}/machines`);
-        if (!response) return;
-        const machines = await response.json();
-
-        let csv = "data:text/csv;charset=utf-8,";
-        // Header
-        csv += "Client Code,Hostname,IP,OS,CPU%,RAM,Disk,Software Name,Version,Publisher,Last Seen\n";
-
-        machines.forEach(m => {
-            // Base machine info
-            const baseInfo = `${m.client_code || 'DEFAULT'},${m.hostname},${m.ip_address},${m.os_info},${m.cpu_usage}%,${m.ram_gb}GB,${m.disk_gb}GB`;
-
-            // If no software, just print machine info
-            if (!m.softwares || m.softwares.length === 0) {
-                csv += `${baseInfo},,,${m.last_seen}\n`;
-            } else {
-                // One row per software
-                m.softwares.forEach(s => {
-                    // Escape commas in names
-                    const cleanName = s.name ? `"${s.name.replace(/"/g, '""')}"` : "";
-                    const cleanVer = s.version ? `"${s.version.replace(/"/g, '""')}"` : "";
-                    const cleanPub = s.publisher ? `"${s.publisher.replace(/"/g, '""')}"` : "";
-
-                    csv += `${baseInfo},${cleanName},${cleanVer},${cleanPub},${m.last_seen}\n`;
-                });
-            }
-        });
-
-        const encodedUri = encodeURI(csv);
-        const link = document.createElement("a");
-        link.setAttribute("href", encodedUri);
-        link.setAttribute("download", `full_inventory_${new Date().toISOString().slice(0, 10)}.csv`);
-        document.body.appendChild(link);
-        link.click();
-        document.body.removeChild(link);
-
-    } catch (e) {
-        alert("Erro ao exportar dados: " + e.message);
-    }
+function exportFullInventory() {
+    // Streamed by the server, the browser just saves the download
+    const link = document.createElement("a");
+    link.setAttribute("href", `${API_URL}/export/inventory.csv`);
+    link.setAttribute("download", `full_inventory_${new Date().toISOString().slice(0, 10)}.csv`);
+    document.body.appendChild(link);
+    link.click();
+    document.body.removeChild(link);
 }
 
 async function pruneOfflineAgents() {
@@ -0,0 +1,83 @@
+"""
+One-off migration: merge machines that share a (client_code, hostname) so
+the unique index the ingest upsert relies on can be created. The most
+recently seen row of each group is kept; commands, metric history and
+rollups of the others are moved to it, their software links and services
+are dropped (the next report of the host resyncs them). Safe to run more
+than once.
+
+Usage: python merge_duplicate_machines.py [--dry-run]
+"""
+import argparse
+
+from sqlalchemy import and_, delete, exists, func, update
+from sqlalchemy.orm import aliased
+from sqlmodel import SQLModel, Session, select
+
+from backend.changes import mark_changed
+from backend.database import engine, create_db_and_tables, add_missing_columns
+from backend.stats import mark_stats_dirty
+from backend.models import Command, Machine, MachineSoftware, MetricRollup, MetricSample, Service
+
+
+def duplicate_groups(session: Session):
+    """Machine ids per duplicated (client_code, hostname), survivor first."""
+    keys = session.execute(
+        select(Machine.client_code, Machine.hostname)
+        .group_by(Machine.client_code, Machine.hostname)
+        .having(func.count() > 1)
+    ).all()
+    for client_code, hostname in keys:
+        yield session.execute(
+            select(Machine.id)
+            .where(Machine.client_code == client_code, Machine.hostname == hostname)
+            # Latest report wins, the oldest id on a tie
+            .order_by(Machine.last_seen.desc(), Machine.id)
+        ).scalars().all()
+
+
+def merge_into(session: Session, survivor: int, duplicate: int):
+    session.execute(update(Command).where(Command.machine_id == duplicate).values(machine_id=survivor))
+    session.execute(update(MetricSample).where(MetricSample.machine_id == duplicate).values(machine_id=survivor))
+    # Rollup buckets are unique per machine: move only those the survivor does not have
+    kept = aliased(MetricRollup)
+    session.execute(
+        update(MetricRollup)
+        .where(MetricRollup.machine_id == duplicate, ~exists().where(and_(
+            kept.machine_id == survivor, kept.step == MetricRollup.step, kept.bucket == MetricRollup.bucket
+        )))
+        .values(machine_id=survivor)
+    )
+    for model in (MetricRollup, MachineSoftware, Service):
+        session.execute(delete(model).where(model.machine_id == duplicate))
+    session.execute(delete(Machine).where(Machine.id == duplicate))
+
+
+def merge(dry_run=False):
+    # Startup refuses to run while duplicates exist: only tables and columns here
+    SQLModel.metadata.create_all(engine)
+    add_missing_columns()
+    with Session(engine) as session:
+        merged = 0
+        for survivor, *duplicates in duplicate_groups(session):
+            print(f"Machine {survivor}: merging {', '.join(map(str, duplicates))}")
+            if dry_run:
+                continue
+            for duplicate in duplicates:
+                merge_into(session, survivor, duplicate)
+            mark_changed(session, survivor)
+            mark_stats_dirty(session)
+            session.commit()
+            merged += len(duplicates)
+
+    if dry_run:
+        return
+    print(f"{merged} duplicate machines merged.")
+    create_db_and_tables()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge machines with the same client code and hostname")
+    parser.add_argument("--dry-run", action="store_true", help="Only list the machines that would be merged")
+    args = parser.parse_args()
+    merge(args.dry_run)
@@ -0,0 +1,52 @@
+"""
+One-off migration: move the per-machine rows of the legacy `software` table
+into SoftwareCatalog + MachineSoftware. Machines that already have catalog
+links are skipped, so it is safe to run more than once.
+
+Usage: python migrate_software_catalog.py [--drop-legacy]
+"""
+import argparse
+from types import SimpleNamespace
+
+from sqlalchemy import inspect, text
+from sqlmodel import Session, select
+
+from backend.database import engine, create_db_and_tables
+from backend.inventory import sync_softwares
+from backend.models import MachineSoftware
+
+
+def migrate(drop_legacy=False):
+    create_db_and_tables()
+    if not inspect(engine).has_table("software"):
+        print("No legacy software table, nothing to migrate.")
+        return
+
+    with Session(engine) as session:
+        machine_ids = session.execute(
+            text("SELECT DISTINCT machine_id FROM software WHERE machine_id IS NOT NULL")
+        ).scalars().all()
+        migrated = set(session.execute(select(MachineSoftware.machine_id).distinct()).scalars().all())
+
+        for machine_id in machine_ids:
+            if machine_id in migrated:
+                continue
+            rows = session.execute(
+                text("SELECT name, version, publisher FROM software WHERE machine_id = :machine_id ORDER BY id"),
+                {"machine_id": machine_id}
+            ).mappings().all()
+            sync_softwares(session, SimpleNamespace(id=machine_id), [dict(row) for row in rows])
+            session.commit()
+            print(f"Machine {machine_id}: {len(rows)} software rows migrated")
+
+        if drop_legacy:
+            session.execute(text("DROP TABLE software"))
+            session.commit()
+            print("Legacy software table dropped.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate legacy software rows to the software catalog")
+    parser.add_argument("--drop-legacy", action="store_true", help="Drop the legacy software table afterwards")
+    args = parser.parse_args()
+    migrate(args.drop_legacy)
@@ -0,0 +1,102 @@
+import asyncio
+import unittest
+from fastapi import HTTPException, Response
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy import event
+from sqlalchemy.pool import StaticPool
+
+from backend.catalog import catalog_cache
+from backend.identity import HostnameCache, hostname_cache, issue_agent_token, verify_agent_token
+from backend.main import (CommandCreate, create_command, create_inventory, get_pending_commands_by_hostname,
+                          heartbeat_by_hostname)
+from backend.models import InventoryReport, Heartbeat, Machine
+
+
+class TestAgentIdentity(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        hostname_cache.clear()
+        self.token = self.report("PC-1").headers["x-agent-token"]
+        self.report("PC-2")
+
+    def report(self, hostname, client_code="ACME"):
+        response = Response()
+        with Session(self.engine) as session:
+            create_inventory(InventoryReport(hostname=hostname, client_code=client_code), response, session)
+        return response
+
+    def statements(self):
+        executed = []
+        event.listen(self.engine, "before_cursor_execute", lambda conn, cursor, sql, *args: executed.append(sql))
+        return executed
+
+    def test_token(self):
+        self.assertEqual(verify_agent_token(self.token), 1)
+        self.assertEqual(verify_agent_token(issue_agent_token(42)), 42)
+        self.assertIsNone(verify_agent_token("2." + self.token.split(".")[1]))
+        self.assertIsNone(verify_agent_token("garbage"))
+        self.assertIsNone(verify_agent_token(None))
+
+    def test_inventory_refreshes_cache(self):
+        hostname_cache.clear()
+        response = self.report("PC-1")
+        self.assertEqual(verify_agent_token(response.headers["x-agent-token"]), 1)
+        self.assertEqual(hostname_cache.get("ACME", "PC-1"), 1)
+
+    def test_heartbeat_uses_cache_and_recovers_from_stale_entry(self):
+        hostname_cache.put("ACME", "PC-2", 1)
+        response = Response()
+        with Session(self.engine) as session:
+            heartbeat_by_hostname(Heartbeat(hostname="PC-2", client_code="ACME", cpu_usage=5), response, session)
+        self.assertEqual(verify_agent_token(response.headers["x-agent-token"]), 2)
+        self.assertEqual(hostname_cache.get("ACME", "PC-2"), 2)
+        with Session(self.engine) as session:
+            self.assertEqual(session.get(Machine, 2).cpu_usage, 5)
+            self.assertIsNone(session.get(Machine, 1).cpu_usage)
+
+    def test_pending_by_token(self):
+        with Session(self.engine) as session:
+            create_command(1, CommandCreate(command="hostname"), session)
+        hostname_cache.clear()
+        executed = self.statements()
+        commands = asyncio.run(get_pending_commands_by_hostname(
+            Response(), hostname=None, x_agent_token=self.token, wait=0, limit=5, session_factory=lambda: Session(self.engine)
+        ))
+        self.assertEqual([c.command for c in commands], ["hostname"])
+        self.assertFalse(any("machine.hostname" in sql for sql in executed))
+        with self.assertRaises(HTTPException):
+            asyncio.run(get_pending_commands_by_hostname(
+                Response(), hostname=None, x_agent_token=None, wait=0, limit=5, session_factory=lambda: Session(self.engine)
+            ))
+
+    def test_same_hostname_in_two_clients(self):
+        self.report("PC-1", client_code="GLOBEX")
+        with Session(self.engine) as session:
+            create_command(1, CommandCreate(command="Restart-Computer"), session)
+            heartbeat_by_hostname(Heartbeat(hostname="PC-1", client_code="GLOBEX", cpu_usage=5), Response(), session)
+            self.assertEqual([session.get(Machine, i).cpu_usage for i in (1, 3)], [None, 5])
+
+        def poll(client_code):
+            hostname_cache.clear()
+            return asyncio.run(get_pending_commands_by_hostname(
+                Response(), hostname="PC-1", client_code=client_code, wait=0, limit=5, session_factory=lambda: Session(self.engine)
+            ))
+        # The other client's PC-1 does not get the command
+        self.assertEqual(poll("GLOBEX"), [])
+        self.assertEqual([c.command for c in poll("ACME")], ["Restart-Computer"])
+
+    def test_cache_bounded(self):
+        cache = HostnameCache(max_size=2)
+        for i in range(3):
+            cache.put("ACME", f"PC-{i}", i)
+        self.assertEqual((cache.get("ACME", "PC-0"), cache.get("ACME", "PC-2")), (None, 2))
+        self.assertIsNone(cache.get("GLOBEX", "PC-2"))
+        cache.invalidate("ACME", "PC-2")
+        self.assertIsNone(cache.get("ACME", "PC-2"))
+        self.assertIsNone(HostnameCache(ttl=-1).get(None, "PC-1"))
+
+
+if __name__ == '__main__':
+    unittest.main()
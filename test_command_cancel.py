@@ -0,0 +1,77 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from sqlmodel import SQLModel, Session, create_engine
+
+from backend import commands
+from backend.catalog import catalog_cache
+from backend.commands import claim_commands, requeue_expired_leases, wait_for_commands
+from backend.events import PENDING_KEY
+from backend.inventory import ingest_report
+from backend.main import CommandCreate, CommandUpdate, cancel_command, create_command, update_command_result
+from backend.models import InventoryReport, Command
+
+
+class TestCommandCancel(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # File database: the parked poll reads from a worker thread while the test cancels
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.tmpdir.name, 'cancel.db')}", connect_args={"check_same_thread": False})
+        self.addCleanup(self.engine.dispose)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        with Session(self.engine) as session:
+            ingest_report(session, InventoryReport(hostname="PC-1"))
+            session.commit()
+            for command in ("Restart-Service Spooler", "Get-Date"):
+                create_command(1, CommandCreate(command=command), session)
+            claim_commands(session, machine_id=1, limit=1)
+        self.session_factory = lambda: Session(self.engine)
+
+    def cancel(self, command_id):
+        with Session(self.engine) as session:
+            return cancel_command(command_id, session)
+
+    def test_pending_cancelled_right_away(self):
+        with Session(self.engine) as session:
+            published = session.info[PENDING_KEY] = []
+            cmd = cancel_command(2, session)
+            self.assertEqual(cmd.status, "cancelled")
+            self.assertEqual([(e["type"], e["status"]) for e in published], [("command.completed", "cancelled")])
+            self.assertEqual(claim_commands(session, machine_id=1), [])
+            update_command_result(1, CommandUpdate(output="ok", status="completed"), session)
+        # Cancelling again is harmless, a finished command is left alone
+        self.assertEqual(self.cancel(2).status, "cancelled")
+        with self.assertRaises(HTTPException) as ctx:
+            self.cancel(1)
+        self.assertEqual(ctx.exception.status_code, 409)
+
+    async def test_running_cancel_wakes_agent_poll(self):
+        # No free slot: the agent only waits for cancellations
+        waiting = asyncio.create_task(wait_for_commands(self.session_factory, 10, hostname="PC-1", limit=0))
+        await asyncio.sleep(0.1)
+        self.assertFalse(waiting.done())
+        cmd = await asyncio.to_thread(self.cancel, 1)
+        self.assertEqual((cmd.status, cmd.cancel_requested), ("running", True))
+        self.assertEqual(await asyncio.wait_for(waiting, 2), ([], [1]))
+
+        with Session(self.engine) as session:
+            update_command_result(1, CommandUpdate(status="cancelled", duration_ms=1200, queue_depth=1), session)
+            cmd = session.get(Command, 1)
+            self.assertEqual((cmd.status, cmd.duration_ms, cmd.queue_depth), ("cancelled", 1200, 1))
+        self.assertEqual(await wait_for_commands(self.session_factory, 0, machine_id=1, limit=0), ([], []))
+
+    def test_expired_lease_of_cancelled_command(self):
+        self.cancel(1)
+        with Session(self.engine) as session:
+            later = datetime.utcnow() + timedelta(seconds=commands.COMMAND_LEASE_SECONDS + 1)
+            self.assertEqual(requeue_expired_leases(session, now=later), [1])
+            self.assertEqual(session.get(Command, 1).status, "cancelled")
+
+
+if __name__ == '__main__':
+    unittest.main()
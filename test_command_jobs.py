@@ -0,0 +1,97 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from fastapi import HTTPException, Response
+from sqlmodel import SQLModel, Session, create_engine
+
+from backend.catalog import catalog_cache
+from backend.commands import claim_commands, iter_job_progress
+from backend.inventory import ingest_chunk
+from backend.main import (CommandJobCreate, CommandUpdate, create_command_job, read_command_job,
+                          read_command_job_commands, update_command_result)
+from backend.models import InventoryReport, Command, CommandJob
+
+
+class TestCommandJobs(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # File database: the progress stream reads from a worker thread
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.tmpdir.name, 'jobs.db')}", connect_args={"check_same_thread": False})
+        self.addCleanup(self.engine.dispose)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        with Session(self.engine) as session:
+            ingest_chunk(session, [InventoryReport(hostname=f"PC-{i}", client_code="ACME") for i in range(1, 4)]
+                         + [InventoryReport(hostname="PC-4", client_code="GLOBEX")])
+
+    def create(self, **data):
+        with Session(self.engine) as session:
+            return create_command_job(CommandJobCreate(command="Restart-Service Spooler", **data), session)
+
+    def complete(self, command_id, status="completed"):
+        with Session(self.engine) as session:
+            # Results are only taken from the agent that claimed the command
+            machine_id = session.get(Command, command_id).machine_id
+            claim_commands(session, machine_id=machine_id)
+            update_command_result(command_id, CommandUpdate(output="ok", status=status), session)
+
+    def test_fan_out_by_selector(self):
+        job = self.create(client_code="ACME")
+        self.assertEqual((job["total"], job["pending"], job["done"]), (3, 3, False))
+        with Session(self.engine) as session:
+            commands = session.query(Command).order_by(Command.id).all()
+            self.assertEqual([(c.machine_id, c.job_id, c.status) for c in commands], [(1, 1, "pending"), (2, 1, "pending"), (3, 1, "pending")])
+            self.assertEqual(json.loads(session.get(CommandJob, 1).selector), {"client_code": "ACME"})
+
+            claimed = claim_commands(session, hostname="PC-1", client_code="ACME")
+            self.complete(claimed[0].id)
+            progress = read_command_job(job["id"], session)
+        self.assertEqual((progress["pending"], progress["running"], progress["completed"]), (2, 0, 1))
+
+        # Selector fields are combined
+        self.assertEqual(self.create(client_code="ACME", machine_ids=[2, 4])["total"], 1)
+
+    def test_selector_errors(self):
+        with self.assertRaises(HTTPException) as ctx:
+            self.create()
+        self.assertEqual(ctx.exception.status_code, 400)
+        with self.assertRaises(HTTPException) as ctx:
+            self.create(client_code="NOBODY")
+        self.assertEqual(ctx.exception.status_code, 404)
+
+    def test_commands_listing_pages(self):
+        job = self.create(hostname="PC-")
+        self.complete(2, status="error")
+        with Session(self.engine) as session:
+            response = Response()
+            page = read_command_job_commands(job["id"], response, status=None, cursor=None, limit=3, session=session)
+            self.assertEqual([row["hostname"] for row in page], ["PC-1", "PC-2", "PC-3"])
+            page = read_command_job_commands(job["id"], response, status=None, cursor=int(response.headers["x-next-cursor"]), limit=3, session=session)
+            self.assertEqual([row["hostname"] for row in page], ["PC-4"])
+            errors = read_command_job_commands(job["id"], Response(), status="error", cursor=None, limit=100, session=session)
+            self.assertEqual([(row["machine_id"], row["status"]) for row in errors], [(2, "error")])
+
+    async def test_progress_stream(self):
+        job = self.create(client_code="ACME")
+        stream = iter_job_progress(lambda: Session(self.engine), job["id"], interval=0.05)
+
+        async def next_progress():
+            chunk = await asyncio.wait_for(stream.__anext__(), 2)
+            return json.loads(chunk.split("data: ", 1)[1])
+
+        self.assertEqual((await next_progress())["pending"], 3)
+        for command_id in (1, 2, 3):
+            await asyncio.to_thread(self.complete, command_id, "error" if command_id == 3 else "completed")
+        last = await next_progress()
+        while not last["done"]:
+            last = await next_progress()
+        self.assertEqual((last["completed"], last["error"], last["done"]), (2, 1, True))
+        with self.assertRaises(StopAsyncIteration):
+            await stream.__anext__()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import unittest
+from datetime import datetime, timedelta
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.pool import StaticPool
+
+from backend import commands
+from backend.catalog import catalog_cache
+from backend.commands import claim_commands, requeue_expired_leases
+from backend.events import pending_events, PENDING_KEY
+from backend.inventory import ingest_report
+from backend.main import CommandCreate, CommandUpdate, create_command, update_command_result
+from backend.models import InventoryReport, Command
+
+
+class TestCommandLeases(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        with Session(self.engine) as session:
+            ingest_report(session, InventoryReport(hostname="PC-1"))
+            session.commit()
+            for command in ("hostname", "Get-Date"):
+                create_command(1, CommandCreate(command=command), session)
+
+    def test_claim_hands_out_each_command_once(self):
+        with Session(self.engine) as session:
+            claimed = claim_commands(session, hostname="PC-1")
+            self.assertEqual([(c.command, c.status, c.attempts) for c in claimed], [("hostname", "running", 1), ("Get-Date", "running", 1)])
+            self.assertIsNotNone(claimed[0].lease_expires_at)
+            # The next poll gets nothing while the lease runs
+            self.assertEqual(claim_commands(session, machine_id=1), [])
+
+            update_command_result(claimed[0].id, CommandUpdate(output="PC-1", status="completed"), session)
+            self.assertIsNone(session.get(Command, claimed[0].id).lease_expires_at)
+
+    def test_expired_lease_requeued_until_max_attempts(self):
+        with Session(self.engine) as session:
+            claim_commands(session, machine_id=1, limit=1)
+            later = datetime.utcnow() + timedelta(seconds=commands.COMMAND_LEASE_SECONDS + 1)
+            self.assertEqual(requeue_expired_leases(session, now=datetime.utcnow()), [])
+
+            published = session.info[PENDING_KEY] = []
+            self.assertEqual(requeue_expired_leases(session, now=later), [1])
+            self.assertEqual(session.get(Command, 1).status, "pending")
+            self.assertEqual([(e["type"], e["hostname"]) for e in published], [("command.queued", "PC-1")])
+
+            for attempt in (2, 3):
+                self.assertEqual([c.attempts for c in claim_commands(session, machine_id=1, limit=1)], [attempt])
+                requeue_expired_leases(session, now=later + timedelta(seconds=commands.COMMAND_LEASE_SECONDS * attempt))
+            session.expire_all()
+            command = session.get(Command, 1)
+            self.assertEqual((command.status, command.output), ("error", "No result received after 3 attempts"))
+            self.assertEqual(pending_events(session), [])
+
+    def test_postgres_claim_skips_locked_rows(self):
+        statement = commands.claim_statement(1, None, 5, datetime(2024, 1, 1))
+        sql = str(statement.compile(dialect=postgresql.dialect()))
+        self.assertIn("FOR UPDATE SKIP LOCKED", sql)
+        self.assertIn("RETURNING", sql)
+
+
+if __name__ == '__main__':
+    unittest.main()
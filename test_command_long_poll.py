@@ -0,0 +1,78 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from fastapi.testclient import TestClient
+from sqlmodel import SQLModel, Session, create_engine
+
+from backend.catalog import catalog_cache
+from backend.commands import COMMAND_CLAIM_LIMIT, wait_for_commands
+from backend.database import get_session_factory
+from backend.inventory import ingest_report
+from backend.main import app, CommandCreate, ServiceAction, create_command, control_service
+from backend.models import InventoryReport
+
+
+class TestCommandLongPoll(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # File database: the parked request and the writer run in different threads, each with its own connection
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.tmpdir.name, 'commands.db')}", connect_args={"check_same_thread": False})
+        self.addCleanup(self.engine.dispose)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        with Session(self.engine) as session:
+            ingest_report(session, InventoryReport(hostname="PC-1"))
+            ingest_report(session, InventoryReport(hostname="PC-2"))
+            session.commit()
+        self.session_factory = lambda: Session(self.engine)
+
+    def queue(self, machine_id, command):
+        with Session(self.engine) as session:
+            return create_command(machine_id, CommandCreate(command=command), session)
+
+    async def test_parked_request_woken_by_new_command(self):
+        started = time.monotonic()
+        waiting = asyncio.create_task(wait_for_commands(self.session_factory, 10, hostname="PC-1"))
+        await asyncio.sleep(0.1)
+        # Another machine's command does not answer the request
+        await asyncio.to_thread(self.queue, 2, "hostname")
+        await asyncio.sleep(0.1)
+        self.assertFalse(waiting.done())
+
+        await asyncio.to_thread(self.queue, 1, "Get-Date")
+        commands, _ = await asyncio.wait_for(waiting, 2)
+        self.assertEqual([c.command for c in commands], ["Get-Date"])
+        self.assertLess(time.monotonic() - started, 2)
+
+    async def test_pending_returned_immediately(self):
+        with Session(self.engine) as session:
+            control_service(1, "Spooler", ServiceAction(action="restart"), session)
+        commands, _ = await asyncio.wait_for(wait_for_commands(self.session_factory, 10, machine_id=1), 1)
+        self.assertEqual([c.command for c in commands], ["Restart-Service -Name 'Spooler' -Force"])
+
+    async def test_timeout(self):
+        started = time.monotonic()
+        self.assertEqual(await wait_for_commands(self.session_factory, 0.2, hostname="PC-1"), ([], []))
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        # wait=0 is a plain poll
+        self.assertEqual(await wait_for_commands(self.session_factory, 0, hostname="UNKNOWN"), ([], []))
+
+
+    def test_more_free_slots_than_claim_limit(self):
+        for n in range(COMMAND_CLAIM_LIMIT + 1):
+            self.queue(1, f"echo {n}")
+        app.dependency_overrides[get_session_factory] = lambda: self.session_factory
+        self.addCleanup(app.dependency_overrides.clear)
+        client = TestClient(app)
+        # An agent with many workers asks for more than the server hands out: clamped, not rejected
+        first = client.get("/api/commands/pending", params={"hostname": "PC-1", "limit": COMMAND_CLAIM_LIMIT + 3})
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(len(first.json()), COMMAND_CLAIM_LIMIT)
+        rest = client.get("/api/machines/1/commands/pending", params={"limit": COMMAND_CLAIM_LIMIT + 3})
+        self.assertEqual([c["command"] for c in rest.json()], [f"echo {COMMAND_CLAIM_LIMIT}"])
+
+if __name__ == '__main__':
+    unittest.main()
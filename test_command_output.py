@@ -0,0 +1,118 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from fastapi import HTTPException
+from sqlmodel import SQLModel, Session, create_engine
+
+from backend import commands
+from backend.catalog import catalog_cache
+from backend.commands import claim_commands, load_command, read_output, requeue_expired_leases, wait_for_output
+from backend.inventory import ingest_report
+from backend.main import (CommandCreate, CommandOutputAppend, CommandUpdate, append_command_output, create_command,
+                          get_command_status, update_command_result)
+from backend.models import InventoryReport, Command, CommandOutputChunk
+
+
+class TestCommandOutput(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # File database: the tail is read from a worker thread while the test appends
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.tmpdir.name, 'output.db')}", connect_args={"check_same_thread": False})
+        self.addCleanup(self.engine.dispose)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        with Session(self.engine) as session:
+            ingest_report(session, InventoryReport(hostname="PC-1"))
+            session.commit()
+            create_command(1, CommandCreate(command="Get-ChildItem"), session)
+            claim_commands(session, machine_id=1)
+
+    def append(self, offset, data, attempt=1):
+        with Session(self.engine) as session:
+            return append_command_output(1, CommandOutputAppend(attempt=attempt, offset=offset, data=data), session)
+
+    def tail(self, offset=0, limit=commands.COMMAND_OUTPUT_CHUNK_MAX_BYTES):
+        with Session(self.engine) as session:
+            return read_output(session, 1, offset, limit)
+
+    def test_chunks_in_order_and_tail(self):
+        self.assertEqual(self.append(0, "Ação\n"), {"size": 7, "truncated": False})
+        self.assertEqual(self.append(7, "PC-1\n")["size"], 12)
+        # A retried chunk is acknowledged once, a gap is refused
+        self.assertEqual(self.append(7, "PC-1\n")["size"], 12)
+        with self.assertRaises(HTTPException) as ctx:
+            self.append(20, "lost")
+        self.assertEqual(ctx.exception.status_code, 409)
+
+        tail = self.tail()
+        self.assertEqual((tail["data"], tail["offset"], tail["done"]), ("Ação\nPC-1\n", 12, False))
+        self.assertEqual(self.tail(offset=7)["data"], "PC-1\n")
+        # The limit is a hard bound inside a chunk, characters are never split
+        self.assertEqual(self.tail(limit=8)["data"], "Ação\nP")
+        self.assertEqual((self.tail(limit=3)["data"], self.tail(limit=3)["offset"]), ("Aç", 3))
+        self.assertEqual(self.tail(offset=1, limit=1)["data"], "ç")
+
+        with Session(self.engine) as session:
+            self.assertEqual(update_command_result(1, CommandUpdate(status="completed"), session).output, "Ação\nPC-1\n")
+            # The chunks are the one stored copy, GET /api/commands/{id} and /wait join them
+            self.assertIsNone(session.get(Command, 1).output)
+            self.assertEqual(session.query(CommandOutputChunk).count(), 2)
+            self.assertEqual(get_command_status(1, session).output, "Ação\nPC-1\n")
+        self.assertEqual(load_command(lambda: Session(self.engine), 1).output, "Ação\nPC-1\n")
+        tail = self.tail(offset=12)
+        self.assertEqual((tail["data"], tail["status"], tail["done"]), ("", "completed", True))
+
+    def test_output_capped(self):
+        commands.COMMAND_OUTPUT_MAX_BYTES, max_bytes = 8, commands.COMMAND_OUTPUT_MAX_BYTES
+        try:
+            self.append(0, "12345")
+            # Cut on a character boundary, later chunks are dropped
+            self.assertEqual(self.append(5, "67çç"), {"size": 7, "truncated": True})
+            self.assertEqual(self.append(12, "more")["size"], 7)
+        finally:
+            commands.COMMAND_OUTPUT_MAX_BYTES = max_bytes
+        tail = self.tail()
+        self.assertEqual((tail["data"], tail["truncated"]), ("1234567", True))
+
+    def test_new_attempt_and_whole_result(self):
+        self.append(0, "first try")
+        with Session(self.engine) as session:
+            requeue_expired_leases(session, now=datetime.utcnow() + timedelta(seconds=commands.COMMAND_LEASE_SECONDS + 1))
+            claim_commands(session, machine_id=1)
+        # The lost agent's output no longer lands
+        with self.assertRaises(HTTPException) as ctx:
+            self.append(9, " more", attempt=1)
+        self.assertEqual(ctx.exception.status_code, 409)
+        self.assertEqual(self.tail()["data"], "")
+        self.append(0, "second", attempt=2)
+        self.assertEqual(self.tail()["data"], "second")
+
+        # The lost agent's result is refused as well
+        with Session(self.engine) as session:
+            with self.assertRaises(HTTPException) as ctx:
+                update_command_result(1, CommandUpdate(attempt=1, status="completed"), session)
+            self.assertEqual(ctx.exception.status_code, 409)
+
+        # Agents without streaming post the whole output with the result
+        with Session(self.engine) as session:
+            update_command_result(1, CommandUpdate(output="whole", attempt=2, status="completed"), session)
+            # It replaces the streamed chunks of every attempt
+            self.assertEqual(session.query(CommandOutputChunk).count(), 0)
+        self.assertEqual(self.tail()["data"], "whole")
+        self.assertEqual(self.tail(offset=2, limit=2)["data"], "ol")
+
+    async def test_tail_woken_by_append(self):
+        session_factory = lambda: Session(self.engine)
+        waiting = asyncio.create_task(wait_for_output(session_factory, 1, 0, wait=10))
+        await asyncio.sleep(0.1)
+        self.assertFalse(waiting.done())
+        await asyncio.to_thread(self.append, 0, "line\n")
+        tail = await asyncio.wait_for(waiting, 2)
+        self.assertEqual((tail["data"], tail["offset"]), ("line\n", 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
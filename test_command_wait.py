@@ -0,0 +1,57 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from fastapi import HTTPException
+from sqlmodel import SQLModel, Session, create_engine
+
+from backend.catalog import catalog_cache
+from backend.commands import claim_commands
+from backend.inventory import ingest_report
+from backend.main import CommandCreate, CommandUpdate, create_command, update_command_result, wait_command_result
+from backend.models import InventoryReport
+
+
+class TestCommandWait(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # File database: the result is read from a worker thread while the test writes
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.engine = create_engine(f"sqlite:///{os.path.join(self.tmpdir.name, 'wait.db')}", connect_args={"check_same_thread": False})
+        self.addCleanup(self.engine.dispose)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        with Session(self.engine) as session:
+            ingest_report(session, InventoryReport(hostname="PC-1"))
+            session.commit()
+            self.command_id = create_command(1, CommandCreate(command="hostname"), session).id
+
+    def wait(self, command_id, timeout):
+        return wait_command_result(command_id, timeout=timeout, session_factory=lambda: Session(self.engine))
+
+    def complete(self):
+        with Session(self.engine) as session:
+            claim_commands(session, machine_id=1)
+            update_command_result(self.command_id, CommandUpdate(output="PC-1", status="completed"), session)
+
+    async def test_wakes_on_result(self):
+        waiting = asyncio.create_task(self.wait(self.command_id, 10))
+        await asyncio.sleep(0.1)
+        self.assertFalse(waiting.done())
+        await asyncio.to_thread(self.complete)
+        cmd = await asyncio.wait_for(waiting, 2)
+        self.assertEqual((cmd.status, cmd.output), ("completed", "PC-1"))
+        # Already finished: answered without waiting
+        cmd = await asyncio.wait_for(self.wait(self.command_id, 10), 2)
+        self.assertEqual(cmd.status, "completed")
+
+    async def test_timeout_and_missing(self):
+        cmd = await self.wait(self.command_id, 0.1)
+        self.assertEqual(cmd.status, "pending")
+        with self.assertRaises(HTTPException) as ctx:
+            await self.wait(999, 0.1)
+        self.assertEqual(ctx.exception.status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import unittest
+from fastapi import Request, Response
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy.pool import StaticPool
+
+from backend.catalog import catalog_cache
+from backend.changes import current_change_seq
+from backend.inventory import ingest_report, apply_heartbeat
+from backend.main import read_machine, read_machines
+from backend.models import InventoryReport, Heartbeat, Machine
+
+
+def make_request(path, etag=None):
+    headers = [(b"if-none-match", etag.encode())] if etag else []
+    return Request({"type": "http", "method": "GET", "path": path, "query_string": b"", "headers": headers,
+                    "scheme": "http", "server": ("testserver", 80)})
+
+
+class TestConditionalGet(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        with Session(self.engine) as session:
+            ingest_report(session, InventoryReport(hostname="PC-1", softwares=[{"name": "Chrome"}]))
+            ingest_report(session, InventoryReport(hostname="PC-2"))
+            session.commit()
+
+    def get_machine(self, session, etag=None):
+        response = Response()
+        result = read_machine(1, make_request("/api/machines/1", etag), response, session)
+        return result if isinstance(result, Response) else response
+
+    def test_writes_bump_change_seq(self):
+        with Session(self.engine) as session:
+            self.assertEqual(current_change_seq(session), 1)
+            self.assertEqual(session.get(Machine, 1).change_seq, 1)
+
+            apply_heartbeat(session, Heartbeat(hostname="PC-2", cpu_usage=5))
+            session.commit()
+            self.assertEqual(current_change_seq(session), 2)
+            self.assertEqual(session.get(Machine, 1).change_seq, 1)
+            self.assertEqual(session.get(Machine, 2).change_seq, 2)
+
+            # Rolled back writes don't consume a sequence value
+            apply_heartbeat(session, Heartbeat(hostname="PC-2", cpu_usage=6))
+            session.rollback()
+            self.assertEqual(current_change_seq(session), 2)
+
+    def test_machine_detail_304(self):
+        with Session(self.engine) as session:
+            etag = self.get_machine(session).headers["etag"]
+            self.assertEqual(self.get_machine(session, etag).status_code, 304)
+
+            # Another machine changing keeps this one's ETag
+            apply_heartbeat(session, Heartbeat(hostname="PC-2", cpu_usage=5))
+            session.commit()
+            self.assertEqual(self.get_machine(session, etag).status_code, 304)
+
+            apply_heartbeat(session, Heartbeat(hostname="PC-1", cpu_usage=5))
+            session.commit()
+            response = self.get_machine(session, etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers["etag"], etag)
+
+    def list_machines(self, session, etag=None):
+        response = Response()
+        result = read_machines(
+            make_request("/api/machines", etag), response, client_code=None, status=None, os_info=None, hostname=None,
+            seen_after=None, seen_before=None, sort="hostname", cursor=None, limit=100, embed=None, session=session
+        )
+        return result, response
+
+    def test_machine_list_304(self):
+        with Session(self.engine) as session:
+            _, response = self.list_machines(session)
+            etag = response.headers["etag"]
+            result, _ = self.list_machines(session, etag)
+            self.assertEqual(result.status_code, 304)
+
+            ingest_report(session, InventoryReport(hostname="PC-3"))
+            session.commit()
+            result, response = self.list_machines(session, etag)
+            self.assertEqual(len(result), 3)
+            self.assertNotEqual(response.headers["etag"], etag)
+
+
+if __name__ == '__main__':
+    unittest.main()
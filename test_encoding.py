@@ -0,0 +1,84 @@
+import asyncio
+import gzip
+import json
+import unittest
+
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from backend import encoding
+
+
+def make_request(body, headers):
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/api/inventory",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return Request(scope, receive)
+
+
+class TestRequestDecoding(unittest.TestCase):
+    def test_gzip_body_is_decoded(self):
+        payload = {"hostname": "TEST-PC"}
+        request = make_request(gzip.compress(json.dumps(payload).encode()), {"Content-Encoding": "gzip", "Content-Type": "application/json"})
+        decoded = asyncio.run(encoding.decode_request(request))
+        self.assertEqual(json.loads(asyncio.run(decoded.body())), payload)
+        self.assertNotIn("content-encoding", decoded.headers)
+
+    def test_decompression_bomb_is_rejected(self):
+        request = make_request(gzip.compress(b" " * (encoding.MAX_DECODED_BODY_BYTES + 1)), {"Content-Encoding": "gzip"})
+        with self.assertRaises(HTTPException) as ctx:
+            asyncio.run(encoding.decode_request(request))
+        self.assertEqual(ctx.exception.status_code, 413)
+
+    def test_uncompressed_body_has_the_same_cap(self):
+        request = make_request(b" " * (encoding.MAX_DECODED_BODY_BYTES + 1), {"Content-Type": "application/json"})
+        with self.assertRaises(HTTPException) as ctx:
+            asyncio.run(encoding.decode_request(request))
+        self.assertEqual(ctx.exception.status_code, 413)
+
+    def test_chunked_body_capped_while_read(self):
+        max_bytes, encoding.MAX_DECODED_BODY_BYTES = encoding.MAX_DECODED_BODY_BYTES, 1024
+        received = []
+
+        async def receive():
+            # An endless chunked upload without Content-Length
+            received.append(1)
+            return {"type": "http.request", "body": b" " * 512, "more_body": True}
+        try:
+            request = Request({"type": "http", "method": "POST", "path": "/api/inventory", "headers": []}, receive)
+            with self.assertRaises(HTTPException) as ctx:
+                asyncio.run(encoding.decode_request(request))
+        finally:
+            encoding.MAX_DECODED_BODY_BYTES = max_bytes
+        self.assertEqual(ctx.exception.status_code, 413)
+        self.assertEqual(len(received), 3)
+
+    def test_stream_is_not_capped_in_total(self):
+        max_bytes, encoding.MAX_DECODED_BODY_BYTES = encoding.MAX_DECODED_BODY_BYTES, 1024
+        try:
+            lines = b"".join(json.dumps({"hostname": f"PC-{i}"}).encode() + b"\n" for i in range(1000))
+            request = make_request(gzip.compress(lines), {"Content-Encoding": "gzip"})
+
+            async def decode():
+                return b"".join([piece async for piece in encoding.iter_decoded_stream(request)])
+            self.assertEqual(asyncio.run(decode()), lines)
+        finally:
+            encoding.MAX_DECODED_BODY_BYTES = max_bytes
+
+    def test_unknown_encoding_is_415(self):
+        request = make_request(b"xx", {"Content-Encoding": "br"})
+        with self.assertRaises(HTTPException) as ctx:
+            asyncio.run(encoding.decode_request(request))
+        self.assertEqual(ctx.exception.status_code, 415)
+        self.assertIn("gzip", ctx.exception.headers["Accept-Encoding"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import unittest
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy.pool import StaticPool
+
+from backend.catalog import catalog_cache
+from backend.events import broker, event_filter, format_sse, notify_payloads, LocalBroker, RESYNC_EVENT
+from backend.inventory import ingest_report, apply_heartbeat
+from backend.main import CommandUpdate, update_command_result
+from backend.models import InventoryReport, Heartbeat, Command
+
+
+class TestEvents(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        # Tests run without DATABASE_URL: the in-process broker
+        self.assertIsInstance(broker, LocalBroker)
+
+    async def drain(self, subscription):
+        events = []
+        while (data := await subscription.get(0.05)) is not None:
+            events.append(data)
+        return events
+
+    async def test_machine_events_published_on_commit(self):
+        subscription = broker.subscribe(event_filter(client_code="ACME"))
+        try:
+            with Session(self.engine) as session:
+                ingest_report(session, InventoryReport(hostname="PC-1", client_code="ACME", disk_usage=10))
+                ingest_report(session, InventoryReport(hostname="PC-2", client_code="GLOBEX"))
+                self.assertEqual(await self.drain(subscription), [])
+                session.commit()
+            created = await self.drain(subscription)
+            self.assertEqual([(e["type"], e["hostname"]) for e in created], [("machine.created", "PC-1")])
+
+            with Session(self.engine) as session:
+                # Rolled back: nothing is published
+                apply_heartbeat(session, Heartbeat(hostname="PC-1", client_code="ACME", disk_usage=95))
+                session.rollback()
+                self.assertEqual(await self.drain(subscription), [])
+
+                apply_heartbeat(session, Heartbeat(hostname="PC-1", client_code="ACME", disk_usage=95))
+                session.commit()
+            events = await self.drain(subscription)
+            self.assertEqual([e["type"] for e in events], ["machine.updated", "machine.status"])
+            self.assertEqual((events[1]["previous_status"], events[1]["status"]), ("online", "critical"))
+        finally:
+            subscription.close()
+
+    async def test_command_completed(self):
+        subscription = broker.subscribe(event_filter(types=["command.completed"]))
+        try:
+            with Session(self.engine) as session:
+                ingest_report(session, InventoryReport(hostname="PC-1", client_code="ACME"))
+                session.add(Command(machine_id=1, command="hostname", status="running", attempts=1))
+                session.commit()
+                update_command_result(1, CommandUpdate(output="PC-1", status="completed"), session)
+            events = await self.drain(subscription)
+            self.assertEqual(events, [{"type": "command.completed", "command_id": 1, "machine_id": 1, "job_id": None,
+                                       "client_code": "ACME", "status": "completed"}])
+        finally:
+            subscription.close()
+
+    async def test_slow_subscriber_gets_resync(self):
+        local = LocalBroker(queue_size=2)
+        subscription = local.subscribe()
+        local.publish([{"type": "machine.updated", "machine_id": i} for i in range(3)])
+        self.assertEqual(await self.drain(subscription), [RESYNC_EVENT])
+        self.assertEqual(format_sse(RESYNC_EVENT), 'event: resync\ndata: {"type": "resync"}\n\n')
+
+    def test_notify_payloads_fit_postgres_limit(self):
+        events = [{"type": "machine.updated", "hostname": "x" * 1000} for _ in range(20)]
+        payloads = list(notify_payloads(events))
+        self.assertGreater(len(payloads), 1)
+        self.assertTrue(all(len(p.encode("utf-8")) <= 7500 for p in payloads))
+        self.assertEqual(sum(len(json.loads(p)) for p in payloads), 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import unittest
+from datetime import datetime
+from typing import List
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy import update
+from sqlalchemy.pool import StaticPool
+
+from backend import responses
+from backend.catalog import catalog_cache
+from backend.inventory import ingest_chunk
+from backend.machines import list_machines, machine_detail
+from backend.models import InventoryReport, Machine, MachineRead, MachineSummary
+from backend.responses import FastJSONResponse
+
+
+def slow_json(content):
+    # What FastAPI sends for a response_model / JSONResponse
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"))
+
+
+class TestFastJson(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        reports = [
+            InventoryReport(hostname="PC-1", client_code="ACME", ram_gb=16, cpu_usage=12.5, os_info="Windows 11 Pro – PT-BR", softwares=[
+                {"name": "Chrome", "version": "120", "publisher": "Google"},
+                {"name": "7-Zip", "version": None, "publisher": None},
+            ], services=[{"name": "Spooler", "display_name": "Print Spooler", "status": "running", "start_type": "auto"}]),
+            InventoryReport(hostname="PC-2", client_code="ACME"),
+        ]
+        with Session(self.engine) as session:
+            ingest_chunk(session, reports)
+            session.execute(update(Machine).where(Machine.id == 2).values(last_seen=datetime(2024, 1, 1)))
+            session.commit()
+
+    def test_summary_list(self):
+        with Session(self.engine) as session:
+            items, _ = list_machines(session, fast=True)
+        expected = TypeAdapter(List[MachineSummary]).dump_python(items, mode="json")
+        self.assertEqual(FastJSONResponse(items).body.decode("utf-8"), slow_json(expected))
+
+    def test_embed_list_and_detail(self):
+        with Session(self.engine) as session:
+            slow, _ = list_machines(session, embed="softwares,services")
+            fast, _ = list_machines(session, embed="softwares,services", fast=True)
+            detail = machine_detail(session, 1)
+            orm = session.get(Machine, 1)
+            expected_detail = TypeAdapter(MachineRead).dump_python(MachineRead.model_validate(orm), mode="json")
+        for machine in slow:
+            # Same children, fast path lists them by id
+            machine["softwares"].sort(key=lambda s: s["id"])
+        self.assertEqual(FastJSONResponse(fast).body.decode("utf-8"), slow_json(jsonable_encoder(slow)))
+        expected_detail["softwares"].sort(key=lambda s: s["id"])
+        self.assertEqual(FastJSONResponse(detail).body.decode("utf-8"), slow_json(expected_detail))
+
+        with Session(self.engine) as session:
+            fast, _ = list_machines(session, embed="services", fast=True)
+        self.assertNotIn("softwares", fast[0])
+        self.assertEqual(fast[1]["services"], [])
+
+    def test_stdlib_fallback(self):
+        items = [{"last_seen": datetime(2024, 1, 1, 12, 30, 0, 5), "name": "Ação"}]
+        with_orjson = FastJSONResponse(items).body
+        responses.orjson, orjson = None, responses.orjson
+        try:
+            self.assertEqual(FastJSONResponse(items).body, with_orjson)
+        finally:
+            responses.orjson = orjson
+
+
+if __name__ == '__main__':
+    unittest.main()
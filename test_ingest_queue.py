@@ -0,0 +1,49 @@
+import unittest
+from sqlmodel import SQLModel, Session, create_engine, select
+from sqlalchemy.pool import StaticPool
+
+from backend.ingest_queue import IngestQueue
+from backend.catalog import catalog_cache
+from backend.models import InventoryReport, Machine, MachineSoftware
+
+
+class TestIngestQueue(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        self.queue = IngestQueue(lambda: Session(self.engine), max_size=2, batch_size=10, workers=1)
+
+    def test_reports_for_same_host_are_coalesced(self):
+        first = InventoryReport(hostname="PC-1", cpu_usage=10, softwares=[{"name": "Chrome", "version": "120", "publisher": "Google"}], softwares_hash="abc")
+        second = InventoryReport(hostname="PC-1", cpu_usage=20, softwares_hash="abc")
+        self.queue.put(first)
+        merged = self.queue.put(second)
+
+        # Latest metrics win, the software list of the older report is kept
+        self.assertEqual(merged.cpu_usage, 20)
+        self.assertEqual(len(merged.softwares), 1)
+        self.assertEqual(self.queue.stats()["depth"], 1)
+        self.assertEqual(self.queue.stats()["coalesced"], 1)
+
+        self.queue.start()
+        self.queue.stop()
+        with Session(self.engine) as session:
+            machine = session.exec(select(Machine)).one()
+            self.assertEqual(machine.cpu_usage, 20)
+            self.assertEqual(len(session.exec(select(MachineSoftware)).all()), 1)
+        self.assertEqual(self.queue.stats()["processed"], 1)
+
+    def test_full_queue_rejects(self):
+        self.assertIsNotNone(self.queue.put(InventoryReport(hostname="PC-1")))
+        self.assertIsNotNone(self.queue.put(InventoryReport(hostname="PC-2")))
+        self.assertIsNone(self.queue.put(InventoryReport(hostname="PC-3")))
+        # Same host still coalesces when full, the same hostname of another client does not
+        self.assertIsNotNone(self.queue.put(InventoryReport(hostname="PC-1")))
+        self.assertIsNone(self.queue.put(InventoryReport(hostname="PC-1", client_code="GLOBEX")))
+        self.assertEqual(self.queue.stats()["rejected"], 2)
+        self.assertGreaterEqual(self.queue.retry_after(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import csv
+import io
+import json
+import unittest
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy.pool import StaticPool
+
+from backend import export
+from backend.catalog import catalog_cache
+from backend.export import iter_inventory_csv, iter_inventory_ndjson, CSV_HEADER
+from backend.inventory import ingest_chunk
+from backend.machines import machine_filters
+from backend.models import InventoryReport
+
+
+class TestInventoryExport(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        reports = [
+            InventoryReport(hostname="PC-1", client_code="ACME", softwares=[
+                {"name": "Chrome", "version": "120", "publisher": "Google"},
+                {"name": "Notepad++, \"portable\"", "version": "8.6", "publisher": None},
+            ]),
+            InventoryReport(hostname="PC-2", client_code="ACME", softwares=[]),
+            InventoryReport(hostname="PC-3", client_code="GLOBEX", softwares=[{"name": "Chrome", "version": "121", "publisher": "Google"}]),
+        ]
+        with Session(self.engine) as session:
+            ingest_chunk(session, reports)
+        self.session_factory = lambda: Session(self.engine)
+
+    def test_csv_rows(self):
+        chunks = iter_inventory_csv(self.session_factory, machine_filters(client_code="ACME"))
+        # The header goes out before the database is even queried
+        self.assertEqual(next(chunks), ",".join(CSV_HEADER) + "\r\n")
+        rows = list(csv.reader(io.StringIO("".join(chunks))))
+        self.assertEqual([(r[1], r[7]) for r in rows], [("PC-1", "Chrome"), ("PC-1", 'Notepad++, "portable"'), ("PC-2", "")])
+
+    def test_ndjson_groups_softwares_per_machine(self):
+        export.EXPORT_BATCH_SIZE, batch_size = 1, export.EXPORT_BATCH_SIZE
+        try:
+            lines = "".join(iter_inventory_ndjson(self.session_factory, [])).splitlines()
+        finally:
+            export.EXPORT_BATCH_SIZE = batch_size
+        machines = [json.loads(line) for line in lines]
+        self.assertEqual([m["hostname"] for m in machines], ["PC-1", "PC-2", "PC-3"])
+        self.assertEqual([s["name"] for s in machines[0]["softwares"]], ["Chrome", 'Notepad++, "portable"'])
+        self.assertEqual(machines[1]["softwares"], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
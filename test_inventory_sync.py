@@ -0,0 +1,185 @@
+import unittest
+from fastapi import Response
+from starlette.requests import Request
+from sqlmodel import SQLModel, Session, create_engine, select
+from sqlalchemy.pool import StaticPool
+
+import asyncio
+import json
+
+from backend import inventory
+from backend.main import create_inventory, create_inventory_batch, create_inventory_stream
+from backend.inventory import ingest_chunk, iter_ndjson_reports
+from backend.models import Machine
+from backend.catalog import catalog_cache
+from backend.models import InventoryReport, MachineSoftware, Service, SoftwareCatalog
+
+
+def make_report(softwares, services):
+    return InventoryReport(
+        hostname="TEST-PC",
+        client_code="TEST",
+        ip_address="127.0.0.1",
+        os_info="Windows 10",
+        processor="Intel",
+        ram_gb=16,
+        disk_gb=512,
+        softwares=softwares,
+        services=services
+    )
+
+
+class TestInventorySync(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+
+    def test_unchanged_rows_are_kept(self):
+        softwares = [
+            {"name": "Chrome", "version": "120", "publisher": "Google"},
+            {"name": "7-Zip", "version": "23.01", "publisher": "Igor Pavlov"},
+        ]
+        services = [{"name": "Spooler", "display_name": "Print Spooler", "status": "running", "start_type": "automatic"}]
+
+        with Session(self.engine) as session:
+            create_inventory(make_report(softwares, services), Response(), session)
+        with Session(self.engine) as session:
+            ids_before = {s.name: s.id for s in session.exec(select(MachineSoftware)).all()}
+
+        # Chrome upgraded, 7-Zip unchanged, service stopped
+        softwares[0] = {"name": "Chrome", "version": "121", "publisher": "Google"}
+        services[0]["status"] = "stopped"
+        with Session(self.engine) as session:
+            create_inventory(make_report(softwares, services), Response(), session)
+
+        with Session(self.engine) as session:
+            rows = session.exec(select(MachineSoftware)).all()
+            self.assertEqual(sorted((s.name, s.version) for s in rows), [("7-Zip", "23.01"), ("Chrome", "121")])
+            ids_after = {s.name: s.id for s in rows}
+            self.assertEqual(ids_after["7-Zip"], ids_before["7-Zip"])
+            self.assertNotEqual(ids_after["Chrome"], ids_before["Chrome"])
+
+            svc = session.exec(select(Service)).one()
+            self.assertEqual(svc.status, "stopped")
+
+    def test_catalog_entries_are_shared(self):
+        softwares = [{"name": "Chrome", "version": "120", "publisher": "Google"}]
+        for hostname in ("PC-1", "PC-2"):
+            report = make_report(softwares, [])
+            report.hostname = hostname
+            with Session(self.engine) as session:
+                create_inventory(report, Response(), session)
+        with Session(self.engine) as session:
+            self.assertEqual(len(session.exec(select(SoftwareCatalog)).all()), 1)
+            links = session.exec(select(MachineSoftware)).all()
+            self.assertEqual(len(links), 2)
+            self.assertEqual(links[0].name, "Chrome")
+
+    def test_removed_rows_are_deleted(self):
+        softwares = [{"name": "Chrome", "version": "120", "publisher": "Google"}]
+        services = [{"name": "Spooler", "display_name": "Print Spooler", "status": "running", "start_type": "automatic"}]
+        with Session(self.engine) as session:
+            create_inventory(make_report(softwares, services), Response(), session)
+        with Session(self.engine) as session:
+            create_inventory(make_report([], []), Response(), session)
+        with Session(self.engine) as session:
+            self.assertEqual(session.exec(select(MachineSoftware)).all(), [])
+            self.assertEqual(session.exec(select(Service)).all(), [])
+
+    def test_fingerprinted_sections_are_skipped(self):
+        softwares = [{"name": "Chrome", "version": "120", "publisher": "Google"}]
+        report = make_report(softwares, [])
+        report.softwares_hash = "abc"
+        with Session(self.engine) as session:
+            create_inventory(report, Response(), session)
+
+        # Same fingerprint, section omitted: nothing to resend, rows untouched
+        report = make_report(None, [])
+        report.softwares_hash = "abc"
+        response = Response()
+        with Session(self.engine) as session:
+            create_inventory(report, response, session)
+        self.assertNotIn("X-Inventory-Resend", response.headers)
+        with Session(self.engine) as session:
+            self.assertEqual(len(session.exec(select(MachineSoftware)).all()), 1)
+
+        # Unknown fingerprint without the section: server asks for it
+        report = make_report(None, [])
+        report.softwares_hash = "def"
+        response = Response()
+        with Session(self.engine) as session:
+            create_inventory(report, response, session)
+        self.assertEqual(response.headers["X-Inventory-Resend"], "softwares")
+
+    def test_batch_commits_per_host_results(self):
+        reports = [make_report([], []) for _ in range(3)]
+        for i, report in enumerate(reports):
+            report.hostname = f"PC-{i}"
+        with Session(self.engine) as session:
+            results = create_inventory_batch(reports, chunk_size=2, session=session)
+        self.assertEqual([r["status"] for r in results], ["ok", "ok", "ok"])
+        with Session(self.engine) as session:
+            self.assertEqual(len(session.exec(select(Machine)).all()), 3)
+
+    def test_ndjson_stream_reports_bad_lines(self):
+        lines = [
+            json.dumps(make_report([], []).model_dump()),
+            "{not json",
+            json.dumps({"ip_address": "1.2.3.4"}),
+        ]
+        body = ("\n".join(lines) + "\n").encode()
+
+        async def stream():
+            # Split across network chunks in the middle of a line
+            yield body[:10]
+            yield body[10:]
+
+        async def collect():
+            return [item async for item in iter_ndjson_reports(stream())]
+
+        report, *errors = asyncio.run(collect())
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(errors[0]["detail"].startswith("line 2"))
+
+        with Session(self.engine) as session:
+            results = ingest_chunk(session, [report])
+        self.assertEqual(results[0]["status"], "ok")
+
+    def test_ndjson_stream_results_in_input_order(self):
+        second = make_report([], [])
+        second.hostname = "PC-2"
+        lines = [make_report([], []).model_dump_json(), "{not json", second.model_dump_json()]
+        body = ("\n".join(lines) + "\n").encode()
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+        request = Request({"type": "http", "method": "POST", "path": "/api/inventory/stream", "headers": []}, receive)
+        with Session(self.engine) as session:
+            results = asyncio.run(create_inventory_stream(request, chunk_size=None, session=session))
+        self.assertEqual([(r.get("hostname"), r["status"]) for r in results], [("TEST-PC", "ok"), (None, "error"), ("PC-2", "ok")])
+
+    def test_ndjson_oversized_line_in_many_chunks(self):
+        report = json.dumps(make_report([], []).model_dump()).encode()
+
+        async def stream():
+            yield report + b"\n" + b"x" * 6
+            for _ in range(5):
+                yield b"x" * 6
+            yield b"x\n" + report + b"\n"
+
+        async def collect():
+            return [item async for item in iter_ndjson_reports(stream())]
+
+        inventory.MAX_NDJSON_LINE_BYTES, max_bytes = 10, inventory.MAX_NDJSON_LINE_BYTES
+        try:
+            items = asyncio.run(collect())
+        finally:
+            inventory.MAX_NDJSON_LINE_BYTES = max_bytes
+        # One error for line 2, the reports around it keep their place
+        self.assertEqual(len(items), 3)
+        self.assertEqual(items[1]["detail"], "line 2: exceeds 10 bytes")
+        self.assertEqual([type(item) for item in (items[0], items[2])], [InventoryReport, InventoryReport])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+from datetime import datetime, timedelta
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy.pool import StaticPool
+
+from backend.catalog import catalog_cache
+from backend.inventory import ingest_chunk
+from backend.machines import list_machines
+from backend.models import InventoryReport, Machine
+
+
+class TestMachineListing(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        reports = [
+            InventoryReport(hostname=f"PC-{i:02d}", client_code="ACME" if i % 2 else "GLOBEX", os_info="Windows 11",
+                            cpu_usage=i, disk_usage=95 if i == 3 else 50,
+                            softwares=[{"name": "Chrome", "version": "120", "publisher": "Google"}],
+                            services=[{"name": "Spooler", "status": "running"}])
+            for i in range(10)
+        ]
+        with Session(self.engine) as session:
+            ingest_chunk(session, reports)
+
+    def test_summary_has_no_collections(self):
+        with Session(self.engine) as session:
+            items, next_cursor = list_machines(session)
+        self.assertEqual(len(items), 10)
+        self.assertIsNone(next_cursor)
+        self.assertEqual(items[0]["hostname"], "PC-00")
+        self.assertNotIn("softwares", items[0])
+        self.assertNotIn("services", items[0])
+
+    def test_embed_is_opt_in(self):
+        with Session(self.engine) as session:
+            items, _ = list_machines(session, embed="softwares", limit=1)
+        self.assertEqual(items[0]["softwares"][0]["name"], "Chrome")
+        self.assertNotIn("services", items[0])
+        with Session(self.engine) as session:
+            with self.assertRaises(ValueError):
+                list_machines(session, embed="commands")
+
+    def test_filters(self):
+        with Session(self.engine) as session:
+            items, _ = list_machines(session, client_code="ACME")
+            self.assertEqual(len(items), 5)
+            items, _ = list_machines(session, status="critical")
+            self.assertEqual([m["hostname"] for m in items], ["PC-03"])
+            items, _ = list_machines(session, hostname="PC-0")
+            self.assertEqual(len(items), 10)
+            items, _ = list_machines(session, hostname="pc")
+            self.assertEqual(items, [])
+
+            session.get(Machine, 1).last_seen = datetime.utcnow() - timedelta(days=2)
+            session.commit()
+            items, _ = list_machines(session, seen_before=datetime.utcnow() - timedelta(days=1))
+            self.assertEqual([m["id"] for m in items], [1])
+
+    def test_keyset_pagination_with_sort(self):
+        seen = []
+        cursor = None
+        with Session(self.engine) as session:
+            while True:
+                items, cursor = list_machines(session, sort="-cpu_usage", cursor=cursor, limit=3)
+                seen.extend(m["cpu_usage"] for m in items)
+                if not cursor:
+                    break
+        self.assertEqual(seen, [9, 8, 7, 6, 5, 4, 3, 2, 1, 0])
+        with Session(self.engine) as session:
+            with self.assertRaises(ValueError):
+                list_machines(session, sort="password")
+            with self.assertRaises(ValueError):
+                list_machines(session, cursor="not-a-cursor")
+
+
+if __name__ == '__main__':
+    unittest.main()
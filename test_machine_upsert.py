@@ -0,0 +1,83 @@
+import unittest
+from datetime import datetime
+from sqlmodel import SQLModel, Session, create_engine, select
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import StaticPool
+
+from backend.catalog import catalog_cache
+from backend.events import PENDING_KEY
+from backend.identity import hostname_cache
+from backend.inventory import ingest_report
+from backend.models import InventoryReport, Command, Machine, MetricRollup, Service
+from merge_duplicate_machines import duplicate_groups, merge_into
+
+
+class TestMachineUpsert(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        hostname_cache.clear()
+
+    def ingest(self, **fields):
+        with Session(self.engine) as session:
+            session.expire_on_commit = False
+            published = session.info[PENDING_KEY] = []
+            machine, _ = ingest_report(session, InventoryReport(**fields))
+            session.commit()
+            return machine, [e["type"] for e in published]
+
+    def test_insert_then_update(self):
+        machine, events = self.ingest(hostname="PC-1", client_code="ACME", os_info="Windows 10", disk_usage=50)
+        self.assertEqual((machine.id, machine.status, machine.previous_status), (1, "online", None))
+        self.assertEqual(events, ["stats.invalidated", "machine.created"])
+
+        # Hardware omitted: the stored values are kept
+        machine, events = self.ingest(hostname="PC-1", client_code="ACME", disk_usage=95)
+        self.assertEqual((machine.id, machine.status, machine.previous_status), (1, "critical", "online"))
+        self.assertEqual(machine.os_info, "Windows 10")
+        self.assertEqual(events, ["stats.invalidated", "machine.updated", "machine.status"])
+        self.assertEqual(hostname_cache.get("ACME", "PC-1"), 1)
+
+        # Same hostname for another client is another machine
+        machine, _ = self.ingest(hostname="PC-1", client_code="OTHER")
+        self.assertEqual(machine.id, 2)
+        with Session(self.engine) as session:
+            self.assertEqual(session.query(Machine).count(), 2)
+
+    def test_merge_duplicates(self):
+        with Session(self.engine) as session:
+            session.execute(text("DROP INDEX uq_machine_client_code_hostname"))
+            for month in (1, 3, 2):
+                session.add(Machine(hostname="PC-1", client_code="ACME", last_seen=datetime(2024, month, 1)))
+            session.add(Command(machine_id=1, command="hostname"))
+            session.add(Service(machine_id=1, name="Spooler", display_name="Print Spooler", status="Running", start_type="Automatic"))
+            session.add(MetricRollup(machine_id=1, step=60, bucket=0))
+            session.add(MetricRollup(machine_id=2, step=60, bucket=0))
+            session.add(MetricRollup(machine_id=3, step=60, bucket=60))
+            session.commit()
+
+            groups = list(duplicate_groups(session))
+            self.assertEqual(groups, [[2, 3, 1]])
+            survivor, *duplicates = groups[0]
+            for duplicate in duplicates:
+                merge_into(session, survivor, duplicate)
+            session.commit()
+
+            self.assertEqual(session.exec(select(Machine.id)).all(), [2])
+            self.assertEqual(session.get(Command, 1).machine_id, 2)
+            self.assertEqual(session.query(Service).count(), 0)
+            rollups = session.exec(select(MetricRollup.machine_id, MetricRollup.bucket).order_by(MetricRollup.bucket)).all()
+            self.assertEqual([tuple(r) for r in rollups], [(2, 0), (2, 60)])
+
+            # Duplicates gone: the unique index can be created again
+            unique, = [index for index in Machine.__table__.indexes if index.name == "uq_machine_client_code_hostname"]
+            unique.create(session.connection())
+            with self.assertRaises(IntegrityError):
+                session.add(Machine(hostname="PC-1", client_code="ACME"))
+                session.flush()
+
+
+if __name__ == '__main__':
+    unittest.main()
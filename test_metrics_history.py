@@ -0,0 +1,102 @@
+import unittest
+from sqlmodel import SQLModel, Session, create_engine, select
+from sqlalchemy.pool import StaticPool
+
+from backend.inventory import ingest_report, apply_heartbeat
+from backend.metrics import metrics_buffer, rollup, query_metrics, pick_tier
+from backend.catalog import catalog_cache
+from backend.models import InventoryReport, Heartbeat, Machine, MetricSample, MetricRollup
+
+# Fixed clock: 2024-01-10 00:00:00 UTC
+NOW = 1704844800
+
+
+class TestMetricsHistory(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        metrics_buffer.clear()
+        with Session(self.engine) as session:
+            machine = Machine(hostname="PC-1")
+            session.add(machine)
+            session.commit()
+            self.machine_id = machine.id
+
+    def add_samples(self, samples):
+        with Session(self.engine) as session:
+            for ts, cpu in samples:
+                session.add(MetricSample(machine_id=self.machine_id, ts=ts, cpu=cpu, memory=50, disk=10))
+            session.commit()
+
+    def test_samples_are_buffered_after_commit(self):
+        with Session(self.engine) as session:
+            apply_heartbeat(session, Heartbeat(hostname="PC-1", cpu_usage=10, memory_usage=20, disk_usage=30))
+            self.assertEqual(len(metrics_buffer), 0)
+            session.commit()
+        self.assertEqual(len(metrics_buffer), 1)
+
+        # A rolled back report never reaches the buffer
+        with Session(self.engine) as session:
+            ingest_report(session, InventoryReport(hostname="PC-1", cpu_usage=99))
+            session.rollback()
+        self.assertEqual(len(metrics_buffer), 1)
+
+        with Session(self.engine) as session:
+            self.assertEqual(metrics_buffer.flush(session), 1)
+            sample = session.exec(select(MetricSample)).one()
+            self.assertEqual(sample.machine_id, self.machine_id)
+            self.assertEqual(sample.cpu, 10)
+        self.assertEqual(len(metrics_buffer), 0)
+
+    def test_rollup_tiers(self):
+        start = NOW - 2 * 3600
+        # One sample every 30s for two hours, cpu alternating 10 / 30
+        self.add_samples([(start + i * 30, 10 if i % 2 else 30) for i in range(240)])
+
+        with Session(self.engine) as session:
+            self.assertTrue(rollup(session, now=NOW + 3600))
+            minutes = session.exec(select(MetricRollup).where(MetricRollup.step == 60)).all()
+            hours = session.exec(select(MetricRollup).where(MetricRollup.step == 3600).order_by(MetricRollup.bucket)).all()
+
+        self.assertEqual(len(minutes), 120)
+        self.assertTrue(all(m.samples == 2 and m.cpu_min == 10 and m.cpu_max == 30 for m in minutes))
+        self.assertEqual(len(hours), 2)
+        self.assertEqual(hours[0].bucket, start)
+        self.assertEqual(hours[0].samples, 120)
+        self.assertAlmostEqual(hours[0].cpu_avg, 20)
+
+        # Running again does not duplicate buckets
+        with Session(self.engine) as session:
+            rollup(session, now=NOW + 3600)
+            self.assertEqual(len(session.exec(select(MetricRollup).where(MetricRollup.step == 60)).all()), 120)
+
+    def test_query_picks_tier(self):
+        # Recent range at fine resolution reads raw samples
+        self.assertEqual(pick_tier(NOW - 3600, 30, NOW), 0)
+        self.assertEqual(pick_tier(NOW - 3600, 300, NOW), 60)
+        # A month back: raw and 1-minute data have expired
+        self.assertEqual(pick_tier(NOW - 30 * 86400, 60, NOW), 3600)
+        self.assertEqual(pick_tier(NOW - 30 * 86400, 86400, NOW), 86400)
+
+        start = NOW - 2 * 3600
+        self.add_samples([(start + i * 30, 10 if i % 2 else 30) for i in range(240)])
+        with Session(self.engine) as session:
+            rollup(session, now=NOW + 3600)
+            series = query_metrics(session, self.machine_id, start, NOW, step=600, now=NOW)
+            self.assertEqual(series["tier"], "1m")
+            self.assertEqual(series["step"], 600)
+            self.assertEqual(len(series["points"]), 12)
+            self.assertEqual(series["points"][0]["samples"], 20)
+            self.assertAlmostEqual(series["points"][0]["cpu_avg"], 20)
+
+            # Without a step the number of points stays bounded
+            series = query_metrics(session, self.machine_id, NOW - 30 * 86400, NOW, now=NOW)
+            self.assertEqual(series["tier"], "1h")
+            self.assertEqual(series["step"], 7200)
+            self.assertEqual(len(series["points"]), 1)
+            self.assertEqual(series["points"][0]["samples"], 240)
+
+
+if __name__ == '__main__':
+    unittest.main()
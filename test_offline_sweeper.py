@@ -0,0 +1,57 @@
+import unittest
+from datetime import datetime, timedelta
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy import update
+from sqlalchemy.pool import StaticPool
+
+from backend.catalog import catalog_cache
+from backend.events import pending_events, PENDING_KEY
+from backend.inventory import ingest_chunk, apply_heartbeat
+from backend.models import InventoryReport, Heartbeat, Machine
+from backend.offline import sweep_offline
+from backend.stats import compute_stats
+
+
+class TestOfflineSweeper(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        with Session(self.engine) as session:
+            ingest_chunk(session, [InventoryReport(hostname=f"PC-{i}", disk_usage=95 if i == 1 else None) for i in range(1, 5)])
+            # PC-1 and PC-2 went quiet
+            for machine_id, hours in ((1, 2), (2, 1)):
+                session.execute(update(Machine).where(Machine.id == machine_id).values(last_seen=datetime.utcnow() - timedelta(hours=hours)))
+            session.commit()
+
+    def test_flips_only_stale_machines(self):
+        with Session(self.engine) as session:
+            published = []
+            session.info[PENDING_KEY] = published
+            self.assertEqual(sorted(sweep_offline(session)), [1, 2])
+            transitions = [e for e in published if e["type"] == "machine.status"]
+            self.assertEqual([(e["machine_id"], e["previous_status"], e["status"]) for e in transitions],
+                             [(1, "critical", "offline"), (2, "online", "offline")])
+
+            self.assertEqual([m.status for m in session.query(Machine).order_by(Machine.id)], ["offline", "offline", "online", "online"])
+            self.assertEqual(compute_stats(session)["online_machines"], 2)
+            # Already offline: nothing left to do
+            self.assertEqual(sweep_offline(session), [])
+
+            # A heartbeat brings it back
+            apply_heartbeat(session, Heartbeat(hostname="PC-2", cpu_usage=5))
+            back = [e for e in pending_events(session) if e["type"] == "machine.status"][-1]
+            self.assertEqual((back["machine_id"], back["previous_status"]), (2, "offline"))
+            session.commit()
+            self.assertEqual(session.get(Machine, 2).status, "online")
+
+    def test_batches(self):
+        with Session(self.engine) as session:
+            # Oldest first
+            self.assertEqual(sweep_offline(session, limit=1), [1])
+            self.assertEqual(sweep_offline(session, limit=1), [2])
+            self.assertEqual(sweep_offline(session, now=datetime.utcnow() + timedelta(hours=1)), [3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
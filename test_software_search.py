@@ -0,0 +1,72 @@
+import unittest
+from sqlmodel import SQLModel, Session, create_engine, select
+from sqlalchemy.pool import StaticPool
+
+from backend.catalog import backfill_version_sort, catalog_cache, search_software, version_key, version_sort_key
+from backend.inventory import ingest_chunk
+from backend.models import InventoryReport, SoftwareCatalog
+
+
+def chrome(version):
+    return {"name": "Google Chrome", "version": version, "publisher": "Google LLC"}
+
+
+class TestSoftwareSearch(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        reports = [
+            InventoryReport(hostname="PC-1", softwares=[chrome("120.0.6099.130"), {"name": "7-Zip", "version": "23.01", "publisher": "Igor Pavlov"}]),
+            InventoryReport(hostname="PC-2", softwares=[chrome("120.0.6099.130")]),
+            InventoryReport(hostname="PC-3", softwares=[chrome("121.0.6167.85")]),
+            InventoryReport(hostname="PC-4", softwares=[{"name": "Firefox", "version": "115.0", "publisher": "Mozilla"}]),
+        ]
+        with Session(self.engine) as session:
+            ingest_chunk(session, reports)
+
+    def test_search_by_name_with_version_counts(self):
+        with Session(self.engine) as session:
+            result = search_software(session, q="chrome")
+        self.assertEqual([m["hostname"] for m in result["machines"]], ["PC-1", "PC-2", "PC-3"])
+        self.assertEqual(result["machines"][0]["matches"], [chrome("120.0.6099.130")])
+        self.assertEqual(
+            [(v["version"], v["machines"]) for v in result["versions"]],
+            [("120.0.6099.130", 2), ("121.0.6167.85", 1)]
+        )
+        self.assertIsNone(result["next_cursor"])
+
+    def test_version_and_publisher_filters(self):
+        self.assertLess(version_key("120.0.6099.217"), version_key("121.0"))
+        self.assertLess(version_key("9.1"), version_key("10.0"))
+        with Session(self.engine) as session:
+            result = search_software(session, q="chrome", version_lt="121")
+            self.assertEqual([m["hostname"] for m in result["machines"]], ["PC-1", "PC-2"])
+            result = search_software(session, publisher="mozilla")
+            self.assertEqual([m["hostname"] for m in result["machines"]], ["PC-4"])
+            # Only catalog entries below the version are matched, in SQL
+            self.assertEqual(search_software(session, q="chrome", version_lt="120.0.6099.130")["machines"], [])
+            # LIKE wildcards in the query are literal
+            self.assertEqual(search_software(session, q="%")["machines"], [])
+
+    def test_version_sort_key(self):
+        versions = ["1.0", "1.0.1", "1.0a", "1.0.0.9", "1.2", "1.10", "10", "2.0-beta", "2.0", "2.0.0", "", "v3", "007", "120.0.6099.217"]
+        by_key = sorted(versions, key=version_key)
+        self.assertEqual(sorted(versions, key=lambda v: version_sort_key(v).encode()), by_key)
+        with Session(self.engine) as session:
+            session.exec(select(SoftwareCatalog)).first().version_sort = None
+            session.commit()
+            self.assertEqual(backfill_version_sort(session), 1)
+            self.assertNotIn(None, session.exec(select(SoftwareCatalog.version_sort)).all())
+
+    def test_keyset_pagination(self):
+        with Session(self.engine) as session:
+            first = search_software(session, q="chrome", limit=2)
+            self.assertEqual([m["hostname"] for m in first["machines"]], ["PC-1", "PC-2"])
+            second = search_software(session, q="chrome", limit=2, cursor=first["next_cursor"])
+            self.assertEqual([m["hostname"] for m in second["machines"]], ["PC-3"])
+            self.assertIsNone(second["next_cursor"])
+
+
+if __name__ == '__main__':
+    unittest.main()
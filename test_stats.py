@@ -0,0 +1,60 @@
+import unittest
+from sqlmodel import SQLModel, Session, create_engine
+from sqlalchemy.pool import StaticPool
+
+from backend.catalog import catalog_cache
+from backend.inventory import ingest_report, ingest_chunk
+from backend.models import InventoryReport
+from backend.events import broker
+from backend.stats import compute_stats, read_cached_stats, stats_cache, STATS_EVENT
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+        SQLModel.metadata.create_all(self.engine)
+        catalog_cache.clear()
+        stats_cache.invalidate()
+        reports = [
+            InventoryReport(hostname="PC-1", client_code="ACME", os_info="Windows 11", ram_gb=16, manufacturer="Dell", model="OptiPlex"),
+            InventoryReport(hostname="PC-2", client_code="ACME", os_info="Windows 11", ram_gb=7.8, manufacturer="Dell", model="OptiPlex", disk_usage=95),
+            InventoryReport(hostname="PC-3", client_code="GLOBEX", os_info="Windows 10"),
+        ]
+        with Session(self.engine) as session:
+            ingest_chunk(session, reports)
+
+    def test_breakdowns(self):
+        with Session(self.engine) as session:
+            stats = compute_stats(session)
+        self.assertEqual(stats["total_machines"], 3)
+        self.assertEqual(stats["online_machines"], 3)
+        self.assertEqual(stats["os_distribution"], {"Windows 11": 2, "Windows 10": 1})
+        self.assertEqual(stats["status_distribution"], {"online": 2, "critical": 1})
+        self.assertEqual(stats["client_distribution"], {"ACME": 2, "GLOBEX": 1})
+        self.assertEqual(stats["ram_distribution"], {"16-32 GB": 1, "4-8 GB": 1, "Unknown": 1})
+        self.assertEqual(stats["top_models"][0], {"manufacturer": "Dell", "model": "OptiPlex", "count": 2})
+
+    def test_cache_invalidated_by_relevant_changes(self):
+        with Session(self.engine) as session:
+            first = read_cached_stats(session)
+            # Metrics only: the cached result is kept
+            ingest_report(session, InventoryReport(hostname="PC-3", client_code="GLOBEX", cpu_usage=50))
+            session.commit()
+            self.assertIs(read_cached_stats(session), first)
+
+            ingest_report(session, InventoryReport(hostname="PC-3", client_code="GLOBEX", os_info="Windows 11"))
+            session.commit()
+            second = read_cached_stats(session)
+        self.assertIsNot(second, first)
+        self.assertEqual(second["os_distribution"], {"Windows 11": 3})
+
+    def test_cache_dropped_by_event_from_another_worker(self):
+        with Session(self.engine) as session:
+            first = read_cached_stats(session)
+            # What the PostgreSQL broker's listener hands over for another process's commit
+            broker.dispatch([{"type": STATS_EVENT}])
+            self.assertIsNot(read_cached_stats(session), first)
+
+
+if __name__ == '__main__':
+    unittest.main()